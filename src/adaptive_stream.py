@@ -0,0 +1,122 @@
+import time
+
+
+def quality_ladder(tiers, max_quality):
+    # JPEG qualities a viewer may use, best first. Always at least the lowest tier.
+    allowed = sorted((q for q in tiers if q <= max_quality), reverse=True)
+    return allowed or [min(tiers)]
+
+
+def downscale_for_width(full_width, max_width, downscales):
+    # Smallest downscale factor whose width fits in max_width (the largest factor if none fits)
+    for factor in sorted(downscales):
+        if full_width // factor <= max_width:
+            return factor
+    return max(downscales)
+
+
+def pick_variant(jpegs, wanted):
+    """Returns the JPEG for the (quality, downscale) variant, or the closest one that was encoded."""
+    jpeg = jpegs.get(wanted)
+    if jpeg is not None or not jpegs:
+        return jpeg
+    quality, downscale = wanted
+    best = min(jpegs, key=lambda key: (abs(key[1] - downscale), abs(key[0] - quality)))
+    return jpegs[best]
+
+
+class AdaptiveViewer:
+    """Frame rate and JPEG quality of one live-stream connection, adapted to its link.
+
+    After every frame the viewer reports how many bytes have left the server
+    and how many are still queued in the socket. From that it keeps an
+    estimate of the link throughput and of the end-to-end latency: age of the
+    frame when it was written plus the time the queued bytes still need. When
+    the latency goes over target it steps the quality down, then the frame
+    rate; once the latency has stayed well under target for a while it steps
+    back up, frame rate first. A step up that quickly has to be undone doubles
+    the wait before the next one, so a link at its limit does not oscillate.
+    Client hints (fps, q, w) are the ceilings.
+    """
+
+    def __init__(self, max_fps, qualities, downscale, target_latency, min_fps=1.0,
+                 adapt_interval=1.0, recover_interval=3.0):
+        self.max_fps = max_fps
+        self.min_fps = min(min_fps, max_fps)
+        self.fps = max_fps
+        self.qualities = qualities
+        self.level = 0 # Index into qualities
+        self.downscale = downscale
+        self.target_latency = target_latency
+        self.adapt_interval = adapt_interval
+        self.recover_interval = recover_interval
+        self._recover_wait = recover_interval
+        self._last_upgrade = None
+        self.latency = None    # Seconds, smoothed
+        self.throughput = None # Bytes/s, smoothed
+        self.downgrades = 0
+        self.upgrades = 0
+        self.frames_sent = 0    # Counted by the stream generator
+        self.frames_skipped = 0
+        self._last_change = time.monotonic()
+        self._last_sample = None # (time, delivered bytes)
+
+    @property
+    def variant(self):
+        return self.qualities[self.level], self.downscale
+
+    @property
+    def frame_interval(self):
+        return 1.0 / self.fps
+
+    def observe(self, now, captured_at, delivered_bytes, queued_bytes):
+        """Feeds one sent frame: delivered_bytes is the running total that left the socket."""
+        if self._last_sample is not None:
+            elapsed = now - self._last_sample[0]
+            if elapsed > 0:
+                rate = (delivered_bytes - self._last_sample[1]) / elapsed
+                self.throughput = rate if self.throughput is None else 0.8 * self.throughput + 0.2 * rate
+        self._last_sample = (now, delivered_bytes)
+
+        latency = now - captured_at
+        if queued_bytes and self.throughput:
+            latency += queued_bytes / self.throughput
+        self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+        self._adapt(now)
+
+    def _adapt(self, now):
+        since_change = now - self._last_change
+        if self.latency > self.target_latency and since_change >= self.adapt_interval:
+            if self.level < len(self.qualities) - 1:
+                self.level += 1
+            elif self.fps > self.min_fps:
+                self.fps = max(self.min_fps, self.fps * 0.7)
+            else:
+                return
+            if self._last_upgrade is not None and now - self._last_upgrade < 2 * self._recover_wait:
+                self._recover_wait = min(self._recover_wait * 2, 60.0) # The last step up was too much
+            self.downgrades += 1
+            self._last_change = now
+        elif self.latency < self.target_latency / 3 and since_change >= self._recover_wait:
+            if self.fps < self.max_fps:
+                self.fps = min(self.max_fps, self.fps * 1.25)
+            elif self.level > 0:
+                self.level -= 1
+            else:
+                return
+            self.upgrades += 1
+            self._last_change = self._last_upgrade = now
+
+    def stats(self):
+        quality, downscale = self.variant
+        return {
+            "fps": round(self.fps, 1),
+            "quality": quality,
+            "downscale": downscale,
+            "latency_ms": round(self.latency * 1000) if self.latency is not None else None,
+            "throughput_kbps": round(self.throughput * 8 / 1000) if self.throughput is not None else None,
+            "downgrades": self.downgrades,
+            "upgrades": self.upgrades,
+            "frames_sent": self.frames_sent,
+            "frames_skipped": self.frames_skipped,
+        }
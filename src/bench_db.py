@@ -0,0 +1,71 @@
+"""Benchmark for the events database at large sizes, no camera needed.
+
+Fills a scratch database with N events and measures insert latency plus
+first-page and deep-page keyset queries at several table sizes, to check
+that they stay flat as the table grows.
+
+    python bench_db.py --events 100000
+"""
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+import config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark event inserts and keyset pagination")
+    parser.add_argument("--events", type=int, default=100_000)
+    parser.add_argument("--checkpoints", type=int, default=4, help="Measure this many times while filling")
+    parser.add_argument("--samples", type=int, default=50)
+    args = parser.parse_args()
+
+    # Point the storage layer at a scratch file before it is imported
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_events.db")
+    config.DB_FILE = db_path
+    import myEventDataBase as db
+    db.init_db()
+
+    conn = db.get_connection()
+    start_ts = int(time.time()) - args.events * 60
+    step = max(1, args.events // args.checkpoints)
+    inserted = 0
+    print(f"Database: {db_path}")
+    print(f"{'rows':>9} {'insert ms':>10} {'page 1 ms':>10} {'deep page ms':>13}")
+    while inserted < args.events:
+        # Bulk fill up to the next checkpoint, then time the normal code paths
+        batch = min(step, args.events - inserted)
+        with conn:
+            conn.executemany(
+                "INSERT INTO video_events (event_type, mp4_filepath, event_timestamp, event_ts) VALUES (?, ?, ?, ?);",
+                [("Motion Detected", f"/bench/{inserted + i}.mp4", "", start_ts + (inserted + i) * 60)
+                 for i in range(batch)])
+        inserted += batch
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull): # The storage layer logs every call
+            started = time.perf_counter()
+            for i in range(args.samples):
+                db.record_new_video_event("Motion Detected", None, f"/bench/live_{inserted}_{i}.mp4", None, "bench")
+            insert_ms = (time.perf_counter() - started) * 1000 / args.samples
+
+            started = time.perf_counter()
+            for _ in range(args.samples):
+                db.get_video_events_page(10)
+            first_ms = (time.perf_counter() - started) * 1000 / args.samples
+
+            # A cursor near the oldest end of the table
+            deep_cursor = f"{start_ts + 20 * 60}_{21}"
+            started = time.perf_counter()
+            for _ in range(args.samples):
+                db.get_video_events_page(10, before=deep_cursor)
+            deep_ms = (time.perf_counter() - started) * 1000 / args.samples
+        print(f"{inserted:>9} {insert_ms:>10.3f} {first_ms:>10.3f} {deep_ms:>13.3f}")
+
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT id FROM video_events WHERE (event_ts, id) < (?, ?) "
+                        "ORDER BY event_ts DESC, id DESC LIMIT 10;", (start_ts, 1)).fetchall()
+    print("Query plan:", "; ".join(row["detail"] for row in plan))
+
+
+if __name__ == "__main__":
+    main()
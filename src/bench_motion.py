@@ -0,0 +1,98 @@
+"""Benchmark for the software motion detector, no camera needed.
+
+Runs MotionDetector over a synthetic sequence (noisy background with a
+square walking through it part of the time) or over the luma of a recorded
+clip, and reports the per-frame cost against a budget plus, for synthetic
+input, how well the detections match the ground truth.
+
+    python bench_motion.py --frames 500 --size 640x360 --budget-ms 20
+    python bench_motion.py --input /path/to/event.mp4
+"""
+import argparse
+import time
+import numpy as np
+from motion_detector import MotionDetector
+
+
+def synthetic_frames(count, width, height, seed=0):
+    # Yields (luma, has_motion). The object is present in the middle third of the sequence.
+    rng = np.random.default_rng(seed)
+    background = rng.integers(60, 120, size=(height, width), dtype=np.uint8)
+    side = max(8, min(width, height) // 6)
+    for i in range(count):
+        frame = background.copy()
+        frame += rng.integers(0, 6, size=(height, width), dtype=np.uint8) # Sensor noise
+        has_motion = count // 3 <= i < 2 * count // 3
+        if has_motion:
+            x = (i * 7) % max(1, width - side)
+            y = height // 2 - side // 2
+            frame[y:y + side, x:x + side] = 230
+        yield frame, has_motion
+
+
+def video_frames(path, limit):
+    import av
+    with av.open(path) as container:
+        for i, frame in enumerate(container.decode(video=0)):
+            if limit and i >= limit:
+                break
+            yield frame.to_ndarray(format="gray"), None
+
+
+def run(frames, detector):
+    timings = []
+    hits = misses = false_alarms = total_motion = 0
+    for luma, expected in frames:
+        started = time.perf_counter()
+        detected = detector.process(luma)
+        timings.append((time.perf_counter() - started) * 1000)
+        if expected is None:
+            hits += detected
+            continue
+        total_motion += expected
+        if expected and detected:
+            hits += 1
+        elif expected:
+            misses += 1
+        elif detected:
+            false_alarms += 1
+    return np.array(timings), hits, misses, false_alarms, total_motion
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the lores motion detector")
+    parser.add_argument("--input", help="Video file to replay instead of synthetic frames")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--size", default="640x360", help="Synthetic frame size, WxH")
+    parser.add_argument("--downscale", type=int, default=4)
+    parser.add_argument("--threshold", type=int, default=25)
+    parser.add_argument("--min-area", type=float, default=0.01)
+    parser.add_argument("--budget-ms", type=float, default=20.0, help="Per-frame CPU budget")
+    args = parser.parse_args()
+
+    detector = MotionDetector(downscale=args.downscale, threshold=args.threshold, min_area=args.min_area)
+    if args.input:
+        frames = video_frames(args.input, args.frames)
+        source = args.input
+    else:
+        width, height = (int(v) for v in args.size.split("x"))
+        frames = synthetic_frames(args.frames, width, height)
+        source = f"synthetic {width}x{height}"
+
+    timings, hits, misses, false_alarms, total_motion = run(frames, detector)
+    if not len(timings):
+        print("No frames processed.")
+        return
+    print(f"Source: {source}, {len(timings)} frames, downscale {args.downscale}")
+    print(f"Per frame: mean {timings.mean():.3f} ms, p95 {np.percentile(timings, 95):.3f} ms, "
+          f"max {timings.max():.3f} ms (budget {args.budget_ms} ms)")
+    if args.input:
+        print(f"Frames with motion: {hits}")
+    else:
+        print(f"Motion frames: {total_motion}, detected {hits}, missed {misses}, false alarms {false_alarms}")
+    within_budget = np.percentile(timings, 95) <= args.budget_ms
+    print("Within budget." if within_budget else "OVER BUDGET.")
+
+
+if __name__ == "__main__":
+    main()
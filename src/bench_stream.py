@@ -0,0 +1,256 @@
+"""Load test for the production stream server, no camera needed.
+
+Starts gunicorn with gunicorn.conf.py in a child process, with a fake camera
+that publishes frames sized like real JPEG variants and stamped with their
+capture time, then connects simulated viewers:
+
+  * normal viewers that read as fast as frames arrive,
+  * limited viewers that read at --limited-rate and should adapt their
+    frame rate and quality to stay under the latency target,
+  * hinted viewers that ask for ?fps=5&q=40&w=200,
+  * slow viewers that read at a trickle and should be evicted for lag,
+  * stalled viewers that never read and should hit the send timeout,
+
+while a probe keeps timing the control routes. Viewers over the cap
+should get a 503 right away.
+
+    python bench_stream.py --viewers 1 --limited 1 --hinted 1 --slow 1 --stalled 1 --seconds 30
+"""
+import argparse
+import http.client
+import os
+import runpy
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+
+class FakeCamera:
+    pass
+
+
+def install_fake_camera(cam_manager, frame_bytes, encode_ms):
+    # Replaces the camera parts of CameraManager; everything from the capture thread on is real
+    payload = os.urandom(frame_bytes)
+
+    def setup_camera():
+        cam_manager.camera = FakeCamera()
+        return cam_manager.camera
+
+    lores = []
+
+    def capture_lores(variants, want_luma, activity=None):
+        captured_at = struct.pack("d", time.time()) # Lets the viewers measure end-to-end latency
+        if activity is not None:
+            # A flat grey YUV420 lores buffer, so an event recorded during the run still gets its activity
+            if not lores:
+                import numpy as np
+                from camera_manager import CAMERA_LORES_RESOLUTION
+                width, height = CAMERA_LORES_RESOLUTION
+                lores.append(np.full((height * 3 // 2, width), 128, dtype=np.uint8))
+            activity.add(lores[0], time.time())
+        jpegs = {}
+        for quality, downscale in variants:
+            time.sleep(encode_ms / 1000 / downscale ** 2) # Stands in for the JPEG encode
+            size = max(64, int(frame_bytes * quality / 75 / downscale ** 2))
+            jpegs[(quality, downscale)] = captured_at + payload[:size - 8]
+        return jpegs
+
+    cam_manager.setup_camera = setup_camera
+    cam_manager._capture_lores = capture_lores
+    cam_manager.noti.send_telegram_message = lambda *args, **kwargs: True
+
+
+def serve(args):
+    from gunicorn.app.base import BaseApplication
+    import config
+    config.STREAM_MAX_VIEWERS = args.max_viewers # Read by gunicorn.conf.py and camera_manager
+
+    class BenchServer(BaseApplication):
+        def load_config(self):
+            # Same settings as production, from gunicorn.conf.py
+            settings = runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "gunicorn.conf.py"))
+            for key, value in settings.items():
+                if key in self.cfg.settings:
+                    self.cfg.set(key, value)
+            self.cfg.set("bind", f"127.0.0.1:{args.port}")
+            self.cfg.set("post_worker_init", lambda worker: None) # No motion thread or post-processing
+
+        def load(self):
+            import stream
+            install_fake_camera(stream.cam_manager, args.frame_bytes, args.encode_ms)
+            return stream.app
+
+    BenchServer().run()
+
+
+class Viewer(threading.Thread):
+    """One /video_feed client. read_rate: None reads as fast as possible, 0 never reads, else bytes/s."""
+
+    def __init__(self, port, read_rate=None, query=""):
+        super().__init__(daemon=True)
+        self.port = port
+        self.read_rate = read_rate
+        self.query = query
+        self.status = None
+        self.frame_times = []
+        self.latencies_ms = []
+        self.disconnected = False
+        self.stop = threading.Event()
+
+    def run(self):
+        if self.read_rate == 0:
+            self._stall()
+        else:
+            self._read_frames()
+
+    def _read_frames(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        try:
+            if self.read_rate:
+                # A small receive window, so a limited link backs up into the server like a real one would
+                conn.sock = socket.socket()
+                conn.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32 * 1024)
+                conn.sock.settimeout(30)
+                conn.sock.connect(("127.0.0.1", self.port))
+            conn.request("GET", "/video_feed" + self.query)
+            response = conn.getresponse()
+            self.status = response.status
+            if response.status != 200:
+                return
+            while not self.stop.is_set():
+                line = response.readline()
+                if not line:
+                    self.disconnected = True
+                    return
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+                    response.readline() # Blank line after the part headers
+                    started = time.monotonic()
+                    body = response.read(length)
+                    if self.read_rate:
+                        time.sleep(max(0.0, length / self.read_rate - (time.monotonic() - started)))
+                    self.frame_times.append(time.monotonic())
+                    self.latencies_ms.append((time.time() - struct.unpack("d", body[:8])[0]) * 1000)
+        except (OSError, http.client.HTTPException):
+            self.disconnected = True
+        finally:
+            conn.close()
+
+    def _stall(self):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024)
+        try:
+            sock.connect(("127.0.0.1", self.port))
+            sock.sendall(b"GET /video_feed HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            first = sock.recv(64)
+            self.status = int(first.split(b" ")[1]) if first.startswith(b"HTTP/") else None
+            self.stop.wait()
+        except OSError:
+            self.disconnected = True
+        finally:
+            sock.close()
+
+
+def request_json(port, method, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        started = time.perf_counter()
+        conn.request(method, path)
+        response = conn.getresponse()
+        body = response.read()
+        return response.status, body, (time.perf_counter() - started) * 1000
+    finally:
+        conn.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the MJPEG stream server with simulated viewers")
+    parser.add_argument("--viewers", type=int, default=1, help="Viewers reading at full speed")
+    parser.add_argument("--limited", type=int, default=1, help="Viewers reading at --limited-rate")
+    parser.add_argument("--hinted", type=int, default=1, help="Viewers asking for a small, slow stream")
+    parser.add_argument("--slow", type=int, default=1, help="Viewers reading at --slow-rate")
+    parser.add_argument("--stalled", type=int, default=1, help="Viewers that never read")
+    parser.add_argument("--extra", type=int, default=2, help="Viewers started after the cap is reached")
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--max-viewers", type=int, default=5)
+    parser.add_argument("--port", type=int, default=5077)
+    parser.add_argument("--frame-bytes", type=int, default=40_000)
+    parser.add_argument("--encode-ms", type=float, default=5)
+    parser.add_argument("--limited-rate", type=int, default=300_000, help="Bytes/s read by limited viewers")
+    parser.add_argument("--slow-rate", type=int, default=8_000, help="Bytes/s read by slow viewers")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port),
+                               "--max-viewers", str(args.max_viewers),
+                               "--frame-bytes", str(args.frame_bytes), "--encode-ms", str(args.encode_ms)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                request_json(args.port, "GET", "/stream_status")
+                break
+            except OSError:
+                time.sleep(0.1)
+        request_json(args.port, "POST", "/start_stream")
+
+        viewers = [Viewer(args.port) for _ in range(args.viewers)]
+        limited = [Viewer(args.port, args.limited_rate) for _ in range(args.limited)]
+        hinted = [Viewer(args.port, query="?fps=5&q=40&w=200") for _ in range(args.hinted)]
+        slow = [Viewer(args.port, args.slow_rate) for _ in range(args.slow)]
+        stalled = [Viewer(args.port, 0) for _ in range(args.stalled)]
+        everyone = viewers + limited + hinted + slow + stalled
+        for viewer in everyone:
+            viewer.start()
+            time.sleep(0.05)
+        time.sleep(1)
+        extra = [Viewer(args.port) for _ in range(args.extra)]
+        for viewer in extra:
+            viewer.start()
+
+        control_ms = []
+        deadline = time.monotonic() + args.seconds
+        while time.monotonic() < deadline:
+            control_ms.append(request_json(args.port, "GET", "/stream_status")[2])
+            control_ms.append(request_json(args.port, "POST", "/start_stream")[2])
+            time.sleep(0.2)
+        status, body, _ = request_json(args.port, "GET", "/stream_status")
+        for viewer in everyone + extra:
+            viewer.stop.set()
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"Server stats: {body.decode()}")
+    for name, group in (("normal", viewers), ("limited", limited), ("hinted", hinted), ("slow", slow),
+                        ("stalled", stalled), ("extra", extra)):
+        for i, viewer in enumerate(group):
+            # Last half only, after the adaptive pacing has settled
+            settled = viewer.latencies_ms[len(viewer.latencies_ms) // 2:]
+            fps = len(viewer.frame_times) / args.seconds
+            latency_info = (f", latency p50 {percentile(settled, 0.5):.0f} ms, p95 {percentile(settled, 0.95):.0f} ms"
+                            if settled else "")
+            print(f"{name} viewer {i}: HTTP {viewer.status}, {len(viewer.frame_times)} frames ({fps:.1f} fps)"
+                  f"{latency_info}, disconnected by server: {viewer.disconnected}")
+    print(f"Control routes: {len(control_ms)} requests, p50 {statistics.median(control_ms):.1f} ms, "
+          f"p95 {percentile(control_ms, 0.95):.1f} ms, max {max(control_ms):.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
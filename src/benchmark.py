@@ -0,0 +1,233 @@
+"""End-to-end benchmark suite on the simulated camera, no Pi needed.
+
+Runs the real CameraManager (capture thread, JPEG encoding, pre-roll
+encoder, MP4 muxing, post-processing queue and events database) on the
+simulated camera backend and measures:
+
+  * mjpeg:   frames per second each viewer gets with 1, 2, 4, ... viewers,
+             and the process CPU used meanwhile,
+  * encode:  per-frame cost of the lores JPEG variants,
+  * record:  trigger to first frame in the file, and motion end to file
+             closed, for record_motion_video(),
+  * event:   trigger to the event row being in the database.
+
+Results are written as JSON along with the git version and the host, and
+--compare prints each metric against an earlier results file, flagging the
+ones that got worse by more than --tolerance. On the Pi, pass
+--backend picamera2 to measure with the real camera.
+
+    python benchmark.py --output results.json
+    python benchmark.py --compare results.json --output results-new.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import config
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Results:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, value, unit, better):
+        # better: "higher" or "lower", used by --compare
+        self.metrics[name] = {"value": round(value, 3), "unit": unit, "better": better}
+        print(f"  {name}: {value:.2f} {unit}")
+
+
+def bench_mjpeg(cam_manager, viewer_counts, seconds, results):
+    print("MJPEG fps per viewer count")
+    cam_manager.start_stream()
+    for count in viewer_counts:
+        frames = [0] * count
+        measuring = threading.Event()
+        done = threading.Event()
+
+        def viewer(index):
+            stream = cam_manager.generate_mjpeg_stream()
+            try:
+                for _ in stream:
+                    if done.is_set():
+                        break
+                    if measuring.is_set():
+                        frames[index] += 1
+            finally:
+                stream.close()
+
+        threads = [threading.Thread(target=viewer, args=(i,), daemon=True) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        time.sleep(1.0) # Warm-up: capture thread started, pacing settled
+        cpu_started, wall_started = time.process_time(), time.monotonic()
+        measuring.set()
+        time.sleep(seconds)
+        measuring.clear()
+        cpu = (time.process_time() - cpu_started) / (time.monotonic() - wall_started)
+        done.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        per_viewer = [n / seconds for n in frames]
+        results.add(f"mjpeg_fps_min_{count}_viewers", min(per_viewer), "fps", "higher")
+        results.add(f"mjpeg_cpu_{count}_viewers", cpu * 100, "% of one core", "lower")
+    cam_manager.stop_stream()
+
+
+def bench_encode(cam_manager, samples, results):
+    from camera_manager import encode_yuv420_jpeg, STREAM_QUALITY_TIERS, STREAM_DOWNSCALES
+    from config import CAMERA_LORES_RESOLUTION
+    print("Lores JPEG encode cost per frame")
+    frames = []
+    for _ in range(min(samples, 30)):
+        frame = cam_manager.camera.capture_lores()
+        frames.append(frame.array.copy())
+        frame.release()
+    for quality in (max(STREAM_QUALITY_TIERS), min(STREAM_QUALITY_TIERS)):
+        for downscale in STREAM_DOWNSCALES:
+            timings = []
+            for i in range(samples):
+                started = time.perf_counter()
+                encode_yuv420_jpeg(frames[i % len(frames)], CAMERA_LORES_RESOLUTION, quality, downscale)
+                timings.append((time.perf_counter() - started) * 1000)
+            results.add(f"jpeg_encode_ms_q{quality}_d{downscale}", statistics.median(timings), "ms", "lower")
+
+
+def bench_record(cam_manager, events, motion_seconds, results):
+    import myEventDataBase as db
+    from camera_manager import RECORD_HOLD_SECONDS
+    print(f"Motion recording ({events} events, {motion_seconds}s of motion, {RECORD_HOLD_SECONDS}s hold)")
+    to_start, to_closed, to_db = [], [], []
+    conn = db.get_connection()
+    for _ in range(events):
+        time.sleep(1.5) # Let the pre-roll buffer fill again
+        triggered_at = time.monotonic()
+        motion_until = triggered_at + motion_seconds
+        started = []
+        cam_manager.backend.set_motion(True)
+        path = cam_manager.record_motion_video(motion_active=lambda: time.monotonic() < motion_until,
+                                               on_started=lambda: started.append(time.monotonic()))
+        closed_at = time.monotonic()
+        cam_manager.backend.set_motion(False)
+        if path is None or not started:
+            print("  Recording failed, skipping this event.")
+            continue
+        to_start.append((started[0] - triggered_at) * 1000)
+        to_closed.append((closed_at - motion_until) * 1000)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if conn.execute("SELECT 1 FROM video_events WHERE mp4_filepath = ?", (path,)).fetchone():
+                to_db.append((time.monotonic() - triggered_at) * 1000)
+                break
+            time.sleep(0.01)
+        else:
+            print(f"  No database row for {path} after 30s.")
+    if to_start:
+        results.add("record_trigger_to_start_ms", statistics.median(to_start), "ms", "lower")
+        results.add("record_motion_end_to_file_closed_ms", statistics.median(to_closed), "ms", "lower")
+    if to_db:
+        results.add("event_trigger_to_db_ms", statistics.median(to_db), "ms", "lower")
+        results.add("event_trigger_to_db_p95_ms", percentile(to_db, 0.95), "ms", "lower")
+
+
+def compare(previous, current, tolerance):
+    print(f"Compared with {previous.get('version')} ({previous.get('timestamp')}):")
+    regressions = 0
+    for name, metric in current["metrics"].items():
+        old = previous.get("metrics", {}).get(name)
+        if old is None or not old["value"]:
+            print(f"  {name}: {metric['value']} {metric['unit']} (new)")
+            continue
+        change = (metric["value"] - old["value"]) / old["value"]
+        worse = change < -tolerance if metric["better"] == "higher" else change > tolerance
+        regressions += worse
+        flag = "  REGRESSION" if worse else ""
+        print(f"  {name}: {old['value']} -> {metric['value']} {metric['unit']} ({change:+.1%}){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark streaming, encoding and recording end to end")
+    parser.add_argument("--backend", default="simulated", help="Camera backend, simulated or picamera2")
+    parser.add_argument("--source", help="Video file for the simulated camera instead of the synthetic scene")
+    parser.add_argument("--viewers", default="1,2,4", help="Viewer counts for the MJPEG test")
+    parser.add_argument("--seconds", type=float, default=5, help="Measuring time per viewer count")
+    parser.add_argument("--encode-samples", type=int, default=200)
+    parser.add_argument("--events", type=int, default=3)
+    parser.add_argument("--motion-seconds", type=float, default=1.0)
+    parser.add_argument("--hold", type=float, default=1.0, help="RECORD_HOLD_SECONDS for the recording test")
+    parser.add_argument("--skip", default="", help="Comma separated tests to skip: mjpeg,encode,record")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change counted as a regression")
+    args = parser.parse_args()
+
+    # Scratch storage and the settings under test, before anything reads them
+    scratch = tempfile.mkdtemp(prefix="pizero-bench-")
+    config.CAMERA_BACKEND = args.backend
+    config.SIM_CAMERA_SOURCE_FILE = args.source
+    config.EVENTS_STORAGE_DIR = scratch
+    config.DB_FILE = os.path.join(scratch, "bench_events.db")
+    config.RECORD_HOLD_SECONDS = args.hold
+    config.WORKER_PROCESS = False # Post-processing in this process, where the Telegram stubs below apply
+    import myEventDataBase as db
+    from camera_manager import CameraManager
+    db.init_db()
+
+    cam_manager = CameraManager()
+    cam_manager.noti.send_telegram_message = lambda *a, **kw: True
+    cam_manager.noti.bot_token = None # No uploads
+    cam_manager.postprocessor.start()
+    if cam_manager.setup_camera() is None:
+        sys.exit("Camera could not be started.")
+
+    skip = set(filter(None, args.skip.split(",")))
+    results = Results()
+    if "mjpeg" not in skip:
+        bench_mjpeg(cam_manager, [int(n) for n in args.viewers.split(",")], args.seconds, results)
+    if "encode" not in skip:
+        bench_encode(cam_manager, args.encode_samples, results)
+    if "record" not in skip:
+        bench_record(cam_manager, args.events, args.motion_seconds, results)
+    cam_manager.postprocessor.stop()
+
+    report = {
+        "version": git_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "metrics": results.metrics,
+    }
+    regressions = 0
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
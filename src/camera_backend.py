@@ -0,0 +1,310 @@
+import threading
+import time
+from fractions import Fraction
+try:
+    from picamera2.outputs import Output
+except ImportError:
+    class Output:
+        """Stand-in for picamera2.outputs.Output off the Pi, with the same attributes."""
+
+        def __init__(self, pts=None):
+            self.recording = False
+            self.ptsoutput = pts
+
+        def start(self):
+            self.recording = True
+
+        def stop(self):
+            self.recording = False
+
+        def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=False):
+            pass
+
+
+# A camera backend gives CameraManager everything it uses from the camera:
+#
+#   start()                               configure and start streaming frames
+#   start_autofocus()                     start an autofocus scan (no-op where there is none)
+#   autofocus_state()                     "scanning", "focused" or "failed"; None without autofocus
+#   capture_lores()                       the next lores frame: .array is the YUV420 buffer
+#                                         (numpy, Y rows then U then V), .save_jpeg(stream)
+#                                         saves a JPEG snapshot (fallback without simplejpeg), .release() hands
+#                                         the buffer back
+#   start_encoder(output, bitrate, iperiod, stream)
+#                                         H.264 from "main" or "lores" into
+#                                         output.outputframe(frame, keyframe, timestamp_us),
+#                                         returns a handle for stop_encoder()
+#   stop_encoder(handle)
+#   close()
+
+
+class _PicameraLoresFrame:
+    def __init__(self, request, mapped_array):
+        self._request = request
+        self._mapped = mapped_array
+        self.array = mapped_array.__enter__().array
+
+    def save_jpeg(self, stream):
+        self._request.save("main", stream, format="jpeg")
+
+    def release(self):
+        try:
+            self._mapped.__exit__(None, None, None)
+        finally:
+            self._request.release()
+
+
+class Picamera2Backend:
+    """The Pi camera through Picamera2. picamera2 and libcamera are imported on start()."""
+
+    name = "picamera2"
+
+    def __init__(self, main_size, lores_size):
+        self.main_size = main_size
+        self.lores_size = lores_size
+        self.picam2 = None
+
+    def start(self):
+        from picamera2 import Picamera2
+        self.picam2 = Picamera2()
+        # Configuration for main (recording) and lores (MJPEG stream)
+        video_config = self.picam2.create_video_configuration(
+            main={"size": self.main_size, "format": "XRGB8888"}, # XRGB8888 for H.264 encoder
+            lores={"size": self.lores_size, "format": "YUV420"}  # YUV420 is good for MJPEG
+        )
+        self.picam2.configure(video_config)
+        self.picam2.start()
+        print("Picamera2 started.")
+
+    def start_autofocus(self):
+        # For the IMX708; raises on cameras or libcamera versions without autofocus
+        from libcamera import controls
+        self.picam2.set_controls({"AfMode": controls.AfModeEnum.Auto, "AfTrigger": controls.AfTriggerEnum.Start})
+
+    def autofocus_state(self):
+        # AfState of the next frame's metadata: 0 idle, 1 scanning, 2 focused, 3 failed
+        state = self.picam2.capture_metadata().get("AfState")
+        if state is None:
+            return None
+        return {2: "focused", 3: "failed"}.get(int(state), "scanning")
+
+    def capture_lores(self):
+        from picamera2 import MappedArray
+        request = self.picam2.capture_request()
+        try:
+            return _PicameraLoresFrame(request, MappedArray(request, "lores"))
+        except Exception:
+            request.release()
+            raise
+
+    def start_encoder(self, output, bitrate, iperiod, stream="main"):
+        from picamera2.encoders import H264Encoder
+        # Repeated headers so a clip or a live viewer can start at any keyframe
+        encoder = H264Encoder(bitrate=bitrate, repeat=True, iperiod=iperiod)
+        self.picam2.start_encoder(encoder, output, name=stream)
+        return encoder
+
+    def stop_encoder(self, encoder):
+        self.picam2.stop_encoder(encoder)
+
+    def close(self):
+        if self.picam2 is not None:
+            self.picam2.close()
+            self.picam2 = None
+
+
+class SyntheticScene:
+    """Frames for the simulated camera: a fixed textured background, plus a bright square
+    walking across it while motion is on. Every stream size is drawn from the same scene.
+    """
+
+    def __init__(self, seed=0):
+        self.motion = False
+        self._seed = seed
+        self._backgrounds = {}
+        self._motion_started = 0.0
+
+    def set_motion(self, active):
+        if active and not self.motion:
+            self._motion_started = time.monotonic()
+        self.motion = active
+
+    def yuv420(self, size, now):
+        width, height = size
+        background = self._backgrounds.get(size)
+        if background is None:
+            import numpy as np
+            rng = np.random.default_rng(self._seed)
+            background = np.full((height * 3 // 2, width), 128, dtype=np.uint8)
+            background[:height] = rng.integers(60, 120, size=(height, width), dtype=np.uint8)
+            self._backgrounds[size] = background
+        frame = background.copy()
+        if self.motion:
+            side = max(8, min(width, height) // 6)
+            x = int((now - self._motion_started) * width / 2) % max(1, width - side)
+            y = height // 2 - side // 2
+            frame[y:y + side, x:x + side] = 230
+        return frame
+
+
+class _FileFrames:
+    # Decodes a video file in a loop, as YUV420 buffers of one size
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._frames = None
+        self._container = None
+
+    def next(self):
+        for _ in range(2):
+            if self._frames is None:
+                import av
+                self._container = av.open(self.path)
+                self._frames = self._container.decode(video=0)
+            for frame in self._frames:
+                width, height = self.size
+                return frame.reformat(width=width, height=height, format="yuv420p").to_ndarray()
+            self._container.close() # End of file, start over
+            self._frames = None
+        raise RuntimeError(f"No video frames in {self.path}")
+
+    def close(self):
+        if self._container is not None:
+            self._container.close()
+
+
+class _SimulatedLoresFrame:
+    def __init__(self, array, size):
+        self.array = array
+        self._size = size
+
+    def save_jpeg(self, stream):
+        # Only used without simplejpeg; the luma plane is enough for a test picture
+        from PIL import Image
+        width, height = self._size
+        Image.frombytes("L", (width, height), self.array[:height].tobytes()).save(stream, format="jpeg")
+
+    def release(self):
+        pass
+
+
+class _SimulatedEncoder:
+    # Encodes the simulated stream with libx264 in its own thread, paced to the frame rate
+    def __init__(self, backend, output, bitrate, iperiod, size):
+        import av
+        self.backend = backend
+        self.output = output
+        self.size = size
+        self.codec = av.CodecContext.create("libx264", "w")
+        self.codec.width, self.codec.height = size
+        self.codec.pix_fmt = "yuv420p"
+        self.codec.bit_rate = bitrate
+        self.codec.framerate = Fraction(backend.framerate)
+        self.codec.time_base = Fraction(1, 1_000_000)
+        self.codec.options = {"preset": "ultrafast", "tune": "zerolatency",
+                              "x264-params": f"keyint={iperiod}:repeat-headers=1"}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sim-encoder", daemon=True)
+
+    def start(self):
+        self.output.start()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.output.stop()
+
+    def _run(self):
+        import av
+        frame_source = self.backend.frame_source(self.size)
+        try:
+            while not self._stop.is_set():
+                now = self.backend.wait_for_frame()
+                frame = av.VideoFrame.from_ndarray(frame_source(now), format="yuv420p")
+                frame.pts = int(now * 1_000_000)
+                for packet in self.codec.encode(frame):
+                    self.output.outputframe(bytes(packet), packet.is_keyframe, packet.pts)
+        except Exception as e:
+            print(f"Simulated encoder stopped: {e}")
+
+
+class SimulatedBackend:
+    """Camera replacement for running and benchmarking off the Pi.
+
+    Frames come at the configured rate from a synthetic scene (set_motion()
+    starts and stops a moving object) or, with source_file, from a video
+    file played in a loop. start_encoder() runs a libx264 encoder per
+    output at the requested bitrate and keyframe interval, with repeated
+    headers and microsecond timestamps like the Pi's hardware encoder.
+    """
+
+    name = "simulated"
+
+    def __init__(self, main_size, lores_size, framerate=30, source_file=None):
+        self.main_size = main_size
+        self.lores_size = lores_size
+        self.framerate = framerate
+        self.source_file = source_file
+        self.scene = SyntheticScene()
+        self._started_at = None
+        self._lores_source = None
+        self._file_frames = []
+
+    def start(self):
+        self._started_at = time.monotonic()
+        print(f"Simulated camera started ({self.framerate} fps, source: {self.source_file or 'synthetic'}).")
+
+    def set_motion(self, active):
+        self.scene.set_motion(active)
+
+    def start_autofocus(self):
+        pass
+
+    def autofocus_state(self):
+        return None # Fixed focus
+
+    def wait_for_frame(self):
+        # Blocks until the next frame time, like a camera delivering frames at a fixed rate
+        interval = 1.0 / self.framerate
+        now = time.monotonic()
+        index = int((now - self._started_at) / interval) + 1
+        due = self._started_at + index * interval
+        time.sleep(max(0.0, due - now))
+        return due
+
+    def frame_source(self, size):
+        # Callable returning the YUV420 frame at a given time, one per consumer (file readers keep a position)
+        if self.source_file:
+            frames = _FileFrames(self.source_file, size)
+            self._file_frames.append(frames)
+            return lambda now: frames.next()
+        return lambda now: self.scene.yuv420(size, now)
+
+    def capture_lores(self):
+        if self._lores_source is None:
+            self._lores_source = self.frame_source(self.lores_size)
+        return _SimulatedLoresFrame(self._lores_source(self.wait_for_frame()), self.lores_size)
+
+    def start_encoder(self, output, bitrate, iperiod, stream="main"):
+        encoder = _SimulatedEncoder(self, output, bitrate, iperiod,
+                                    self.main_size if stream == "main" else self.lores_size)
+        encoder.start()
+        return encoder
+
+    def stop_encoder(self, encoder):
+        encoder.stop()
+
+    def close(self):
+        for frames in self._file_frames:
+            frames.close()
+        self._file_frames = []
+        self._lores_source = None
+
+
+def create_backend(name, main_size, lores_size, framerate=30, source_file=None):
+    if name == "picamera2":
+        return Picamera2Backend(main_size, lores_size)
+    if name == "simulated":
+        return SimulatedBackend(main_size, lores_size, framerate, source_file)
+    raise ValueError(f"Unknown camera backend: {name}")
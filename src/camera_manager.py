@@ -2,14 +2,25 @@ import os
 import time
 import threading
 import io
-import subprocess # For calling ffmpeg
+import collections
 from datetime import datetime
-from picamera2 import Picamera2
-from picamera2.encoders import H264Encoder
-from picamera2.outputs import FileOutput
-from libcamera import controls, Transform # Import Transform if you use it for flipping
 from telegram_handler import notiManager
-from myEventDataBase import record_new_video_event
+from frame_broadcaster import FrameBroadcaster
+from adaptive_stream import AdaptiveViewer, quality_ladder, downscale_for_width, pick_variant
+from preroll_output import PrerollOutput
+from segment_recorder import SegmentOutput
+from live_h264 import LiveH264Output, H264FileFeed
+from postprocess import PostProcessor
+from event_jobs import EventJobs, POSTPROCESS_MAX_PENDING
+from mp4_muxer import Mp4Muxer, save_keyframe_thumbnail
+from event_activity import ACTIVITY_SAMPLE_FPS
+from camera_backend import create_backend
+import metrics
+from metrics import stage_timer, STREAM_FRAMES
+from startup import STARTUP, STARTING, READY, FAILED, DISABLED
+from retention import RetentionManager, STORAGE_MAX_BYTES, STORAGE_MIN_FREE_BYTES
+from worker_process import WorkerSupervisor, WORKER_PROCESS
+import config
 from config import (
     CAMERA_MAIN_RESOLUTION,
     CAMERA_LORES_RESOLUTION,
@@ -21,143 +32,526 @@ from config import (
 # --- Ensure base directories exist ---
 VIDEO_FILES_DIR = os.path.join(EVENTS_STORAGE_DIR, VIDEOS_SUBDIR_NAME)
 THUMBNAIL_FILES_DIR = os.path.join(EVENTS_STORAGE_DIR, THUMBNAILS_SUBDIR_NAME)
+SEGMENT_FILES_DIR = os.path.join(EVENTS_STORAGE_DIR, getattr(config, "SEGMENTS_SUBDIR_NAME", "segments"))
 # ---
 
-def generate_thumbnail(mp4_filepath, output_dir=THUMBNAIL_FILES_DIR, seek_time="00:00:01", width=320):
-    
-    #Generates a thumbnail from an MP4 video file using ffmpeg.    
-    if not os.path.exists(mp4_filepath):
-        print(f"Error generating thumbnail: Video file not found at {mp4_filepath}")
-        return None
-
-    base_filename = os.path.basename(mp4_filepath)
-    thumbnail_filename = os.path.splitext(base_filename)[0] + "_thumb.jpg"
-    thumbnail_fullpath = os.path.join(output_dir, thumbnail_filename)
-
-    os.makedirs(output_dir, exist_ok=True)
-
-    command = [
-        'ffmpeg', '-y', # Overwrite output files without asking
-        '-i', mp4_filepath,
-        '-ss', seek_time,
-        '-vframes', '1',
-        '-vf', f'scale={width}:-1', # Scale to width, maintain aspect ratio
-        thumbnail_fullpath
-    ]
-    try:
-        print(f"Generating thumbnail: {' '.join(command)}")
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
-        if result.returncode == 0:
-            print(f"Thumbnail generated successfully: {thumbnail_fullpath}")
-            return thumbnail_fullpath
-        else:
-            print(f"Error generating thumbnail for {mp4_filepath}.")
-            print(f"FFmpeg stdout: {result.stdout.decode(errors='ignore')}")
-            print(f"FFmpeg stderr: {result.stderr.decode(errors='ignore')}")
-            return None   
-    except Exception as e:
-        print(f"An unexpected error occurred during thumbnail generation: {e}")
-        return None
+# Optional settings, older config.py files may not define them
+STREAM_FPS = getattr(config, "STREAM_FPS", 20) # Target frame rate of the shared MJPEG capture thread
+STREAM_JPEG_QUALITY = getattr(config, "STREAM_JPEG_QUALITY", 75)
+STREAM_MAX_VIEWERS = getattr(config, "STREAM_MAX_VIEWERS", 4)            # Concurrent /video_feed clients, more get a 503
+STREAM_MAX_LAG_SECONDS = getattr(config, "STREAM_MAX_LAG_SECONDS", 3.0)  # Drop a viewer when sending one frame takes longer
+STREAM_LATENCY_TARGET = getattr(config, "STREAM_LATENCY_TARGET", 0.5)    # Seconds from capture to client, per viewer
+STREAM_MIN_FPS = getattr(config, "STREAM_MIN_FPS", 2)                     # Adaptive pacing never goes below this
+STREAM_QUALITY_TIERS = getattr(config, "STREAM_QUALITY_TIERS", (75, 60, 45, 30)) # JPEG qualities viewers step through
+STREAM_DOWNSCALES = getattr(config, "STREAM_DOWNSCALES", (1, 2, 4))      # Lores widths offered for ?w= (full, 1/2, 1/4)
+STREAM_MAX_VARIANTS = getattr(config, "STREAM_MAX_VARIANTS", 4)           # Encodes per captured frame, the rest share the closest
+RECORD_BITRATE = getattr(config, "RECORD_BITRATE", 2_000_000)       # bits/s of the always-on H.264 encoder
+RECORD_FRAMERATE = getattr(config, "RECORD_FRAMERATE", 30)          # Used for the keyframe interval (1 per second)
+RECORD_PREROLL_SECONDS = getattr(config, "RECORD_PREROLL_SECONDS", 3) # Seconds kept from before the trigger
+RECORD_HOLD_SECONDS = getattr(config, "RECORD_HOLD_SECONDS", 5)     # Keep recording until motion is gone this long
+RECORD_MAX_SECONDS = getattr(config, "RECORD_MAX_SECONDS", 60)      # Hard cap on one event's length
+# Memory cap for the pre-roll buffer, twice the nominal size to absorb bitrate spikes
+RECORD_PREROLL_MAX_BYTES = getattr(config, "RECORD_PREROLL_MAX_BYTES",
+                                   2 * RECORD_BITRATE // 8 * (RECORD_PREROLL_SECONDS + 1))
+# Continuous recording: the encoder writes fixed-length MP4 segments all the time, and motion events
+# point into them instead of getting their own clip
+CONTINUOUS_RECORDING = getattr(config, "CONTINUOUS_RECORDING", False)
+SEGMENT_SECONDS = getattr(config, "SEGMENT_SECONDS", 120) # Segment length, cut at the next keyframe
+# Low-bandwidth live view: H.264 from the hardware encoder on the lores stream, as fragmented MP4
+LIVE_H264_BITRATE = getattr(config, "LIVE_H264_BITRATE", 400_000)
+LIVE_H264_KEYFRAME_INTERVAL = getattr(config, "LIVE_H264_KEYFRAME_INTERVAL", RECORD_FRAMERATE) # Frames, also the join delay
+LIVE_H264_RING_SECONDS = getattr(config, "LIVE_H264_RING_SECONDS", 3)
+LIVE_H264_SOURCE_FILE = getattr(config, "LIVE_H264_SOURCE_FILE", None) # Raw .h264 replayed instead of the encoder (off-device testing)
+# "picamera2", or "simulated" to run without a camera (synthetic scene, or SIM_CAMERA_SOURCE_FILE in a loop)
+CAMERA_BACKEND = getattr(config, "CAMERA_BACKEND", "picamera2")
+SIM_CAMERA_FPS = getattr(config, "SIM_CAMERA_FPS", RECORD_FRAMERATE)
+SIM_CAMERA_SOURCE_FILE = getattr(config, "SIM_CAMERA_SOURCE_FILE", None) # Any video file PyAV can decode
+# Software motion detection on lores frames: "off", "confirm" (PIR triggers must be confirmed) or "standalone"
+MOTION_DETECTOR_MODE = getattr(config, "MOTION_DETECTOR_MODE", "off")
+MOTION_DETECTOR_FPS = getattr(config, "MOTION_DETECTOR_FPS", 5)
+MOTION_DETECTOR_DOWNSCALE = getattr(config, "MOTION_DETECTOR_DOWNSCALE", 4)   # Use every Nth pixel/row
+MOTION_DETECTOR_THRESHOLD = getattr(config, "MOTION_DETECTOR_THRESHOLD", 25)  # Luma difference per pixel
+MOTION_DETECTOR_MIN_AREA = getattr(config, "MOTION_DETECTOR_MIN_AREA", 0.01)  # Fraction of the ROI
+MOTION_DETECTOR_ROI = getattr(config, "MOTION_DETECTOR_ROI", None)            # [(x0, y0, x1, y1), ...] in 0..1
+AUTOFOCUS_TIMEOUT = getattr(config, "AUTOFOCUS_TIMEOUT", 5.0) # Give up waiting for the lens after this long (seconds)
+
+_simplejpeg = None # simplejpeg (fast YUV420 -> JPEG), imported with the first frame since it pulls in numpy
+
+def load_simplejpeg():
+    """Returns the simplejpeg module, or False when it is not installed."""
+    global _simplejpeg
+    if _simplejpeg is None:
+        try:
+            import simplejpeg
+            _simplejpeg = simplejpeg
+        except ImportError:
+            _simplejpeg = False
+    return _simplejpeg
+
+def encode_yuv420_jpeg(yuv, size, quality=STREAM_JPEG_QUALITY, downscale=1):
+    # Encodes a YUV420 buffer (as returned for the lores stream) straight to JPEG.
+    # The planes are numpy views into the buffer, nothing is copied or colour converted.
+    width, height = size
+    y_plane = yuv[:height, :width]
+    # U and V are half width, so viewing the buffer at half stride puts one chroma row per row
+    chroma = yuv.reshape((yuv.shape[0] * 2, yuv.strides[0] // 2))
+    u_plane = chroma[2 * height: 2 * height + height // 2, :width // 2]
+    v_plane = chroma[2 * height + height // 2: 3 * height, :width // 2]
+    if downscale > 1:
+        # Smaller variants skip pixels; the copies are only 1/downscale^2 of the frame
+        u_plane = u_plane[::downscale, ::downscale].copy()
+        v_plane = v_plane[::downscale, ::downscale].copy()
+        y_plane = y_plane[::downscale, ::downscale][:2 * u_plane.shape[0], :2 * u_plane.shape[1]].copy()
+    return load_simplejpeg().encode_jpeg_yuv_planes(y_plane, u_plane, v_plane, quality=quality, fastdct=True)
+
+
+# What the capture thread publishes: capture time and the JPEG of every variant viewers asked for,
+# keyed by (quality, downscale)
+LiveFrame = collections.namedtuple("LiveFrame", "captured_at jpegs")
 
 
 class CameraManager:
-    def __init__(self):
-        self.picam2 = None
-        self.camera_lock = threading.Lock()        
+    def __init__(self, backend=None):
+        # backend: a camera backend (see camera_backend.py), by default the one named by CAMERA_BACKEND.
+        # self.camera is the backend once it is started.
+        self.backend = backend or create_backend(CAMERA_BACKEND, CAMERA_MAIN_RESOLUTION, CAMERA_LORES_RESOLUTION,
+                                                 SIM_CAMERA_FPS, SIM_CAMERA_SOURCE_FILE)
+        self.camera = None
+        self.camera_lock = metrics.TimedLock(metrics.CAMERA_LOCK_WAIT)
+        self.record_lock = threading.Lock() # Only one motion recording at a time
+        self.encoder = None
+        self.preroll = None
+        self.segments = None # SegmentOutput, in place of the pre-roll buffer with CONTINUOUS_RECORDING
         self.stream_active = False
         self.stream_event = threading.Event()
         self.noti = notiManager() # Initialize your notification manager
-        #self.jpeg_quality = 90  # Default JPEG quality for streams/snapshots from lores                                     
+
+        # One capture thread feeds every /video_feed client through this slot
+        self.frames = FrameBroadcaster()
+        self._capture_thread = None
+        self._viewers = 0
+        self._viewers_lock = threading.Lock()
+        self._adaptive_viewers = set() # AdaptiveViewer of every connected client, read by the capture thread
+        self._viewer_slots = threading.BoundedSemaphore(STREAM_MAX_VIEWERS)
+        self.viewers_rejected = 0
+        self.viewers_evicted = 0
+        self.jpeg_quality = STREAM_JPEG_QUALITY  # JPEG quality for streams/snapshots from lores
+
+        # H.264 live view: one encoder session shared by all its viewers, started for the first
+        # and stopped after the last
+        self.live_h264 = LiveH264Output(CAMERA_LORES_RESOLUTION, RECORD_FRAMERATE, LIVE_H264_RING_SECONDS)
+        self._live_h264_source = None # Encoder handle of the camera backend, or H264FileFeed with LIVE_H264_SOURCE_FILE
+        self._live_h264_viewers = 0
+        self._live_h264_lock = threading.Lock()
+
+        # Optional image based motion detection on the same lores frames
+        self.motion_detector = None
+        self.motion_detector_mode = MOTION_DETECTOR_MODE
+        self.detector_active = False
+        self.motion_trigger = None # MotionTrigger, set up by motion_logic.check_for_motion
+        self.autofocus_state = None # Last result of the autofocus scan, see _run_autofocus
+        self.activity = None # ActivityTracker of the event being recorded, fed by the capture thread
+        if MOTION_DETECTOR_MODE in ("confirm", "standalone"):
+            from motion_detector import MotionDetector # Only imported when used, it needs numpy
+            self.motion_detector = MotionDetector(
+                downscale=MOTION_DETECTOR_DOWNSCALE,
+                threshold=MOTION_DETECTOR_THRESHOLD,
+                min_area=MOTION_DETECTOR_MIN_AREA,
+                roi=MOTION_DETECTOR_ROI,
+            )
+
+        # Everything after the file is closed runs here, off the motion thread. By default the
+        # stages and the retention manager run in a separate, lower-priority worker process
+        # (worker_process.py) and this process only queues jobs; self.retention is then a
+        # stand-in that forwards file_added() to the worker and reports its stats.
+        if WORKER_PROCESS:
+            self.worker = WorkerSupervisor(latency=self.frame_delivery_latency)
+            self.retention = self.worker.retention
+        else:
+            self.worker = None
+            # Evicts the oldest events when storage runs low, started from stream.py
+            self.retention = RetentionManager(EVENTS_STORAGE_DIR, max_bytes=STORAGE_MAX_BYTES,
+                                              min_free_bytes=STORAGE_MIN_FREE_BYTES)
+        self.postprocessor = PostProcessor(max_pending=POSTPROCESS_MAX_PENDING,
+                                           on_submit=self.worker.wake if self.worker is not None else None)
+        EventJobs(self.noti, self.retention.file_added).register(self.postprocessor)
+        self._register_metrics()
+
+    def _register_metrics(self):
+        # Read only when /metrics is scraped
+        metrics.gauge_callback("pizero_stream_viewers", "Connected live-view clients.",
+                               lambda: {("mjpeg",): self._viewers, ("h264",): self._live_h264_viewers},
+                               labels=("stream",))
+        metrics.counter_callback("pizero_stream_viewers_rejected_total", "Viewers turned away at the viewer cap.",
+                                 lambda: self.viewers_rejected)
+        metrics.counter_callback("pizero_stream_viewers_evicted_total", "Viewers dropped for falling behind.",
+                                 lambda: self.viewers_evicted)
+        metrics.gauge_callback("pizero_preroll_buffer_bytes", "H.264 held in the pre-roll buffer.",
+                               lambda: self.preroll.stats()["bytes"] if self.preroll is not None else None)
+        metrics.counter_callback("pizero_segments_written_total", "Continuous recording segments finished.",
+                                 lambda: self.segments.segments_written if self.segments is not None else None)
+        metrics.gauge_callback("pizero_live_h264_buffer_bytes", "Fragments held for H.264 live viewers.",
+                               lambda: self.live_h264.stats()["buffered_bytes"])
+        metrics.gauge_callback("pizero_postprocess_queue_depth", "Post-processing jobs per stage and state.",
+                               self.postprocessor.queue_depth, labels=("stage", "state"))
 
     def setup_camera(self):
         with self.camera_lock:
-            if self.picam2 is None:
-                print("Initializing camera...")
-                self.picam2 = Picamera2()               
-
-                # Configuration for main (recording) and lores (MJPEG stream)
-                video_config = self.picam2.create_video_configuration(
-                    main={"size": CAMERA_MAIN_RESOLUTION, "format": "XRGB8888"}, # XRGB8888 for H.264 encoder
-                    lores={"size": CAMERA_LORES_RESOLUTION, "format": "YUV420"}  # YUV420 is good for MJPEG
-                )
-                self.picam2.configure(video_config)                
-                self.picam2.start() # Start the camera
-                print("Picamera2 started.")
-
-                # Attempt autofocus for IMX708
-                try:       
-                    self.picam2.set_controls({"AfMode": controls.AfModeEnum.Auto, "AfTrigger": controls.AfTriggerEnum.Start})
-                    
-                    # Allow some time for continuous AF to settle, or after triggering Auto.
-                    time.sleep(2) 
-                    print("Autofocus mode set/triggered.")
-                except Exception as af_e:
-                    print(f"Could not set autofocus (ensure camera supports it & libcamera is up to date): {af_e}")
+            if self.camera is None:
+                print(f"Initializing camera ({self.backend.name})...")
+                STARTUP.set("camera", STARTING, self.backend.name)
+                try:
+                    self.backend.start()
+                except Exception as e:
+                    print(f"Could not start the camera: {e}")
+                    STARTUP.set("camera", FAILED, str(e))
+                    return None
+                self.camera = self.backend
+
+                # Always-on encoder feeding the pre-roll ring buffer, or the segment files in continuous
+                # mode. Keyframe every second with repeated headers so a clip or a seek can start at any
+                # keyframe.
+                try:
+                    if CONTINUOUS_RECORDING:
+                        self.segments = SegmentOutput(SEGMENT_FILES_DIR, CAMERA_MAIN_RESOLUTION, RECORD_FRAMERATE,
+                                                      SEGMENT_SECONDS, on_segment_closed=self.retention.file_added)
+                        self.encoder = self.camera.start_encoder(self.segments, RECORD_BITRATE, RECORD_FRAMERATE)
+                        print(f"Continuous recording started ({SEGMENT_SECONDS}s segments in {SEGMENT_FILES_DIR}).")
+                    else:
+                        self.preroll = PrerollOutput(RECORD_PREROLL_SECONDS, RECORD_PREROLL_MAX_BYTES)
+                        self.encoder = self.camera.start_encoder(self.preroll, RECORD_BITRATE, RECORD_FRAMERATE)
+                        print(f"Pre-roll encoder started ({RECORD_PREROLL_SECONDS}s, max {RECORD_PREROLL_MAX_BYTES} bytes).")
+                    STARTUP.set("recording", READY, "continuous" if CONTINUOUS_RECORDING else "pre-roll")
+                except Exception as enc_e:
+                    print(f"Could not start the recording encoder: {enc_e}")
+                    STARTUP.set("recording", FAILED, str(enc_e))
+                    self.encoder = None
+                    self.preroll = None
+                    self.segments = None
 
+                # Frames already flow while the lens settles, so focus is waited for in the background
+                threading.Thread(target=self._run_autofocus, name="autofocus", daemon=True).start()
+
+                STARTUP.set("camera", READY, self.backend.name)
+                STARTUP.milestone("camera_ready")
                 print("Camera initialized and setup complete.")
             else:
                 print("Camera already initialized.")
-        return self.picam2
+        return self.camera
+
+    def _run_autofocus(self):
+        # Triggers one autofocus scan and polls AfState frame by frame until it settles or times out
+        STARTUP.set("autofocus", STARTING)
+        started = time.monotonic()
+        try:
+            self.camera.start_autofocus()
+            state = self.camera.autofocus_state()
+            while state == "scanning" and time.monotonic() - started < AUTOFOCUS_TIMEOUT:
+                state = self.camera.autofocus_state() # Waits for the next frame's metadata
+            if state == "scanning":
+                state = "timeout"
+        except Exception as af_e:
+            print(f"Could not set autofocus (ensure camera supports it & libcamera is up to date): {af_e}")
+            state = None
+        self.autofocus_state = state
+        if state is None:
+            STARTUP.set("autofocus", DISABLED, "no autofocus")
+            return
+        STARTUP.set("autofocus", READY if state == "focused" else FAILED, state)
+        STARTUP.milestone("autofocus_done")
+        print(f"Autofocus {state} after {time.monotonic() - started:.2f}s.")
+
+    def get_preroll_stats(self):
+        if self.preroll is None:
+            return None
+        return self.preroll.stats()
 
-    def record_motion_video(self):
-        if self.picam2 is None:
+    def _wait_for_motion_end(self, motion_active, on_tick=None):
+        # Returns once motion_active() has been False for RECORD_HOLD_SECONDS, or after RECORD_MAX_SECONDS.
+        # on_tick(seconds since start) is called on every check.
+        started = last_motion = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if on_tick is not None:
+                on_tick(now - started)
+            if motion_active is not None and motion_active():
+                last_motion = now
+            if now - last_motion >= RECORD_HOLD_SECONDS:
+                break
+            if now - started >= RECORD_MAX_SECONDS:
+                print(f"Recording reached the {RECORD_MAX_SECONDS}s limit.")
+                break
+            time.sleep(0.2)
+
+    def record_motion_video(self, motion_active=None, on_started=None):
+        # motion_active: optional callable returning True while motion is still present.
+        # Recording continues until it has been False for RECORD_HOLD_SECONDS (or RECORD_MAX_SECONDS).
+        # on_started: optional callable, called as soon as frames are going into the file.
+        # Returns the MP4 path, or with continuous recording the (clip_start, clip_end) range of the event.
+        if self.camera is None:
             print("Camera not set up. Attempting setup...")
             if self.setup_camera() is None:
                 print("Failed to setup camera for recording.")
                 return None
+        if self.segments is not None:
+            return self._record_motion_range(motion_active, on_started)
+        if self.preroll is None:
+            print("Pre-roll encoder not running. Cannot record.")
+            return None
         
-        current_time_for_filename = datetime.now().strftime("%Y%m%d_%H%M%S") # More sortable format       
-        h264_filename = f"event_{current_time_for_filename}.h264"
-        h264_full_path = os.path.join(VIDEO_FILES_DIR, h264_filename)
-        mp4_full_path = None
-        generated_thumbnail_path = None
+        event_time = time.time()
+        current_time_for_filename = datetime.fromtimestamp(event_time).strftime("%Y%m%d_%H%M%S") # More sortable format       
+        mp4_filename = f"event_{current_time_for_filename}.mp4"
+        mp4_full_path = os.path.join(VIDEO_FILES_DIR, mp4_filename)
+        thumbnail_full_path = os.path.join(THUMBNAIL_FILES_DIR, f"event_{current_time_for_filename}_thumb.jpg")
         
         # Ensure the target directory exists
         os.makedirs(VIDEO_FILES_DIR, exist_ok=True)
         
-        #print(f"Motion detected! Recording video to {h264_full_path}...")
-        
-        with self.camera_lock: # Ensure exclusive camera access for recording configuration
+        with self.record_lock: # The encoder keeps running, so the camera itself is not locked
+            print(f"Pre-roll buffer: {self.preroll.stats()}")
             try:
-                
-                encoder = H264Encoder()
-                output = FileOutput(h264_full_path)
-                self.picam2.start_encoder(encoder, output)
-                print(f"Recording started: {h264_full_path}")
-                time.sleep(10) # Record for the specified duration
-                self.picam2.stop_encoder()
-                print(f"Recording stopped: {h264_full_path}")
+                # Encoded frames are muxed straight into the MP4, there is no .h264 file anymore
+                muxer = Mp4Muxer(mp4_full_path, CAMERA_MAIN_RESOLUTION, RECORD_FRAMERATE)
             except Exception as e:
-                print(f"Recording stopped: {h264_full_path}")
+                print(f"Could not open {mp4_full_path} for recording: {e}")
+                return None
+            with stage_timer("record_start"): # Pre-roll flushed into the file
+                started_ok = self.preroll.start_recording(muxer)
+            live_at = time.time()
+            if not started_ok:
+                muxer.close()
+                return None
+            # Only once the clip is going, an early return must not leave the capture thread sampling for nobody
+            tracker = self._start_activity(event_time)
+            print(f"Recording started: {mp4_full_path}")
+            if on_started is not None:
+                on_started()
+            try:
+                self._wait_for_motion_end(motion_active)
+            except Exception as e:
+                print(f"Error while recording {mp4_full_path}: {e}")
+            finally:
+                self.activity = None
+                with stage_timer("record_finalize"):
+                    self.preroll.stop_recording()
+                print(f"Recording stopped: {mp4_full_path} ({muxer.frames_written} frames, {muxer.duration:.1f}s)")
 
-        # --- Post-recording processing ---
-        self.noti.send_telegram_message(f"Motion! Video recorded: {h264_filename}")
-        
-        # Convert to MP4
-        mp4_full_path = self.noti.convert_video_to_mp4(h264_full_path) # This should return the full path of the MP4
-        
-        if mp4_full_path and os.path.exists(mp4_full_path):
-            self.noti.send_telegram_video(mp4_full_path)
-
-            # Generate Thumbnail
-            generated_thumbnail_path = generate_thumbnail(mp4_full_path)
-
-            # Record event to database
-            try:                      
-                record_new_video_event(
-                    event_type="Motion Detected",
-                    h264_path=h264_full_path, # Store full path
-                    mp4_path=mp4_full_path,   # Store full path
-                    thumbnail_path=generated_thumbnail_path, # Store full path                    
-                    notes_str=f"Motion at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-                )
-            except Exception as db_e:
-                print(f"Error recording event to database: {db_e}")
-        else:
-            print(f"MP4 conversion failed or file not found for {h264_full_path}.")           
+        if muxer.frames_written == 0:
+            print(f"No frames were recorded for {mp4_full_path}, discarding it.")
+            os.remove(mp4_full_path)
+            return None
+
+        # The lores frame with the most motion, or decoded from the keyframe kept by the muxer;
+        # either way the file is not read again
+        with stage_timer("thumbnail"):
+            thumbnail_path = tracker.save_thumbnail(thumbnail_full_path) if tracker is not None else None
+            if thumbnail_path is None:
+                thumbnail_path = save_keyframe_thumbnail(muxer.thumbnail_keyframe, thumbnail_full_path)
+        self.retention.file_added(mp4_full_path, thumbnail_path)
+        # The clip starts with the pre-roll, that far back from when live frames started going in
+        activity = self._finish_activity(tracker, current_time_for_filename, live_at - muxer.preroll_seconds)
+
+        # --- Post-recording processing happens in the background ---
+        queued = self.postprocessor.submit(mp4_filename, ("notify", "upload", "record"), {
+            "h264_path": None,
+            "mp4_path": mp4_full_path,
+            "thumbnail_path": thumbnail_path,
+            "event_ts": event_time,
+            "notes": f"Motion at {datetime.fromtimestamp(event_time).strftime('%Y-%m-%d %H:%M:%S')}",
+            **activity,
+        })
+        if not queued:
+            print(f"Motion event {mp4_filename} will be listed but not sent to Telegram (post-processing backlog).")
+        return mp4_full_path
+
+    def _record_motion_range(self, motion_active, on_started):
+        # Continuous mode: the footage is already going into the segments, the event only
+        # records which part of them it covers (pre-roll included)
+        event_time = time.time()
+        clip_start = event_time - RECORD_PREROLL_SECONDS
+        stamp = datetime.fromtimestamp(event_time).strftime("%Y%m%d_%H%M%S")
+        thumbnail_keyframe = []
+        def take_thumbnail(elapsed):
+            # Same choice as the clip muxer: a keyframe about a second after the trigger
+            if not thumbnail_keyframe and elapsed >= 1.0 and self.segments.latest_keyframe:
+                thumbnail_keyframe.append(self.segments.latest_keyframe)
+
+        with self.record_lock:
+            print(f"Motion event started, footage from {datetime.fromtimestamp(clip_start):%H:%M:%S} on.")
+            tracker = self._start_activity(event_time)
+            if on_started is not None:
+                on_started()
+            try:
+                self._wait_for_motion_end(motion_active, on_tick=take_thumbnail)
+            except Exception as e:
+                print(f"Error while following motion event {stamp}: {e}")
+            finally:
+                self.activity = None
+        clip_end = time.time()
+
+        thumbnail_path = None
+        thumbnail_full_path = os.path.join(THUMBNAIL_FILES_DIR, f"event_{stamp}_thumb.jpg")
+        keyframe = thumbnail_keyframe[0] if thumbnail_keyframe else self.segments.latest_keyframe
+        with stage_timer("thumbnail"):
+            thumbnail_path = tracker.save_thumbnail(thumbnail_full_path) if tracker is not None else None
+            if thumbnail_path is None and keyframe:
+                thumbnail_path = save_keyframe_thumbnail(keyframe, thumbnail_full_path)
+        self.retention.file_added(thumbnail_path)
+        # Playback of the range starts at clip_start (at the keyframe before it, to be exact)
+        activity = self._finish_activity(tracker, stamp, clip_start)
+
+        queued = self.postprocessor.submit(f"event_{stamp}", ("notify", "record"), {
+            "h264_path": None,
+            "mp4_path": None,
+            "clip_start": clip_start,
+            "clip_end": clip_end,
+            "thumbnail_path": thumbnail_path,
+            "event_ts": event_time,
+            "notes": f"Motion at {datetime.fromtimestamp(event_time).strftime('%Y-%m-%d %H:%M:%S')}",
+            **activity,
+        })
+        if not queued:
+            print(f"Motion event event_{stamp} will be listed but not sent to Telegram (post-processing backlog).")
+        return clip_start, clip_end
+
+    def _start_activity(self, started_at):
+        # Has the capture thread sample lores frames for the event from now on; None without numpy
+        try:
+            from event_activity import ActivityTracker
+            tracker = ActivityTracker(CAMERA_LORES_RESOLUTION, started_at)
+        except ImportError as e:
+            print(f"Event activity disabled: {e}")
+            return None
+        self.activity = tracker
+        self._ensure_capture_thread()
+        return tracker
+
+    def _finish_activity(self, tracker, stamp, video_start):
+        # Sprite strip and activity columns of a finished event, {} if no frame was sampled
+        if tracker is None or tracker.samples == 0:
+            return {}
+        with stage_timer("sprite"):
+            sprite_path, tile_times = tracker.save_sprite(os.path.join(THUMBNAIL_FILES_DIR, f"event_{stamp}_sprite.jpg"))
+        self.retention.file_added(sprite_path)
+        return {
+            "activity": tracker.summary(video_start, tile_times),
+            "sprite_path": sprite_path,
+            "activity_hash": tracker.activity_hash(),
+        }
+
+    def _capture_lores(self, variants, want_luma, activity=None):
+        # Captures one lores frame and uses it for the stream, the motion detector and/or the
+        # activity of the event being recorded. Returns {(quality, downscale): jpeg} for the requested variants.
+        with self.camera_lock, stage_timer("capture"):
+            frame = self.camera.capture_lores()
+        try:
+            jpegs = {}
+            if activity is not None:
+                with stage_timer("activity"):
+                    activity.add(frame.array, time.time())
+            if want_luma:
+                width, height = CAMERA_LORES_RESOLUTION
+                with stage_timer("motion_detect"):
+                    self.motion_detector.process(frame.array[:height, :width]) # Y plane view, no copy
+            if variants and load_simplejpeg():
+                # Zero-copy path: encode the mapped lores buffer directly, once per variant
+                for quality, downscale in variants:
+                    with stage_timer("jpeg_encode"):
+                        jpegs[(quality, downscale)] = encode_yuv420_jpeg(
+                            frame.array, CAMERA_LORES_RESOLUTION, quality, downscale)
+            if variants and not jpegs:
+                # Fallback without simplejpeg: converted through PIL, a single variant only
+                stream_buffer = io.BytesIO()
+                with stage_timer("jpeg_encode"):
+                    frame.save_jpeg(stream_buffer)
+                jpegs[(self.jpeg_quality, 1)] = stream_buffer.getvalue()
+            return jpegs
+        finally:
+            frame.release()
+
+    def _stream_demand(self):
+        # Variants the connected viewers want, most wanted first and capped at STREAM_MAX_VARIANTS,
+        # and the highest frame rate any of them wants
+        with self._viewers_lock:
+            viewers = list(self._adaptive_viewers)
+        if not viewers:
+            return [(self.jpeg_quality, 1)], STREAM_FPS
+        demand = collections.Counter(viewer.variant for viewer in viewers)
+        variants = [variant for variant, _ in demand.most_common(STREAM_MAX_VARIANTS)]
+        return variants, max(viewer.fps for viewer in viewers)
+
+    def _streaming(self):
+        return self.stream_active and not self.stream_event.is_set() and self._viewers > 0
+
+    def _capture_loop(self):
+        # Single producer: each lores frame is captured once for all viewers and the motion detector,
+        # and encoded once however many viewers there are.
+        print("Lores capture thread started.")
+        last_analysis = last_sample = 0.0
+        while True:
+            with self._viewers_lock:
+                streaming = self._streaming()
+                detecting = self.detector_active
+                tracker = self.activity
+                if not streaming and not detecting and tracker is None:
+                    # Under the lock _ensure_capture_thread holds: whoever registers after this starts a new thread
+                    self._capture_thread = None
+                    break
+            started = time.monotonic()
+            analyze = detecting and started - last_analysis >= 1.0 / MOTION_DETECTOR_FPS
+            if analyze:
+                last_analysis = started
+            sample = tracker is not None and started - last_sample >= 1.0 / ACTIVITY_SAMPLE_FPS
+            if sample:
+                last_sample = started
+            variants, stream_fps = self._stream_demand() if streaming else ([], 0)
+            try:
+                jpegs = self._capture_lores(variants, analyze, tracker if sample else None)
+            except Exception as e:
+                # Viewers stay connected and get frames again once the next capture works;
+                # only stop_stream() closes the broadcaster
+                print(f"Lores capture thread error: {e}")
+                time.sleep(1)
+                continue
+            if jpegs:
+                self.frames.publish(LiveFrame(started, jpegs))
+            # Capture only as fast as the fastest viewer (or the detector, or the recording event) needs
+            frame_interval = 1.0 / max(stream_fps, MOTION_DETECTOR_FPS if detecting else 0,
+                                       ACTIVITY_SAMPLE_FPS if tracker is not None else 0)
+            elapsed = time.monotonic() - started
+            if elapsed < frame_interval:
+                time.sleep(frame_interval - elapsed)
+        print("Lores capture thread stopped.")
+
+    def _ensure_capture_thread(self):
+        # Call after setting the flag that keeps the loop running (viewers, detector_active, activity)
+        with self._viewers_lock:
+            if self._capture_thread is None or not self._capture_thread.is_alive():
+                self._capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
+                self._capture_thread.start()
+
+    def start_motion_detector(self):
+        """Starts feeding lores frames to the software motion detector (if MOTION_DETECTOR_MODE is set)."""
+        if self.motion_detector is None:
+            return False
+        if self.camera is None and self.setup_camera() is None:
+            print("Motion detector: camera could not be initialized.")
+            return False
+        self.detector_active = True
+        self._ensure_capture_thread()
+        print(f"Software motion detector started (mode: {MOTION_DETECTOR_MODE}).")
+        return True
 
-    def generate_mjpeg_stream(self):
-        if self.picam2 is None:
+    def stop_motion_detector(self):
+        self.detector_active = False
+
+    def generate_mjpeg_stream(self, max_fps=None, max_quality=None, max_width=None,
+                              queued_bytes=None, on_dropped=None):
+        # max_fps / max_quality / max_width: client hints, ceilings for the adaptive pacing.
+        # queued_bytes: optional callable returning the bytes still unsent in the client's socket.
+        # on_dropped: called when the viewer is cut off (too far behind, or its write failed)
+        if self.camera is None:
             print("MJPEG Stream: Camera not ready. Attempting setup.")
             if self.setup_camera() is None:
                 error_message = b"Error: Camera could not be initialized for MJPEG stream."
@@ -170,38 +564,200 @@ class CameraManager:
             self.stream_active = True
             self.stream_event.clear()
 
-        print("MJPEG stream generation started (using lores stream).")
-        #frames_sent = 0
+        viewer = AdaptiveViewer(
+            max_fps=max(1.0, min(max_fps or STREAM_FPS, STREAM_FPS)),
+            qualities=quality_ladder(STREAM_QUALITY_TIERS, min(max_quality or self.jpeg_quality, self.jpeg_quality)),
+            downscale=downscale_for_width(CAMERA_LORES_RESOLUTION[0], max_width or CAMERA_LORES_RESOLUTION[0],
+                                          STREAM_DOWNSCALES),
+            target_latency=STREAM_LATENCY_TARGET,
+            min_fps=STREAM_MIN_FPS,
+        )
+        with self._viewers_lock:
+            self._viewers += 1
+            self._adaptive_viewers.add(viewer)
+            self.frames.open()
+        self._ensure_capture_thread()
+
+        print(f"MJPEG viewer connected ({self._viewers} watching, {viewer.stats()}).")
+        sent_counter = STREAM_FRAMES.labels("mjpeg", "sent")
+        skipped_counter = STREAM_FRAMES.labels("mjpeg", "skipped")
+        send_timer = metrics.STAGE_SECONDS.labels("stream_send")
+        bytes_written = 0
+        dropped = False
+        last_seq = self.frames.latest_seq
+        next_due = 0.0
         try:
             while self.stream_active and not self.stream_event.is_set():
-                stream_buffer = io.BytesIO()
-                with self.camera_lock: # Lock for capturing the frame
-                    # Capture from the 'lores' stream, which is YUV420.
-                    # capture_file will convert it to JPEG.                   
-                    self.picam2.capture_file(stream_buffer, format="jpeg")
-                
-                frame = stream_buffer.getvalue()
-                #stream_buffer.close()
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n'
-                       b'Content-Length: ' + f"{len(frame)}".encode() + b'\r\n'
-                       b'\r\n' + frame + b'\r\n')
-                 
-                #frames_sent += 1
-                time.sleep(0.05) # ~20 FPS target
+                # Paced to this viewer's own frame rate; frames published meanwhile are skipped
+                delay = next_due - time.monotonic()
+                if delay > 0 and self.stream_event.wait(delay):
+                    break
+                seq, live_frame = self.frames.wait_for_frame(last_seq)
+                if live_frame is None:
+                    if self.frames.closed:
+                        break
+                    continue # Timed out, re-check the stream state
+                if last_seq and seq > last_seq + 1:
+                    viewer.frames_skipped += seq - last_seq - 1 # Stale frames are dropped, never queued
+                    skipped_counter.inc(seq - last_seq - 1)
+                last_seq = seq
+                frame = pick_variant(live_frame.jpegs, viewer.variant)
+                viewer.frames_sent += 1
+                sent_counter.inc()
+                yield_started = time.monotonic()
+                next_due = yield_started + viewer.frame_interval
+                chunk = (b'--frame\r\n'
+                         b'Content-Type: image/jpeg\r\n'
+                         b'Content-Length: ' + f"{len(frame)}".encode() + b'\r\n'
+                         b'\r\n' + frame + b'\r\n')
+                yield chunk
+                STARTUP.milestone("first_frame")
+                # The server only asks for the next frame once this one is written to the socket,
+                # so the time spent away from here is how far the client has fallen behind.
+                now = time.monotonic()
+                send_time = now - yield_started
+                send_timer.observe(send_time)
+                bytes_written += len(chunk)
+                queued = queued_bytes() if queued_bytes is not None else 0
+                viewer.observe(now, live_frame.captured_at, bytes_written - queued, queued)
+                if send_time > STREAM_MAX_LAG_SECONDS:
+                    self.viewers_evicted += 1
+                    dropped = True
+                    print(f"MJPEG viewer evicted, a frame took {send_time:.1f}s to send.")
+                    break
+        except GeneratorExit:
+            dropped = True # Closed by the server while a frame was being written
+            raise
+        except Exception as e:
+            print(f"MJPEG stream generation stopped: {e}")
+        finally:
+            with self._viewers_lock:
+                self._viewers -= 1
+                self._adaptive_viewers.discard(viewer)
+            if dropped and on_dropped is not None:
+                on_dropped()
+            print(f"MJPEG viewer disconnected. Frames sent: {viewer.frames_sent}, skipped: {viewer.frames_skipped}, "
+                  f"last settings: {viewer.stats()}")
+
+    def start_live_h264(self):
+        """Registers an H.264 viewer, starting the shared encoder session for the first one."""
+        with self._live_h264_lock:
+            if self._live_h264_source is not None:
+                self._live_h264_viewers += 1
+                return True
+            self.live_h264.open_session()
+            try:
+                if LIVE_H264_SOURCE_FILE:
+                    source = H264FileFeed(LIVE_H264_SOURCE_FILE, self.live_h264, RECORD_FRAMERATE)
+                    source.start()
+                else:
+                    if self.camera is None and self.setup_camera() is None:
+                        raise RuntimeError("camera could not be initialized")
+                    source = self.camera.start_encoder(self.live_h264, LIVE_H264_BITRATE, LIVE_H264_KEYFRAME_INTERVAL,
+                                                       stream="lores")
+            except Exception as e:
+                print(f"Could not start the H.264 live view: {e}")
+                self.live_h264.close_session()
+                return False
+            self._live_h264_source = source
+            self._live_h264_viewers = 1
+            print(f"H.264 live view started ({LIVE_H264_BITRATE} bit/s).")
+            return True
+
+    def stop_live_h264(self):
+        with self._live_h264_lock:
+            self._live_h264_viewers -= 1
+            if self._live_h264_viewers > 0 or self._live_h264_source is None:
+                return
+            source = self._live_h264_source
+            self._live_h264_source = None
+            try:
+                if isinstance(source, H264FileFeed):
+                    source.stop()
+                else:
+                    self.camera.stop_encoder(source)
+            except Exception as e:
+                print(f"Error stopping the H.264 live view: {e}")
+            self.live_h264.close_session()
+            print("H.264 live view stopped, no viewers left.")
+
+    def generate_h264_stream(self, init_segment, on_dropped=None):
+        # fMP4 for one viewer: the init segment, then every fragment from the newest keyframe on.
+        # The caller holds a start_live_h264() registration and releases it when the response closes.
+        fragments_sent = 0
+        fragments_skipped = 0
+        dropped = False
+        last_seq = 0
+        try:
+            yield init_segment
+            while self.stream_active and not self.stream_event.is_set():
+                seq, fragment, skipped = self.live_h264.next_fragment(last_seq)
+                if fragment is None:
+                    if self.live_h264.closed:
+                        break
+                    continue
+                fragments_skipped += skipped # Fell out of the ring, jumped to the newest keyframe
+                if skipped:
+                    STREAM_FRAMES.labels("h264", "skipped").inc(skipped)
+                last_seq = seq
+                fragments_sent += 1
+                STREAM_FRAMES.labels("h264", "sent").inc()
+                yield_started = time.monotonic()
+                yield fragment
+                STARTUP.milestone("first_frame")
+                send_time = time.monotonic() - yield_started
+                metrics.STAGE_SECONDS.labels("stream_send").observe(send_time)
+                if send_time > STREAM_MAX_LAG_SECONDS:
+                    self.viewers_evicted += 1
+                    dropped = True
+                    print(f"H.264 viewer evicted, a fragment took {send_time:.1f}s to send.")
+                    break
+        except GeneratorExit:
+            dropped = True
+            raise
         except Exception as e:
-            print(f"MJPEG stream generation stopped.")
+            print(f"H.264 stream generation stopped: {e}")
         finally:
-            print(f"MJPEG stream generation stopped. Total frames sent: {frames_sent}")
-            self.stream_active = False # Ensure stream is marked inactive
-            self.stream_event.set()    # Ensure event is set to stop any waiting loops
+            if dropped and on_dropped is not None:
+                on_dropped()
+            print(f"H.264 viewer disconnected. Fragments sent: {fragments_sent}, skipped: {fragments_skipped}")
+
+    def acquire_viewer_slot(self):
+        # One slot per /video_feed response, released when the response is closed
+        if self._viewer_slots.acquire(blocking=False):
+            return True
+        self.viewers_rejected += 1
+        return False
+
+    def release_viewer_slot(self):
+        self._viewer_slots.release()
+
+    def frame_delivery_latency(self):
+        # Seconds from capture to client of the worst-off MJPEG viewer, None without viewers
+        with self._viewers_lock:
+            latencies = [viewer.latency for viewer in self._adaptive_viewers if viewer.latency is not None]
+        return max(latencies, default=None)
+
+    def get_stream_stats(self):
+        with self._viewers_lock:
+            viewers = list(self._adaptive_viewers)
+        return {
+            "active": self.stream_active,
+            "viewers": self._viewers,
+            "viewer_settings": [viewer.stats() for viewer in viewers],
+            "live_h264_viewers": self._live_h264_viewers,
+            "live_h264": self.live_h264.stats(),
+            "max_viewers": STREAM_MAX_VIEWERS,
+            "viewers_rejected": self.viewers_rejected,
+            "viewers_evicted": self.viewers_evicted,
+        }
 
     def start_stream(self):
         if self.stream_active:
             print("Stream is already active.")
             return True
         
-        if self.picam2 is None:
+        if self.camera is None:
             if self.setup_camera() is None:
                 print("Error: Camera could not be initialized for starting stream.")
                 return False
@@ -216,6 +772,7 @@ class CameraManager:
         if self.stream_active:
             self.stream_active = False
             self.stream_event.set()  # Signal generate_mjpeg_stream to stop
+            self.frames.close()      # Wake up viewers waiting for the next frame
             print("Stream stopped. MJPEG generation will cease.")
             self.noti.send_telegram_message("Camera live stream stopped.")
             return True
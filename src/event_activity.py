@@ -0,0 +1,170 @@
+"""Visual summary of a motion event, built from the lores frames seen while it records.
+
+While an event records, the capture thread hands an ActivityTracker a
+lores frame ACTIVITY_SAMPLE_FPS times a second. From those it keeps
+
+  * the motion energy (mean luma change since the previous sample) per second,
+  * the frame with the most energy, which becomes the event thumbnail,
+  * small sprite tiles at regular intervals, one JPEG strip for hover-scrubbing,
+  * where in the picture the motion was, as a 64-bit hash, to spot near-duplicate events.
+
+Nothing is decoded: the tracker works on the YUV420 buffers the camera
+already produces, downscaled by striding. Memory stays bounded however
+long the event runs: one peak frame at half size, and at most
+2 * SPRITE_MAX_TILES tiles (when the tiles fill up, every other one is
+dropped and the interval doubles).
+"""
+import json
+import os
+import config
+
+ACTIVITY_SAMPLE_FPS = getattr(config, "ACTIVITY_SAMPLE_FPS", 4)   # Lores frames analyzed per second while recording
+SPRITE_MAX_TILES = getattr(config, "SPRITE_MAX_TILES", 16)        # Tiles in the scrub-preview strip of one event
+SPRITE_TILE_INTERVAL = getattr(config, "SPRITE_TILE_INTERVAL", 1.0) # Seconds between tiles, grows for long events
+DUPLICATE_WINDOW_SECONDS = getattr(config, "DUPLICATE_WINDOW_SECONDS", 600) # Near-duplicates must be this close in time
+DUPLICATE_MAX_DISTANCE = getattr(config, "DUPLICATE_MAX_DISTANCE", 8)       # Differing bits of the 64-bit activity hash
+
+ENERGY_DOWNSCALE = 8   # Every 8th luma pixel and row feeds the energy and the hash
+HASH_GRID = 8          # The activity hash is an 8x8 grid of where the motion was
+THUMBNAIL_DOWNSCALE = 2 # 640x360 lores -> 320x180 thumbnail
+TILE_DOWNSCALE = 4      # 640x360 lores -> 160x90 tiles
+JPEG_QUALITY = 80
+
+
+def _planes(yuv, size, downscale):
+    # Y, U and V of a YUV420 lores buffer, downscaled by striding and copied (the buffer goes back to the camera)
+    width, height = size
+    chroma = yuv.reshape((yuv.shape[0] * 2, yuv.strides[0] // 2))
+    u_plane = chroma[2 * height: 2 * height + height // 2, :width // 2][::downscale, ::downscale].copy()
+    v_plane = chroma[2 * height + height // 2: 3 * height, :width // 2][::downscale, ::downscale].copy()
+    y_plane = yuv[:height, :width][::downscale, ::downscale][:2 * u_plane.shape[0], :2 * u_plane.shape[1]].copy()
+    return y_plane, u_plane, v_plane
+
+
+def encode_planes(y_plane, u_plane, v_plane, quality=JPEG_QUALITY):
+    """JPEG of YUV420 planes, through simplejpeg when installed, else PIL."""
+    try:
+        import simplejpeg
+        return simplejpeg.encode_jpeg_yuv_planes(y_plane, u_plane, v_plane, quality=quality)
+    except ImportError:
+        import io
+        from PIL import Image
+        size = (y_plane.shape[1], y_plane.shape[0])
+        image = Image.merge("YCbCr", (Image.fromarray(y_plane),
+                                      Image.fromarray(u_plane).resize(size),
+                                      Image.fromarray(v_plane).resize(size))).convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+        return buffer.getvalue()
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def hash_distance(a, b):
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+class ActivityTracker:
+    """Activity of one event; add() is called from the capture thread, the rest once recording has stopped.
+
+    Times are wall-clock seconds (time.time()). The summary stores them
+    as offsets into the event's video, given its start with video_start.
+    """
+
+    def __init__(self, size, started_at, tile_interval=SPRITE_TILE_INTERVAL, max_tiles=SPRITE_MAX_TILES):
+        import numpy as np # Deferred like the motion detector's, only needed once something records
+        self._np = np
+        self.size = size
+        self.started_at = started_at
+        self.max_tiles = max_tiles
+        self.tile_interval = tile_interval
+        self.samples = 0
+        self.energy = [] # Highest energy seen in each second since started_at, 0..1
+        self.peak_energy = -1.0
+        self.peak_at = None
+        self._peak_planes = None
+        self.tiles = [] # (time, (y, u, v))
+        self._next_tile_at = started_at
+        self._previous = None
+        self._motion_grid = None
+
+    def add(self, yuv, now):
+        np = self._np
+        width, height = self.size
+        luma = yuv[:height, :width][::ENERGY_DOWNSCALE, ::ENERGY_DOWNSCALE].astype(np.int16)
+        if self._previous is None:
+            energy = 0.0
+            self._motion_grid = np.zeros((HASH_GRID, HASH_GRID), dtype=np.float64)
+        else:
+            change = np.abs(luma - self._previous)
+            energy = float(change.mean()) / 255
+            # Motion per cell of an 8x8 grid, summed over the event
+            rows, cols = (change.shape[0] // HASH_GRID) * HASH_GRID, (change.shape[1] // HASH_GRID) * HASH_GRID
+            cells = change[:rows, :cols].reshape(HASH_GRID, rows // HASH_GRID, HASH_GRID, cols // HASH_GRID)
+            self._motion_grid += cells.mean(axis=(1, 3))
+        self._previous = luma
+        self.samples += 1
+
+        second = max(0, int(now - self.started_at))
+        if second >= len(self.energy):
+            self.energy.extend([0.0] * (second + 1 - len(self.energy)))
+        self.energy[second] = max(self.energy[second], energy)
+
+        if energy > self.peak_energy:
+            self.peak_energy = energy
+            self.peak_at = now
+            self._peak_planes = _planes(yuv, self.size, THUMBNAIL_DOWNSCALE)
+
+        if now >= self._next_tile_at:
+            self.tiles.append((now, _planes(yuv, self.size, TILE_DOWNSCALE)))
+            self._next_tile_at = now + self.tile_interval
+            if len(self.tiles) >= 2 * self.max_tiles:
+                self.tiles = self.tiles[::2]
+                self.tile_interval *= 2
+
+    def activity_hash(self):
+        """Which cells of an 8x8 grid saw more motion than the average cell, as a signed 64-bit int; None without motion."""
+        if self._motion_grid is None or not self._motion_grid.any():
+            return None
+        bits = (self._motion_grid > self._motion_grid.mean()).flatten()
+        value = sum(1 << i for i, bit in enumerate(bits) if bit)
+        return value - (1 << 64) if value >= 1 << 63 else value # SQLite integers are signed
+
+    def save_thumbnail(self, path):
+        if self._peak_planes is None:
+            return None
+        try:
+            return _write(path, encode_planes(*self._peak_planes))
+        except Exception as e:
+            print(f"Activity: could not write thumbnail {path}: {e}")
+            return None
+
+    def save_sprite(self, path):
+        """Writes the tiles side by side as one JPEG. Returns (path, tile times), or (None, []) without tiles."""
+        if not self.tiles:
+            return None, []
+        np = self._np
+        step = max(1, -(-len(self.tiles) // self.max_tiles)) # Ceiling division, at most max_tiles
+        tiles = self.tiles[::step]
+        try:
+            planes = [np.hstack([tile[1][i] for tile in tiles]) for i in range(3)]
+            return _write(path, encode_planes(*planes)), [at for at, _ in tiles]
+        except Exception as e:
+            print(f"Activity: could not write sprite {path}: {e}")
+            return None, []
+
+    def summary(self, video_start, tile_times):
+        """The activity column of the event: JSON with offsets in seconds from the start of its video."""
+        def offset(ts):
+            return round(max(0.0, ts - video_start), 2)
+        return json.dumps({
+            "start": offset(self.started_at), # energy[0] covers the second from here
+            "energy": [round(value, 4) for value in self.energy],
+            "peak": offset(self.peak_at) if self.peak_at is not None else None,
+            "tiles": [offset(ts) for ts in tile_times],
+        }, separators=(",", ":"))
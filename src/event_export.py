@@ -0,0 +1,238 @@
+"""Streaming export of events as a tar or zip archive.
+
+libarchive writes the archive block by block into a small bounded queue
+that the consumer (an HTTP response, a file, stdout) drains, so nothing
+is staged on the SD card and memory stays at a few blocks however big the
+export is. Videos and thumbnails are read in CHUNK_SIZE pieces; the
+manifest.json, written last so it records what actually went in, keeps
+one small entry per event, which EXPORT_MAX_EVENTS caps.
+
+Archive layout:
+
+    <name>/videos/<event video>.mp4
+    <name>/thumbnails/<event thumbnail>.jpg   (and the scrub-preview sprite, if there is one)
+    <name>/segments/<segment>.mp4        (continuous recording, events point into these)
+    <name>/manifest.json
+"""
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+import config
+import metrics
+import myEventDataBase as db
+
+EXPORT_MAX_EVENTS = getattr(config, "EXPORT_MAX_EVENTS", 2000)    # Per archive, narrow the range for more
+EXPORT_MAX_CONCURRENT = getattr(config, "EXPORT_MAX_CONCURRENT", 1) # Exports at once, each one reads the SD card flat out
+
+CHUNK_SIZE = 64 * 1024  # Read size for the files going into the archive
+BLOCK_SIZE = 64 * 1024  # Size of the chunks libarchive hands out
+QUEUE_BLOCKS = 8        # Blocks buffered between the archive writer and the consumer
+
+FORMATS = {
+    # name: (libarchive format, libarchive options, mimetype, file extension)
+    "tar": ("pax_restricted", "", "application/x-tar", ".tar"),
+    "zip": ("zip", "zip:compression=store", "application/zip", ".zip"), # MP4 and JPEG do not compress further
+}
+
+EXPORTS = metrics.counter("pizero_exports_total", "Event exports by format and result.", labels=("format", "result"))
+EXPORT_BYTES = metrics.counter("pizero_export_bytes_total", "Archive bytes produced by event exports.")
+
+_export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+
+def acquire_export_slot():
+    return _export_slots.acquire(blocking=False)
+
+
+def release_export_slot():
+    _export_slots.release()
+
+
+def archive_name(since=None, until=None, event_type=None):
+    # e.g. events-20250608-0000-20250609-0000-motion_detected
+    def stamp(ts):
+        return datetime.fromtimestamp(ts).strftime("%Y%m%d-%H%M")
+    parts = ["events", stamp(since) if since is not None else "start", stamp(until) if until is not None else "now"]
+    if event_type:
+        parts.append("".join(c if c.isalnum() else "_" for c in event_type.lower()))
+    return "-".join(parts)
+
+
+def _file_chunks(f, size):
+    # Exactly size bytes, the entry header already promised that many
+    remaining = size
+    while remaining > 0:
+        chunk = f.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise OSError(f"{f.name} shrank while it was being exported")
+        remaining -= len(chunk)
+        yield chunk
+
+
+class EventArchive:
+    """One export: the events matching the filters, as an archive produced by chunks().
+
+    A writer thread runs libarchive and blocks on the queue whenever the
+    consumer falls behind; closing the chunks() generator (the client went
+    away) stops it at the next block. With mark=True the exported events
+    get exported_at set, once the whole archive has been handed out.
+    """
+
+    def __init__(self, fmt="tar", since=None, until=None, event_type=None, mark=False,
+                 max_events=EXPORT_MAX_EVENTS):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown archive format {fmt!r}, expected one of {', '.join(FORMATS)}")
+        self.fmt = fmt
+        self.since = since
+        self.until = until
+        self.event_type = event_type
+        self.mark = mark
+        self.max_events = max_events
+        self.name = archive_name(since, until, event_type)
+        self.filename = self.name + FORMATS[fmt][3]
+        self.mimetype = FORMATS[fmt][2]
+        self.exported_ids = []
+        self._segments_added = set()
+        self.bytes_written = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize=QUEUE_BLOCKS)
+        self._cancelled = threading.Event()
+        self._thread = None
+
+    def count(self):
+        return db.count_video_events(self.since, self.until, self.event_type)
+
+    def chunks(self):
+        self._thread = threading.Thread(target=self._write_archive, name="export", daemon=True)
+        self._thread.start()
+        started = time.monotonic()
+        complete = False
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is None:
+                    break
+                self.bytes_written += len(chunk)
+                EXPORT_BYTES.inc(len(chunk))
+                yield chunk
+            complete = self.error is None
+        finally:
+            self.close()
+            result = "complete" if complete else ("error" if self.error else "cancelled")
+            EXPORTS.labels(self.fmt, result).inc()
+            print(f"Export {self.filename}: {result}, {len(self.exported_ids)} event(s), "
+                  f"{self.bytes_written / 1e6:.1f} MB in {time.monotonic() - started:.1f}s"
+                  + (f" ({self.error})" if self.error else ""))
+        if complete and self.mark and self.exported_ids:
+            db.mark_events_exported(self.exported_ids)
+
+    def close(self):
+        # Stops the writer thread if it is still running; safe to call more than once
+        self._cancelled.set()
+        while True:
+            try:
+                self._queue.get_nowait() # Unblocks a writer waiting on a full queue
+            except queue.Empty:
+                break
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+
+    def _put(self, data):
+        # libarchive's write callback: returns the bytes taken, or -1 to make it abort
+        chunk = bytes(data)
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(chunk, timeout=0.5)
+                return len(chunk)
+            except queue.Full:
+                continue
+        return -1
+
+    def _write_archive(self):
+        import libarchive
+        format_name, options = FORMATS[self.fmt][:2]
+        try:
+            with libarchive.custom_writer(self._put, format_name, options=options, block_size=BLOCK_SIZE) as archive:
+                manifest, truncated = [], False
+                # One past the cap, to tell a full archive from a truncated one
+                for event in db.iter_video_events(self.since, self.until, self.event_type, limit=self.max_events + 1):
+                    if self._cancelled.is_set():
+                        return
+                    if len(manifest) == self.max_events:
+                        truncated = True
+                        break
+                    manifest.append(self._add_event(archive, event))
+                self._add_manifest(archive, manifest, truncated)
+        except Exception as e:
+            if not self._cancelled.is_set():
+                self.error = str(e) or type(e).__name__
+        finally:
+            if not self._cancelled.is_set():
+                self._queue.put(None)
+
+    def _add_file(self, archive, path, entry_path, mtime):
+        # Returns the size added, or None if the file is gone
+        if not path:
+            return None
+        try:
+            f = open(path, "rb")
+        except OSError:
+            return None
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            archive.add_file_from_memory(f"{self.name}/{entry_path}", size, _file_chunks(f, size),
+                                         permission=0o644, mtime=mtime)
+        return size
+
+    def _add_event(self, archive, event):
+        entry = {key: event[key] for key in ("id", "event_ts", "event_timestamp", "event_type", "notes")}
+        entry["is_archived"] = bool(event["is_archived"])
+        mtime = event["event_ts"] or time.time()
+        video_path = event["mp4_filepath"] or event["h264_filepath"]
+        for key, path, subdir in (("video", video_path, "videos"),
+                                  ("thumbnail", event["thumbnail_path"], "thumbnails"),
+                                  ("sprite", event["sprite_path"], "thumbnails")):
+            entry_path = f"{subdir}/{os.path.basename(path)}" if path else None
+            size = self._add_file(archive, path, entry_path, mtime)
+            entry[key] = entry_path if size is not None else None
+            entry[f"{key}_bytes"] = size
+            if path and size is None:
+                entry.setdefault("missing", []).append(key)
+        if event["activity"]:
+            entry["activity"] = json.loads(event["activity"])
+        if event["clip_start"] is not None:
+            entry["segments"] = self._add_segments(archive, event["clip_start"], event["clip_end"])
+            entry["clip_start"], entry["clip_end"] = event["clip_start"], event["clip_end"]
+        if entry["video"] or entry.get("segments"):
+            self.exported_ids.append(event["id"])
+        return entry
+
+    def _add_segments(self, archive, clip_start, clip_end):
+        # Continuous recording: the segments the event covers, each one added once per archive.
+        # A segment still being written is left out, its last fragment may be incomplete.
+        names = []
+        for segment in db.get_segments_between(clip_start, clip_end):
+            if segment["end_ts"] is None:
+                continue
+            entry_path = f"segments/{os.path.basename(segment['filepath'])}"
+            if segment["filepath"] not in self._segments_added:
+                if self._add_file(archive, segment["filepath"], entry_path, segment["start_ts"]) is None:
+                    continue
+                self._segments_added.add(segment["filepath"])
+            names.append(entry_path)
+        return names
+
+    def _add_manifest(self, archive, events, truncated):
+        manifest = {
+            "exported_at": datetime.now().isoformat(timespec="seconds"),
+            "filters": {"since": self.since, "until": self.until, "event_type": self.event_type},
+            "event_count": len(events),
+            "truncated": truncated,
+            "events": events,
+        }
+        body = json.dumps(manifest, indent=1).encode()
+        archive.add_file_from_memory(f"{self.name}/manifest.json", len(body), body, permission=0o644,
+                                     mtime=time.time())
@@ -0,0 +1,124 @@
+"""The post-processing stages of a recorded event (see PostProcessor).
+
+They only need the notification manager and a way to report new files
+to the retention manager, not the camera, so the same stages run in the
+web process or in the background worker process (worker_process.py).
+"""
+import os
+import subprocess # For calling ffmpeg
+import config
+from config import EVENTS_STORAGE_DIR, THUMBNAILS_SUBDIR_NAME
+from metrics import stage_timer
+from myEventDataBase import record_new_video_event
+from postprocess import Stage
+from telegram_handler import SENT, REJECTED
+
+THUMBNAIL_FILES_DIR = os.path.join(EVENTS_STORAGE_DIR, THUMBNAILS_SUBDIR_NAME)
+POSTPROCESS_MAX_PENDING = getattr(config, "POSTPROCESS_MAX_PENDING", 200) # Queued jobs past which notify/upload are shed
+
+
+def generate_thumbnail(mp4_filepath, output_dir=THUMBNAIL_FILES_DIR, seek_time="00:00:01", width=320):
+
+    #Generates a thumbnail from an MP4 video file using ffmpeg.
+    if not os.path.exists(mp4_filepath):
+        print(f"Error generating thumbnail: Video file not found at {mp4_filepath}")
+        return None
+
+    base_filename = os.path.basename(mp4_filepath)
+    thumbnail_filename = os.path.splitext(base_filename)[0] + "_thumb.jpg"
+    thumbnail_fullpath = os.path.join(output_dir, thumbnail_filename)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    command = [
+        'ffmpeg', '-y', # Overwrite output files without asking
+        '-i', mp4_filepath,
+        '-ss', seek_time,
+        '-vframes', '1',
+        '-vf', f'scale={width}:-1', # Scale to width, maintain aspect ratio
+        thumbnail_fullpath
+    ]
+    try:
+        print(f"Generating thumbnail: {' '.join(command)}")
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        if result.returncode == 0:
+            print(f"Thumbnail generated successfully: {thumbnail_fullpath}")
+            return thumbnail_fullpath
+        else:
+            print(f"Error generating thumbnail for {mp4_filepath}.")
+            print(f"FFmpeg stdout: {result.stdout.decode(errors='ignore')}")
+            print(f"FFmpeg stderr: {result.stderr.decode(errors='ignore')}")
+            return None
+    except Exception as e:
+        print(f"An unexpected error occurred during thumbnail generation: {e}")
+        return None
+
+
+class EventJobs:
+    """Handlers of the notify, convert, upload, thumbnail and record stages.
+
+    New clips are muxed to MP4 while recording and only need notify, upload and record.
+    convert -> thumbnail -> record is kept for .h264 clips queued by older versions.
+    """
+
+    def __init__(self, noti, file_added):
+        self.noti = noti
+        self.file_added = file_added # RetentionManager.file_added, or its stand-in in the web process
+
+    def register(self, postprocessor):
+        # notify and upload are shed when the queue is full, the event is still recorded
+        postprocessor.add_stage(Stage("notify", self.notify, optional=True))
+        postprocessor.add_stage(Stage("convert", self.convert, next_stages=("thumbnail", "upload")))
+        postprocessor.add_stage(Stage("upload", self.upload, max_attempts=5, retry_delay=30, optional=True))
+        postprocessor.add_stage(Stage("thumbnail", self.thumbnail, next_stages=("record",)))
+        postprocessor.add_stage(Stage("record", self.record))
+        return postprocessor
+
+    def notify(self, payload):
+        video_path = payload.get("mp4_path") or payload["h264_path"]
+        if video_path is None: # Continuous recording, the event is a range of the segments
+            self.noti.send_telegram_message(f"Motion! {payload['notes']} ({payload['clip_end'] - payload['clip_start']:.0f}s)")
+            return
+        self.noti.send_telegram_message(f"Motion! Video recorded: {os.path.basename(video_path)}")
+
+    def convert(self, payload):
+        mp4_full_path = self.noti.convert_video_to_mp4(payload["h264_path"])
+        if not mp4_full_path or not os.path.exists(mp4_full_path):
+            raise RuntimeError(f"MP4 conversion failed or file not found for {payload['h264_path']}")
+        self.file_added(mp4_full_path) # The .h264 is removed by the retention sweep later
+        return {"mp4_path": mp4_full_path}
+
+    def upload(self, payload):
+        if not self.noti.bot_token or not self.noti.chat_id:
+            return # Telegram not configured, nothing to retry
+        # One attempt per run, this stage's retries are the only ones
+        status = self.noti.send_telegram_video_once(payload["mp4_path"])
+        if status == REJECTED:
+            return # Too large or refused, another attempt would be refused too
+        if status != SENT:
+            raise RuntimeError(f"Telegram upload failed for {payload['mp4_path']}")
+
+    def thumbnail(self, payload):
+        # A missing thumbnail is not worth retrying, the event is still recorded
+        with stage_timer("ffmpeg"):
+            thumbnail_path = generate_thumbnail(payload["mp4_path"])
+        self.file_added(thumbnail_path)
+        return {"thumbnail_path": thumbnail_path}
+
+    def record(self, payload):
+        new_id = record_new_video_event(
+            event_type="Motion Detected",
+            h264_path=payload.get("h264_path"), # Store full path, None for clips muxed while recording
+            mp4_path=payload["mp4_path"],   # Store full path, None for events pointing into the segments
+            thumbnail_path=payload.get("thumbnail_path"), # Store full path
+            notes_str=payload["notes"],
+            event_time=payload.get("event_ts"), # Trigger time, not the time the row is written
+            clip_start=payload.get("clip_start"),
+            clip_end=payload.get("clip_end"),
+            activity=payload.get("activity"),
+            sprite_path=payload.get("sprite_path"),
+            activity_hash=payload.get("activity_hash")
+        )
+        if new_id is None:
+            raise RuntimeError(f"Could not record event for {payload['mp4_path'] or payload['notes']}")
+        return {"event_id": new_id}
@@ -0,0 +1,76 @@
+"""Exports events as a tar or zip archive, the same one /export serves.
+
+Times are ISO-8601 local times (2025-06-08 or 2025-06-08T14:00) or unix
+seconds. The archive is streamed to the output as it is written, so it can
+go straight to another machine without a copy on the SD card:
+
+    python export_events.py --since 2025-06-08 --until 2025-06-09 -o june8.tar
+    python export_events.py --since 2025-06-08 --format zip -o - | ssh nas 'cat > june8.zip'
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+
+
+def parse_time(value):
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a date, time or unix timestamp: {value!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export events with their videos and thumbnails as one archive")
+    parser.add_argument("--since", type=parse_time, help="Events at or after this time")
+    parser.add_argument("--until", type=parse_time, help="Events before this time")
+    parser.add_argument("--type", dest="event_type", help="Only events of this type")
+    parser.add_argument("--format", choices=("tar", "zip"), default="tar")
+    parser.add_argument("-o", "--output", help="Archive file, - for stdout (default: <name>.tar in this directory)")
+    parser.add_argument("--mark", action="store_true",
+                        help="Record the events as exported, so retention evicts them before the others")
+    parser.add_argument("--max-events", type=int, help="Cap on the number of events (default EXPORT_MAX_EVENTS)")
+    args = parser.parse_args()
+
+    to_stdout = args.output == "-"
+    if to_stdout:
+        out = sys.stdout.buffer
+        sys.stdout = sys.stderr # The modules log with print(), keep that out of the archive
+
+    import myEventDataBase as db
+    from event_export import EventArchive, EXPORT_MAX_EVENTS
+    db.init_db()
+    archive = EventArchive(args.format, since=args.since, until=args.until, event_type=args.event_type,
+                           mark=args.mark, max_events=args.max_events or EXPORT_MAX_EVENTS)
+    total = archive.count()
+    if total == 0:
+        sys.exit("No events match.")
+    if total > archive.max_events:
+        print(f"{total} events match, only the oldest {archive.max_events} are exported.")
+
+    path = "-" if to_stdout else (args.output or archive.filename)
+    if not to_stdout:
+        out = open(path, "wb")
+    try:
+        for chunk in archive.chunks():
+            out.write(chunk)
+        out.flush()
+    except (KeyboardInterrupt, BrokenPipeError):
+        archive.close()
+        archive.error = archive.error or "interrupted"
+    finally:
+        if not to_stdout:
+            out.close()
+    if archive.error:
+        if not to_stdout:
+            os.remove(path) # A partial archive is worse than none
+        sys.exit(f"Export failed: {archive.error}")
+    print(f"{len(archive.exported_ids)} event(s), {archive.bytes_written / 1e6:.1f} MB written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import threading
+
+
+class FrameBroadcaster:
+    """Shared latest-frame slot for the live stream.
+
+    One producer publishes encoded frames, any number of viewers read them.
+    Each frame gets a sequence number; a viewer asks for "anything newer than
+    the last seq I sent", so a slow viewer simply skips the frames it missed
+    instead of queueing them up.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._frame = None
+        self._seq = 0
+        self._closed = False
+
+    def publish(self, frame):
+        with self._cond:
+            self._frame = frame
+            self._seq += 1
+            self._cond.notify_all()
+
+    def wait_for_frame(self, last_seq, timeout=1.0):
+        # Returns (seq, frame). frame is None on timeout or when the broadcaster is closed.
+        with self._cond:
+            if self._seq <= last_seq and not self._closed:
+                self._cond.wait_for(lambda: self._seq > last_seq or self._closed, timeout)
+            if self._closed or self._seq <= last_seq:
+                return last_seq, None
+            return self._seq, self._frame
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def latest_seq(self):
+        return self._seq
+
+    def open(self):
+        with self._cond:
+            self._closed = False
+
+    def close(self):
+        # Wake every waiting viewer so it can notice the stream has stopped.
+        with self._cond:
+            self._closed = True
+            self._frame = None
+            self._cond.notify_all()
@@ -0,0 +1,28 @@
+# Production server for the camera app:
+#
+#     cd src && gunicorn -c gunicorn.conf.py
+#
+# One worker process, because the camera, the recorder and the background
+# threads must exist exactly once. Requests run on a thread pool (gthread):
+# every MJPEG viewer holds a thread while it watches, so the pool is sized
+# for the viewer cap plus spare threads that keep the control and media
+# routes answering while every stream slot is in use. Idle keep-alive
+# connections wait in gunicorn's poller and do not hold a thread.
+import config as app_config # "config" is a gunicorn setting name
+
+STREAM_MAX_VIEWERS = getattr(app_config, "STREAM_MAX_VIEWERS", 4)
+SERVER_SPARE_THREADS = getattr(app_config, "SERVER_SPARE_THREADS", 4)
+
+wsgi_app = "stream:app"
+bind = getattr(app_config, "SERVER_BIND", "0.0.0.0:5000")
+workers = 1
+worker_class = "gthread"
+threads = STREAM_MAX_VIEWERS + SERVER_SPARE_THREADS
+keepalive = 5
+sendfile = True # /media/videos hands byte ranges to sendfile()
+
+
+def post_worker_init(worker):
+    # Camera, motion thread and post-processing start inside the worker that serves the app
+    from stream import start_background_services
+    start_background_services()
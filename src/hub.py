@@ -0,0 +1,272 @@
+"""Hub side of multi-node mode: one instance collects the events of every camera node.
+
+Nodes push their event rows and thumbnails (see replication.py) to
+/hub/ingest; the hub keeps them in hub_events next to its own
+video_events, and get_merged_video_events() lists both in one time order.
+Videos stay on the nodes: the first request for one fetches it from the
+node into a size-capped cache under HUB_STORAGE_DIR. Live views are
+proxied byte for byte, the hub never decodes or re-encodes them.
+
+    HUB_STORAGE_DIR/<node_id>/thumbnails/<name>.jpg
+    HUB_STORAGE_DIR/<node_id>/videos/<remote id>.mp4
+"""
+import base64
+import binascii
+import os
+import re
+import threading
+import urllib.parse
+import urllib.request
+import config
+import metrics
+import myEventDataBase as db
+from config import EVENTS_STORAGE_DIR
+
+HUB_MODE = getattr(config, "HUB_MODE", False)   # Accept events from camera nodes on /hub/ingest
+HUB_TOKEN = getattr(config, "HUB_TOKEN", None)  # Shared secret between the hub and its nodes, both directions; hub mode needs it
+HUB_STORAGE_DIR = getattr(config, "HUB_STORAGE_DIR", os.path.join(EVENTS_STORAGE_DIR, "hub"))
+HUB_CACHE_MAX_BYTES = getattr(config, "HUB_CACHE_MAX_BYTES", 2 * 1024**3) # Videos fetched from the nodes, oldest used go first
+HUB_FETCH_TIMEOUT = getattr(config, "HUB_FETCH_TIMEOUT", 30) # Seconds without data from a node before a fetch or live view gives up
+HUB_MAX_BATCH = 500 # Ops per ingest request, a node sends at most REPLICATION_BATCH_SIZE
+HUB_THUMBNAIL_MAX_BYTES = 256 * 1024 # Same cap as the nodes' THUMBNAIL_MAX_BYTES, bigger ones are dropped
+# Body of one ingest request: a full batch of REPLICATION_BATCH_SIZE events with the largest thumbnails, base64
+HUB_MAX_INGEST_BYTES = getattr(config, "HUB_MAX_INGEST_BYTES", 24 * 1024 * 1024)
+
+LIVE_KINDS = ("video_feed", "live_h264")
+LIVE_PASS_HEADERS = ("Content-Type", "X-Codecs", "Cache-Control")
+PROXY_CHUNK_SIZE = 64 * 1024
+
+_NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$") # Node ids and file names, safe as path components
+
+INGESTED_OPS = metrics.counter("pizero_hub_ingested_ops_total", "Event ops received from camera nodes.", labels=("op",))
+VIDEO_FETCHES = metrics.counter("pizero_hub_video_fetches_total", "Videos requested through the hub.", labels=("result",))
+
+_fetch_locks = {}
+_fetch_locks_guard = threading.Lock()
+
+
+class IngestError(ValueError):
+    """A malformed ingest request; answered with 400."""
+
+
+def valid_name(name):
+    return isinstance(name, str) and bool(_NAME_RE.match(name))
+
+
+def node_dir(node_id, subdir):
+    return os.path.join(HUB_STORAGE_DIR, node_id, subdir)
+
+
+def _write_atomic(path, data):
+    # Readers see the old file or the new one, never half of it
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".part"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def ingest(payload):
+    """Applies an ingest request from a node. Returns (ops applied, whether the node was new to the hub).
+
+    Thumbnails are written before the rows that point at them are
+    committed, so a listed thumbnail always exists; the ones the batch
+    replaced or deleted are removed afterwards.
+    """
+    if not isinstance(payload, dict):
+        raise IngestError("expected a JSON object")
+    node_id, node_url, ops = payload.get("node_id"), payload.get("node_url"), payload.get("ops")
+    if not valid_name(node_id):
+        raise IngestError("node_id must be 1-64 letters, digits, '.', '_' or '-'")
+    if not isinstance(node_url, str) or not node_url.startswith(("http://", "https://")):
+        raise IngestError("node_url must be an http(s) URL")
+    if not isinstance(ops, list) or len(ops) > HUB_MAX_BATCH:
+        raise IngestError(f"ops must be a list of at most {HUB_MAX_BATCH}")
+
+    new_node = db.get_hub_node(node_id) is None
+    rows = []
+    for op in ops:
+        try:
+            kind, event_id = op["op"], int(op["id"] if op["op"] == "delete" else op["event"]["id"])
+        except (KeyError, TypeError, ValueError):
+            raise IngestError(f"malformed op: {op!r:.200}")
+        if kind == "delete":
+            rows.append({"op": "delete", "id": event_id})
+        elif kind == "upsert":
+            rows.append({"op": "upsert", "id": event_id, "event": _hub_event(node_id, op["event"])})
+        else:
+            raise IngestError(f"unknown op {kind!r}")
+
+    for row in rows:
+        thumbnail = row.get("event", {}).pop("thumbnail_data", None)
+        if thumbnail is not None:
+            _write_atomic(row["event"]["thumbnail_path"], thumbnail)
+    orphaned, stale_videos = db.apply_hub_ops(node_id, node_url.rstrip("/"), rows)
+    for path in orphaned:
+        _remove(path)
+    for remote_id in stale_videos:
+        _remove(cached_video_path(node_id, remote_id))
+    for row in rows:
+        INGESTED_OPS.labels(row["op"]).inc()
+    return len(rows), new_node
+
+
+def _hub_event(node_id, event):
+    # The row for hub_events, with the decoded thumbnail to write under thumbnail_data
+    try:
+        row = {
+            "event_ts": int(event["event_ts"]),
+            "event_timestamp": str(event["event_timestamp"]),
+            "event_type": event.get("event_type"),
+            "notes": event.get("notes"),
+            "is_archived": bool(event.get("is_archived")),
+            "clip_start": event.get("clip_start"),
+            "clip_end": event.get("clip_end"),
+            "video_path": event.get("video_path"),
+            "thumbnail_path": None,
+        }
+    except (KeyError, TypeError, ValueError):
+        raise IngestError("event needs event_ts and event_timestamp")
+    if row["video_path"] is not None and not (isinstance(row["video_path"], str) and row["video_path"].startswith("/")):
+        raise IngestError("video_path must be an absolute URL path on the node")
+    name, thumbnail = event.get("thumbnail_name"), event.get("thumbnail")
+    # Oversized thumbnails are dropped rather than refused, so the batch (and the node's outbox) still goes through
+    if thumbnail and valid_name(name) and len(thumbnail) <= (HUB_THUMBNAIL_MAX_BYTES + 2) // 3 * 4:
+        try:
+            data = base64.b64decode(thumbnail, validate=True)
+        except (binascii.Error, TypeError, ValueError):
+            raise IngestError("thumbnail is not valid base64")
+        if len(data) <= HUB_THUMBNAIL_MAX_BYTES:
+            row["thumbnail_data"] = data
+            row["thumbnail_path"] = os.path.join(node_dir(node_id, "thumbnails"), name)
+    return row
+
+
+# --- Videos, fetched from the nodes on first request ---
+
+def cached_video_path(node_id, remote_id):
+    return os.path.join(node_dir(node_id, "videos"), f"{int(remote_id)}.mp4")
+
+
+def _node_request(node_url, path, query=None):
+    url = node_url + path
+    if query:
+        url += ("&" if "?" in url else "?") + urllib.parse.urlencode(query)
+    headers = {"Authorization": f"Bearer {HUB_TOKEN}"} if HUB_TOKEN else {}
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=HUB_FETCH_TIMEOUT)
+
+
+def fetch_video(node_id, remote_id):
+    """Path of the event's video in the hub cache, fetched from the node if needed; None if unavailable.
+
+    Concurrent requests for the same video wait for one fetch. The
+    download goes to a .part file that is renamed when complete, so the
+    cache never holds a truncated video.
+    """
+    path = cached_video_path(node_id, remote_id)
+    if os.path.isfile(path):
+        os.utime(path) # Recently used, pruned last
+        VIDEO_FETCHES.labels("cached").inc()
+        return path
+    with _fetch_locks_guard:
+        lock = _fetch_locks.setdefault(path, threading.Lock())
+    with lock:
+        if os.path.isfile(path):
+            VIDEO_FETCHES.labels("cached").inc()
+            return path
+        event = db.get_hub_event(node_id, remote_id)
+        node = db.get_hub_node(node_id)
+        if event is None or node is None or not event["video_path"]:
+            return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".part"
+        try:
+            with _node_request(node["node_url"], event["video_path"]) as response, open(tmp_path, "wb") as f:
+                while True:
+                    chunk = response.read(PROXY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except OSError as e: # URLError and HTTPError included
+            print(f"Hub: fetching video {node_id}/{remote_id} from {node['node_url']} failed: {e}")
+            _remove(tmp_path)
+            VIDEO_FETCHES.labels("failed").inc()
+            return None
+        finally:
+            with _fetch_locks_guard:
+                _fetch_locks.pop(path, None)
+    VIDEO_FETCHES.labels("fetched").inc()
+    prune_video_cache(keep=path)
+    return path
+
+
+def prune_video_cache(keep=None, max_bytes=HUB_CACHE_MAX_BYTES):
+    """Removes the least recently used cached videos until the cache fits max_bytes."""
+    files = []
+    try:
+        nodes = os.listdir(HUB_STORAGE_DIR)
+    except OSError:
+        return
+    for node_id in nodes:
+        videos_dir = node_dir(node_id, "videos")
+        try:
+            names = os.listdir(videos_dir)
+        except OSError:
+            continue
+        for name in names:
+            if not name.endswith(".mp4"):
+                continue
+            path = os.path.join(videos_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        if path != keep:
+            _remove(path)
+            total -= size
+
+
+# --- Live views ---
+
+def open_live(node_id, kind, query):
+    """Opens a live view on the node. Returns (response, headers to pass on), or None if the node does not answer.
+
+    The caller streams the response with live_chunks(), which hands on
+    whatever the node sent as soon as it arrives.
+    """
+    node = db.get_hub_node(node_id)
+    if node is None or kind not in LIVE_KINDS:
+        return None
+    try:
+        response = _node_request(node["node_url"], f"/{kind}", query)
+    except OSError as e:
+        print(f"Hub: live view {kind} of {node_id} unavailable: {e}")
+        return None
+    headers = {name: response.headers[name] for name in LIVE_PASS_HEADERS if response.headers.get(name)}
+    return response, headers
+
+
+def live_chunks(response):
+    try:
+        while True:
+            chunk = response.read1(PROXY_CHUNK_SIZE) # Whatever has arrived, without waiting for a full chunk
+            if not chunk:
+                break
+            yield chunk
+    except OSError:
+        pass # The node went away
+    finally:
+        response.close()
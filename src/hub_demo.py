@@ -0,0 +1,240 @@
+"""Hub mode on one machine: a hub and several camera nodes as separate processes on localhost.
+
+Every process runs stream.py with its own config (simulated camera, own
+database and storage, own port), written to a scratch directory from the
+config.py this script imports. The script then records events on the
+nodes and checks that
+
+  * they show up on the hub in one time-ordered list, page by page,
+  * a node's video is fetched through the hub byte for byte, then served from its cache,
+  * a node's live view is relayed by the hub,
+  * a deleted event disappears from the hub,
+  * events recorded while the hub is down arrive once it is back.
+
+    python hub_demo.py --nodes 3 --events 5
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import config
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+HUB_TOKEN = "demo-token"
+
+CONFIG_TEMPLATE = """\
+exec(open({base!r}).read())
+CAMERA_BACKEND = "simulated"
+EVENTS_STORAGE_DIR = {storage!r}
+DB_FILE = {db_file!r}
+SERVER_BIND = "127.0.0.1:{port}"
+NODE_ID = {node_id!r}
+HUB_TOKEN = {token!r}
+HUB_MODE = {hub_mode!r}
+HUB_URL = {hub_url!r}
+NODE_URL = "http://127.0.0.1:{port}"
+REPLICATION_INTERVAL = 1
+BOT_TOKEN = None
+CHAT_ID = None
+"""
+
+
+class Instance:
+    """One stream.py process with its own config directory."""
+
+    def __init__(self, root, node_id, port, hub_url=None, hub_mode=False):
+        self.node_id = node_id
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.dir = os.path.join(root, node_id)
+        self.storage = os.path.join(self.dir, "events")
+        os.makedirs(os.path.join(self.storage, config.VIDEOS_SUBDIR_NAME), exist_ok=True)
+        os.makedirs(os.path.join(self.storage, config.THUMBNAILS_SUBDIR_NAME), exist_ok=True)
+        with open(os.path.join(self.dir, "config.py"), "w") as f:
+            f.write(CONFIG_TEMPLATE.format(base=os.path.abspath(config.__file__), storage=self.storage,
+                                           db_file=os.path.join(self.dir, "events.db"), port=port, node_id=node_id,
+                                           token=HUB_TOKEN, hub_mode=hub_mode, hub_url=hub_url))
+        self.env = dict(os.environ, PYTHONPATH=self.dir)
+        self.process = None
+        self.session = None
+
+    def start(self):
+        log = open(os.path.join(self.dir, "server.log"), "ab")
+        self.process = subprocess.Popen([sys.executable, "stream.py"], cwd=SRC_DIR, env=self.env,
+                                        stdout=log, stderr=subprocess.STDOUT)
+        import requests
+        self.session = requests.Session()
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                self.session.get(self.url + "/healthz", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        else:
+            raise RuntimeError(f"{self.node_id} did not start, see {self.dir}/server.log")
+        self.session.post(self.url + "/", data={"username": config.USER_NAME, "password": config.PASSWORD})
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+    def run(self, *args):
+        # This script in the instance's config, for the database work of --add-events and --delete-oldest
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), *args], cwd=SRC_DIR, env=self.env,
+                                capture_output=True, text=True, check=True)
+        return result.stdout.strip().splitlines()[-1]
+
+
+def add_events(count):
+    # Runs inside a node's config: short real MP4s and thumbnails, recorded like the camera would
+    import av
+    import numpy as np
+    from PIL import Image
+    import myEventDataBase as db
+    db.init_db()
+    now = time.time()
+    ids = []
+    for i in range(count):
+        event_time = now - (count - i) * 7
+        stamp = f"{config.NODE_ID}_{int(event_time * 1000)}"
+        mp4_path = os.path.join(config.EVENTS_STORAGE_DIR, config.VIDEOS_SUBDIR_NAME, f"{stamp}.mp4")
+        thumbnail_path = os.path.join(config.EVENTS_STORAGE_DIR, config.THUMBNAILS_SUBDIR_NAME, f"{stamp}.jpg")
+        with av.open(mp4_path, "w", options={"movflags": "faststart"}) as container:
+            stream = container.add_stream("libx264", rate=10)
+            stream.width, stream.height, stream.pix_fmt = 320, 240, "yuv420p"
+            for n in range(20):
+                image = np.full((240, 320, 3), (n * 12) % 256, dtype=np.uint8)
+                container.mux(stream.encode(av.VideoFrame.from_ndarray(image, format="rgb24")))
+            container.mux(stream.encode())
+        Image.new("RGB", (160, 120), (40 * i % 256, 80, 160)).save(thumbnail_path, quality=70)
+        ids.append(db.record_new_video_event("Motion Detected", None, mp4_path, thumbnail_path,
+                                             f"demo event {i} on {config.NODE_ID}", event_time=event_time))
+    print(",".join(map(str, ids)))
+
+
+def delete_oldest():
+    import myEventDataBase as db
+    db.init_db()
+    event = next(db.iter_video_events(limit=1))
+    db.delete_video_event(event["id"])
+    print(event["id"])
+
+
+def hub_events(hub):
+    # The whole merged list, following the older_cursor pages
+    events, before = [], None
+    while True:
+        params = {"limit": 4, **({"before": before} if before else {})}
+        data = hub.session.get(hub.url + "/hub/events", params=params, timeout=10).json()
+        events.extend(data["events"])
+        before = data["older_cursor"]
+        if not before:
+            return events
+
+
+def wait_for(description, condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            print(f"FAIL {description}")
+            return False
+        time.sleep(0.5)
+    print(f"OK   {description}")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a hub and camera nodes on localhost and check replication")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--events", type=int, default=5, help="Events recorded on every node")
+    parser.add_argument("--port", type=int, default=5100, help="Hub port, the nodes use the ports after it")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory")
+    parser.add_argument("--add-events", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--delete-oldest", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.add_events:
+        add_events(args.add_events)
+        return
+    if args.delete_oldest:
+        delete_oldest()
+        return
+
+    root = tempfile.mkdtemp(prefix="pizero-hub-")
+    print(f"Scratch directory: {root}")
+    hub = Instance(root, "hub", args.port, hub_mode=True)
+    nodes = [Instance(root, f"cam{i + 1}", args.port + 1 + i, hub_url=hub.url) for i in range(args.nodes)]
+    results = []
+    try:
+        for instance in [hub, *nodes]:
+            instance.start()
+        for node in nodes:
+            node.run("--add-events", str(args.events))
+
+        expected = args.nodes * args.events
+        results.append(wait_for(f"{expected} events from {args.nodes} nodes on the hub",
+                                lambda: len(hub_events(hub)) == expected))
+        events = hub_events(hub)
+        keys = [(e["event_ts"], e["node_id"], e["id"]) for e in events]
+        results.append(wait_for("merged list newest first, no duplicates across pages",
+                                lambda: keys == sorted(set(keys), reverse=True), timeout=0))
+        results.append(wait_for("thumbnails served by the hub", lambda: all(
+            hub.session.get(hub.url + e["thumbnail_url"], timeout=10).content[:2] == b"\xff\xd8" for e in events),
+            timeout=0))
+
+        event = events[0]
+        node = next(n for n in nodes if n.node_id == event["node_id"])
+        started = time.perf_counter()
+        fetched = hub.session.get(hub.url + event["video_url"], timeout=30).content
+        first_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        cached = hub.session.get(hub.url + event["video_url"], headers={"Range": "bytes=0-"}, timeout=30).content
+        cached_ms = (time.perf_counter() - started) * 1000
+        original = node.session.get(node.url + "/api/events", params={"limit": 1}).json()["events"][0]
+        original_bytes = node.session.get(node.url + original["video_url"], timeout=30).content
+        results.append(wait_for(f"video fetched from {node.node_id} through the hub ({len(fetched)} bytes, "
+                                f"{first_ms:.0f} ms, then {cached_ms:.0f} ms from the cache)",
+                                lambda: fetched == cached == original_bytes, timeout=0))
+
+        node.session.post(node.url + "/start_stream")
+        time.sleep(2)
+        with hub.session.get(hub.url + f"/hub/live/{node.node_id}/video_feed", params={"fps": 5}, stream=True,
+                             timeout=10) as live:
+            received = b""
+            for chunk in live.iter_content(4096):
+                received += chunk
+                if received.count(b"\xff\xd9") >= 3 or len(received) > 2_000_000:
+                    break
+        results.append(wait_for(f"live view of {node.node_id} relayed ({live.headers.get('Content-Type')})",
+                                lambda: received.count(b"\xff\xd9") >= 3, timeout=0))
+
+        deleted = int(nodes[0].run("--delete-oldest"))
+        results.append(wait_for(f"event {deleted} deleted on {nodes[0].node_id} is gone from the hub", lambda: not any(
+            e["node_id"] == nodes[0].node_id and e["id"] == deleted for e in hub_events(hub))))
+        expected -= 1
+
+        hub.stop()
+        for node in nodes:
+            node.run("--add-events", "2")
+        expected += 2 * args.nodes
+        time.sleep(3) # Let the nodes fail a push or two
+        hub.start()
+        results.append(wait_for(f"events recorded while the hub was down arrive ({expected} in total)",
+                                lambda: len(hub_events(hub)) == expected, timeout=60))
+    finally:
+        for instance in [hub, *nodes]:
+            instance.stop()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    print(f"{sum(results)}/{len(results)} checks passed")
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import collections
+import struct
+import threading
+import time
+from fractions import Fraction
+from camera_backend import Output
+
+TIMESTAMP_BASE = Fraction(1, 1_000_000) # picamera2 encoder timestamps are in microseconds
+FRAGMENT_FLAGS = "frag_every_frame+empty_moov+default_base_moof" # One self-contained fragment per frame
+
+
+def _fragment_has_idr(mdat_payload):
+    # The mp4 muxer stores length-prefixed NAL units; an IDR slice (type 5) makes it a keyframe
+    offset = 0
+    while offset + 5 <= len(mdat_payload):
+        nal_length = struct.unpack_from(">I", mdat_payload, offset)[0]
+        if mdat_payload[offset + 4] & 0x1F == 5:
+            return True
+        offset += 4 + nal_length
+    return False
+
+
+def _codec_string(init_segment):
+    # RFC 6381 codec string ("avc1.PPCCLL") from the avcC box, needed by MediaSource.isTypeSupported
+    index = init_segment.find(b"avcC")
+    if index < 0 or index + 8 > len(init_segment):
+        return "avc1.42e01e"
+    profile, compatibility, level = init_segment[index + 5:index + 8]
+    return f"avc1.{profile:02x}{compatibility:02x}{level:02x}"
+
+
+class _BoxSplitter:
+    # File-like target for the PyAV muxer. Cuts its output into top-level boxes and hands them on.
+    def __init__(self, on_box):
+        self._buffer = bytearray()
+        self._on_box = on_box
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= 8:
+            size = struct.unpack_from(">I", self._buffer)[0]
+            if size < 8 or len(self._buffer) < size:
+                break
+            box = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self._on_box(box[4:8], box)
+        return len(data)
+
+
+class LiveH264Output(Output):
+    """Encoder output that repackages H.264 as fragmented MP4 for live viewing.
+
+    One encoder session feeds every viewer. Each frame is muxed into its own
+    moof+mdat fragment (no re-encoding) and kept in a short ring; a viewer
+    gets the init segment (ftyp+moov) and then the fragments in order,
+    starting from the newest keyframe, which a browser can append to a
+    MediaSource buffer as they arrive. A viewer that falls out of the ring
+    jumps ahead to the newest keyframe.
+
+    Anything that calls outputframe() can drive it: the hardware encoder on
+    the camera or an H264FileFeed replaying a recorded stream.
+    """
+
+    def __init__(self, size, framerate, ring_seconds=3):
+        super().__init__()
+        self.size = size
+        self.framerate = framerate
+        self.ring_us = int(ring_seconds * 1_000_000)
+        self._cond = threading.Condition()
+        self._mux_lock = threading.Lock()
+        self._container = None
+        self._stream = None
+        self._first_timestamp = None
+        self._last_pts = -1
+        self._frame_timestamp = None    # Timestamp of the frame last given to the muxer
+        self._fragment_timestamp = None # ... and of the one before, whose fragment the next mux() emits
+        self._init_parts = []
+        self.init_segment = None
+        self.codec = None
+        self._fragments = collections.deque() # (seq, keyframe, timestamp_us, moof+mdat bytes)
+        self._seq = 0
+        self._moof = None
+        self._closed = True
+
+    # --- Producer side ---
+
+    def open_session(self):
+        with self._cond:
+            self._closed = False
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        if timestamp is None:
+            timestamp = time.monotonic_ns() // 1000
+        with self._mux_lock:
+            if self._closed:
+                return
+            if self._container is None:
+                if not keyframe:
+                    return # The stream has to start on a keyframe
+                self._open_container()
+            if self._first_timestamp is None:
+                self._first_timestamp = timestamp
+            import av # Deferred like all PyAV imports, it is slow to load on a Pi Zero
+            pts = timestamp - self._first_timestamp
+            if pts <= self._last_pts:
+                pts = self._last_pts + 1
+            self._last_pts = pts
+            self._fragment_timestamp, self._frame_timestamp = self._frame_timestamp, timestamp
+
+            packet = av.Packet(bytes(frame))
+            packet.pts = packet.dts = pts
+            packet.time_base = TIMESTAMP_BASE
+            packet.is_keyframe = keyframe
+            packet.stream = self._stream
+            self._container.mux(packet) # The fragment of the previous frame comes out here
+
+    def _open_container(self):
+        import av
+        self._container = av.open(_BoxSplitter(self._on_box), "w", format="mp4",
+                                  options={"movflags": FRAGMENT_FLAGS, "flush_packets": "1"})
+        self._stream = self._container.add_stream("h264", rate=self.framerate)
+        self._stream.width, self._stream.height = self.size
+        self._stream.time_base = TIMESTAMP_BASE
+
+    def _on_box(self, kind, box):
+        # Called from inside mux(), with _mux_lock held
+        if kind in (b"ftyp", b"moov"):
+            self._init_parts.append(box)
+            if kind == b"moov":
+                with self._cond:
+                    self.init_segment = b"".join(self._init_parts)
+                    self.codec = _codec_string(self.init_segment)
+                    self._cond.notify_all()
+        elif kind == b"moof":
+            self._moof = box
+        elif kind == b"mdat" and self._moof is not None:
+            keyframe = _fragment_has_idr(memoryview(box)[8:])
+            with self._cond:
+                self._seq += 1
+                timestamp = self._fragment_timestamp or self._frame_timestamp
+                self._fragments.append((self._seq, keyframe, timestamp, self._moof + box))
+                while self._fragments and timestamp - self._fragments[0][2] > self.ring_us:
+                    self._fragments.popleft()
+                self._cond.notify_all()
+            self._moof = None
+
+    def close_session(self):
+        # Encoder stopped: wake the viewers and start over with a new init segment next time
+        with self._mux_lock:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            if self._container is not None:
+                try:
+                    self._container.close()
+                except Exception as e:
+                    print(f"Live H.264: error closing the fragment muxer: {e}")
+            self._container = self._stream = None
+            self._first_timestamp = self._frame_timestamp = self._fragment_timestamp = None
+            self._last_pts = -1
+            self._init_parts = []
+            with self._cond:
+                self.init_segment = self.codec = None
+                self._fragments.clear()
+
+    # --- Viewer side ---
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def wait_for_init(self, timeout=5.0):
+        with self._cond:
+            self._cond.wait_for(lambda: self.init_segment is not None or self._closed, timeout)
+            return self.init_segment
+
+    def next_fragment(self, last_seq, timeout=1.0):
+        """Returns (seq, fragment, skipped) for the fragment after last_seq, or (last_seq, None, 0).
+
+        last_seq 0 (a new viewer) or a seq that already left the ring starts at the newest keyframe.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._closed or (self._fragments and self._fragments[-1][0] > last_seq),
+                                timeout)
+            if self._closed or not self._fragments or self._fragments[-1][0] <= last_seq:
+                return last_seq, None, 0
+            oldest = self._fragments[0][0]
+            if last_seq and last_seq + 1 >= oldest:
+                seq, _, _, fragment = self._fragments[last_seq + 1 - oldest]
+                return seq, fragment, 0
+            for seq, keyframe, _, fragment in reversed(self._fragments):
+                if keyframe:
+                    return seq, fragment, (seq - last_seq - 1 if last_seq else 0)
+            return last_seq, None, 0 # No keyframe buffered yet
+
+    def stats(self):
+        with self._cond:
+            return {
+                "active": not self._closed,
+                "codec": self.codec,
+                "fragments": len(self._fragments),
+                "buffered_bytes": sum(len(f[3]) for f in self._fragments),
+            }
+
+
+class H264FileFeed:
+    """Replays a raw H.264 file into an output in a loop, in place of the camera's encoder.
+
+    Lets the live H.264 view run and be tested off-device.
+    """
+
+    def __init__(self, path, output, framerate=30):
+        self.path = path
+        self.output = output
+        self.framerate = framerate
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="h264-file-feed", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        import av
+        interval = 1.0 / self.framerate
+        timestamp = time.monotonic_ns() // 1000
+        while not self._stop.is_set():
+            with av.open(self.path, format="h264") as container:
+                for packet in container.demux(video=0):
+                    if packet.size == 0:
+                        continue
+                    if self._stop.wait(interval):
+                        return
+                    timestamp += int(interval * 1_000_000)
+                    self.output.outputframe(bytes(packet), packet.is_keyframe, timestamp)
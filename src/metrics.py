@@ -0,0 +1,291 @@
+import bisect
+import os
+import threading
+import time
+
+# Seconds; from sub-millisecond frame work up to uploads that take a minute
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _default(self):
+        # The child of a metric without labels
+        return self.labels()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def _render_child(self, values, child):
+        yield f"{self.name}{_format_labels(self.label_names, values)} {_format_value(child.value)}"
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.started)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _render_child(self, values, child):
+        with child._lock:
+            counts, total = list(child.counts), child.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = _format_labels(self.label_names, values, (("le", _format_value(bound)),))
+            yield f"{self.name}_bucket{labels} {cumulative}"
+        labels = _format_labels(self.label_names, values)
+        yield f"{self.name}_sum{labels} {_format_value(total)}"
+        yield f"{self.name}_count{labels} {cumulative}"
+
+
+class CallbackMetric:
+    """A gauge or counter whose value is read from fn() only when /metrics is scraped.
+
+    fn returns a number, or a dict of {label values tuple: number} for a metric with labels.
+    """
+
+    def __init__(self, name, help_text, fn, labels=(), kind="gauge"):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.label_names = tuple(labels)
+        self.kind = kind
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            return [f"# {self.name} unavailable: {_escape(e)}"]
+        if value is None:
+            return []
+        samples = value.items() if isinstance(value, dict) else [((), value)]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, sample in samples:
+            if not isinstance(values, tuple):
+                values = (values,)
+            lines.append(f"{self.name}{_format_labels(self.label_names, values)} {_format_value(sample)}")
+        return lines
+
+
+class Registry:
+    """Metrics of the process, rendered in the Prometheus text format.
+
+    Counters and histograms only do a dict lookup, a bisect and an
+    increment under a per-series lock when they are updated; everything
+    else (cumulative buckets, callback values, process stats) is computed
+    when /metrics is scraped, so nothing runs when nobody scrapes.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        # Registering a name again replaces the old metric (a new CameraManager, say)
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name, help_text, labels=()):
+    return REGISTRY.register(Counter(name, help_text, labels))
+
+
+def histogram(name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, labels, buckets))
+
+
+def gauge_callback(name, help_text, fn, labels=()):
+    return REGISTRY.register(CallbackMetric(name, help_text, fn, labels))
+
+
+def counter_callback(name, help_text, fn, labels=()):
+    return REGISTRY.register(CallbackMetric(name, help_text, fn, labels, kind="counter"))
+
+
+def render():
+    return REGISTRY.render()
+
+
+class TimedLock:
+    """threading.Lock that records how long each acquisition waited in a histogram."""
+
+    def __init__(self, wait_histogram):
+        self._lock = threading.Lock()
+        self._wait = wait_histogram
+
+    def acquire(self, blocking=True, timeout=-1):
+        started = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        self._wait.observe(time.perf_counter() - started)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# --- Instruments shared by the modules ---
+
+STAGE_SECONDS = histogram("pizero_stage_duration_seconds",
+                          "Time spent in each processing stage (capture, encode, record, ffmpeg, upload, database).",
+                          labels=("stage",))
+CAMERA_LOCK_WAIT = histogram("pizero_camera_lock_wait_seconds", "Time spent waiting for the camera lock.")
+STREAM_FRAMES = counter("pizero_stream_frames_total",
+                        "Live-view frames per stream type and outcome (sent, or skipped because the viewer was behind).",
+                        labels=("stream", "outcome"))
+TELEGRAM_REQUESTS = counter("pizero_telegram_requests_total", "Telegram Bot API calls by method and result.",
+                            labels=("method", "result"))
+POSTPROCESS_JOBS = counter("pizero_postprocess_jobs_total", "Post-processing jobs by stage and result.",
+                           labels=("stage", "result"))
+
+
+def stage_timer(stage):
+    """with stage_timer("jpeg_encode"): ... records the block's duration under that stage."""
+    return STAGE_SECONDS.labels(stage).time()
+
+
+# --- Process stats, read at scrape time ---
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def _resident_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+_process_started = time.time()
+counter_callback("process_cpu_seconds_total", "User and system CPU time of the process.",
+                 lambda: sum(os.times()[:2]))
+gauge_callback("process_resident_memory_bytes", "Resident memory of the process.", _resident_bytes)
+gauge_callback("process_open_fds", "Open file descriptors.", _open_fds)
+gauge_callback("process_threads", "Python threads.", threading.active_count)
+gauge_callback("process_start_time_seconds", "Start time of the process, unix seconds.", lambda: _process_started)
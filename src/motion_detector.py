@@ -0,0 +1,107 @@
+import threading
+import time
+import numpy as np
+
+
+class MotionDetector:
+    """Software motion detector working on lores luma (Y plane) frames.
+
+    The frame is downscaled by plain striding, compared against a running
+    average background and thresholded. A frame counts as motion when the
+    changed pixels inside the ROI cover at least min_area of it. Changes
+    covering more than max_area are treated as a lighting change (lights on,
+    clouds) and the background is reset instead. All buffers are allocated
+    on the first frame, after that a frame costs a handful of numpy passes
+    over a few thousand pixels.
+    """
+
+    def __init__(self, downscale=4, alpha=0.05, threshold=25, min_area=0.01, max_area=0.8,
+                 roi=None, hold_seconds=1.0):
+        self.downscale = downscale
+        self.alpha = alpha              # Background learning rate
+        self.threshold = threshold      # Luma difference counted as "changed"
+        self.min_area = min_area        # Fraction of the ROI that must change
+        self.max_area = max_area
+        self.roi = roi                  # List of (x0, y0, x1, y1) in 0..1 coordinates, None = whole frame
+        self.hold_seconds = hold_seconds
+        self.last_score = 0.0
+        self.last_motion_time = None
+        self.frames_processed = 0
+        self.when_motion = None # Optional callback, called from process() when motion starts
+        self._motion_event = threading.Event()
+        self._background = None
+        self._frame = None
+        self._diff = None
+        self._absdiff = None
+        self._mask = None
+        self._roi_mask = None
+        self._roi_pixels = 0
+
+    def _allocate(self, shape):
+        self._background = np.empty(shape, dtype=np.float32)
+        self._frame = np.empty(shape, dtype=np.float32)
+        self._diff = np.empty(shape, dtype=np.float32)
+        self._absdiff = np.empty(shape, dtype=np.float32)
+        self._mask = np.empty(shape, dtype=bool)
+        self._roi_mask = None
+        if self.roi:
+            height, width = shape
+            self._roi_mask = np.zeros(shape, dtype=bool)
+            for x0, y0, x1, y1 in self.roi:
+                self._roi_mask[int(y0 * height):int(y1 * height), int(x0 * width):int(x1 * width)] = True
+        self._roi_pixels = int(self._roi_mask.sum()) if self._roi_mask is not None else shape[0] * shape[1]
+
+    def reset(self):
+        self._background = None
+
+    def process(self, luma):
+        """Feeds one luma frame (2D uint8 array, may be a view). Returns True if it shows motion."""
+        small = luma[::self.downscale, ::self.downscale]
+        if self._background is None or self._background.shape != small.shape:
+            self._allocate(small.shape)
+            np.copyto(self._background, small, casting="unsafe")
+            return False
+
+        np.copyto(self._frame, small, casting="unsafe")
+        np.subtract(self._frame, self._background, out=self._diff)
+        np.abs(self._diff, out=self._absdiff)
+        np.greater(self._absdiff, self.threshold, out=self._mask)
+        if self._roi_mask is not None:
+            np.logical_and(self._mask, self._roi_mask, out=self._mask)
+        changed = np.count_nonzero(self._mask) / max(self._roi_pixels, 1)
+        self.last_score = changed
+        self.frames_processed += 1
+
+        if changed > self.max_area:
+            # Global brightness change, start learning the new scene from here
+            np.copyto(self._background, self._frame)
+            return False
+
+        # background += alpha * (frame - background), ten times slower where something is moving
+        # so a passing subject does not leave a ghost behind. No temporaries are allocated.
+        self._diff *= self.alpha
+        np.multiply(self._diff, 0.1, out=self._diff, where=self._mask)
+        self._background += self._diff
+
+        if changed >= self.min_area:
+            started = not self.motion_detected
+            self.last_motion_time = time.monotonic()
+            self._motion_event.set()
+            if started and self.when_motion is not None:
+                self.when_motion()
+            return True
+        return False
+
+    @property
+    def motion_detected(self):
+        # True while the last motion frame is less than hold_seconds old
+        if self.last_motion_time is None:
+            return False
+        return time.monotonic() - self.last_motion_time < self.hold_seconds
+
+    def wait_for_motion(self, timeout):
+        """Blocks until a frame shows motion (or timeout). Returns True on motion."""
+        if self.motion_detected:
+            return True
+        self._motion_event.clear()
+        return self._motion_event.wait(timeout)
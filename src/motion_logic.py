@@ -1,39 +1,226 @@
-from gpiozero import MotionSensor
+import threading
 import time
+import config
 from config import PIR_PIN_BCM
+from startup import STARTUP, STARTING, READY, FAILED, DISABLED
+
+# How long the camera gets to confirm a PIR trigger when MOTION_DETECTOR_MODE is "confirm"
+MOTION_CONFIRM_SECONDS = getattr(config, "MOTION_CONFIRM_SECONDS", 2)
+PIR_SETTLE_SECONDS = getattr(config, "PIR_SETTLE_SECONDS", 30)        # PIR warm-up, its triggers are ignored meanwhile
+PIR_DEBOUNCE_SECONDS = getattr(config, "PIR_DEBOUNCE_SECONDS", 0.2)   # A PIR pulse must last this long to count
+PIR_SAMPLE_RATE = getattr(config, "PIR_SAMPLE_RATE", 50)              # gpiozero samples the pin this often (Hz)
+MOTION_HOLDOFF_SECONDS = getattr(config, "MOTION_HOLDOFF_SECONDS", 10) # Quiet time after an event before the next one
+RETRIGGER_GRACE_SECONDS = 1.0 # A trigger edge keeps the recording going this long even if the pin is low again
+
+
+class MotionTrigger:
+    """Turns PIR and camera motion callbacks into recordings.
+
+    gpiozero's when_motion/when_no_motion and the software detector's
+    when_motion only note the trigger and wake the engine thread, which
+    runs this state machine:
+
+        settling   PIR warm-up after start; PIR triggers are ignored
+        idle       waiting for a trigger
+        debounce   the PIR must still be active after debounce_seconds
+        confirming ("confirm" mode) the camera has confirm_seconds to agree
+        recording  record_motion_video() runs; any new trigger extends it
+        holdoff    after an event; a trigger now is remembered and starts
+                   the next event when the hold-off ends, if motion is
+                   still present
+
+    Nothing polls the pin, so a trigger is handled as soon as its callback
+    fires, and detection keeps running while the live stream is on. The
+    time from the trigger edge to the first frame going into the file is
+    recorded for every event.
+    """
+
+    def __init__(self, cam_manager, pir_pin=None, pin_factory=None, mode="off", settle_seconds=PIR_SETTLE_SECONDS,
+                 debounce_seconds=PIR_DEBOUNCE_SECONDS, holdoff_seconds=MOTION_HOLDOFF_SECONDS,
+                 confirm_seconds=MOTION_CONFIRM_SECONDS, sample_rate=PIR_SAMPLE_RATE):
+        self.cam_manager = cam_manager
+        self.detector = cam_manager.motion_detector if mode != "off" else None
+        self.mode = mode if self.detector is not None else "off"
+        self.debounce_seconds = debounce_seconds
+        self.holdoff_seconds = holdoff_seconds
+        self.confirm_seconds = confirm_seconds
+        self.state = "idle"
+        self._cond = threading.Condition()
+        self._pending = None # (source, trigger time) of a trigger not handled yet
+        self._last_edge = 0.0
+        self._settle_until = 0.0
+        self._holdoff_until = 0.0
+        self._stopped = False
+        self._latencies = []
+        self.counts = {"triggers": 0, "recordings": 0, "recording_failures": 0, "retriggers": 0, "ignored_settling": 0,
+                       "ignored_debounce": 0, "ignored_unconfirmed": 0, "ignored_holdoff": 0}
+
+        self.pir = None
+        if pir_pin is not None:
+            from gpiozero import MotionSensor # Imported in the motion thread, not at server start
+            self.pir = MotionSensor(pir_pin, sample_rate=sample_rate, pin_factory=pin_factory)
+            self.pir.when_motion = self._on_pir_motion
+            self.pir.when_no_motion = self._on_pir_no_motion
+            self._settle_until = time.monotonic() + settle_seconds
+            self.state = "settling" if settle_seconds > 0 else "idle"
+        STARTUP.set("motion", STARTING if self.state == "settling" else READY, self._describe())
+        if self.detector is not None:
+            self.detector.when_motion = self._on_camera_motion
+
+    def _describe(self):
+        sources = (["PIR"] if self.pir is not None else []) + ([f"camera ({self.mode})"] if self.detector else [])
+        return ", ".join(sources)
+
+    # --- Callbacks (gpiozero's and the capture thread) ---
+
+    def _trigger(self, source):
+        now = time.monotonic()
+        with self._cond:
+            self._last_edge = now
+            self.counts["triggers"] += 1
+            if self.state == "recording":
+                self.counts["retriggers"] += 1 # Extends the running event through motion_active()
+            elif self._pending is None:
+                self._pending = (source, now)
+            self._cond.notify_all()
+
+    def _on_pir_motion(self):
+        self._trigger("PIR sensor")
+
+    def _on_pir_no_motion(self):
+        with self._cond:
+            self._cond.notify_all() # Ends a debounce wait early
+
+    def _on_camera_motion(self):
+        if self.mode == "standalone":
+            self._trigger("camera")
+
+    # --- Engine ---
+
+    def motion_active(self):
+        # Recording keeps going while either sensor still sees motion, or right after a trigger edge
+        return ((self.pir is not None and self.pir.motion_detected)
+                or (self.detector is not None and self.detector.motion_detected)
+                or time.monotonic() - self._last_edge < RETRIGGER_GRACE_SECONDS)
+
+    def _wait_until(self, deadline, predicate=lambda: False):
+        # Waits on the condition (held) until deadline or predicate() is true. Returns predicate().
+        while not predicate() and not self._stopped:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._cond.wait(remaining)
+        return predicate()
+
+    def _next_trigger(self):
+        # Blocks until a trigger passes settling, debounce and hold-off. Returns (source, trigger time).
+        with self._cond:
+            while not self._stopped:
+                if self.state == "settling" and time.monotonic() >= self._settle_until:
+                    self.state = "idle"
+                    STARTUP.set("motion", READY, self._describe())
+                    print("PIR sensor settled. Monitoring for motion.")
+                if self._pending is None:
+                    timeout = self._settle_until - time.monotonic() if self.state == "settling" else None
+                    self._cond.wait(timeout)
+                    continue
+                source, triggered_at = self._pending
+                self._pending = None
+                if source == "PIR sensor":
+                    if triggered_at < self._settle_until:
+                        self.counts["ignored_settling"] += 1
+                        continue
+                    self.state = "debounce"
+                    released = self._wait_until(triggered_at + self.debounce_seconds,
+                                                lambda: not self.pir.is_active)
+                    self.state = "idle"
+                    if released:
+                        self.counts["ignored_debounce"] += 1
+                        continue
+                if time.monotonic() < self._holdoff_until:
+                    self.state = "holdoff"
+                    self._wait_until(self._holdoff_until)
+                    self.state = "idle"
+                    if not self.motion_active():
+                        self.counts["ignored_holdoff"] += 1
+                        continue
+                return source, triggered_at
+        return None, None
+
+    def run(self):
+        if self.pir is not None and self.state == "settling":
+            print(f"Allowing the PIR sensor {self._settle_until - time.monotonic():.0f}s to settle...")
+        while not self._stopped:
+            source, triggered_at = self._next_trigger()
+            if source is None:
+                break
+            if source == "PIR sensor" and self.mode == "confirm":
+                self.state = "confirming"
+                if not self.detector.wait_for_motion(self.confirm_seconds):
+                    print(f"PIR trigger not confirmed by the camera (score {self.detector.last_score:.3f}), ignoring it.")
+                    self.counts["ignored_unconfirmed"] += 1
+                    self.state = "idle"
+                    continue
+
+            print(f"Motion detected by {source} at {time.strftime('%Y-%m-%d %H:%M:%S')}!")
+            self.state = "recording"
+
+            def on_started():
+                latency = time.monotonic() - triggered_at
+                self._latencies = (self._latencies + [latency])[-100:]
+                print(f"Trigger to record latency: {latency * 1000:.0f} ms")
+
+            try:
+                recorded = self.cam_manager.record_motion_video(motion_active=self.motion_active, on_started=on_started)
+            except Exception as e:
+                print(f"Error recording motion event: {e}")
+                recorded = None
+            # None when the camera or the encoder was not available
+            self.counts["recordings" if recorded is not None else "recording_failures"] += 1
+            with self._cond:
+                self._holdoff_until = time.monotonic() + self.holdoff_seconds
+                self._pending = None # Triggers during the recording already extended it
+                self.state = "idle"
+            print(f"Motion event processed. Next event possible in {self.holdoff_seconds}s.")
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self.pir is not None:
+            self.pir.close()
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        return {
+            "state": self.state,
+            "mode": self.mode,
+            **self.counts,
+            "latency_ms_last": round(self._latencies[-1] * 1000) if latencies else None,
+            "latency_ms_median": round(latencies[len(latencies) // 2] * 1000) if latencies else None,
+            "latency_ms_max": round(latencies[-1] * 1000) if latencies else None,
+        }
+
 
 def check_for_motion(cam_manager):
-    
-    if PIR_PIN_BCM is None:
+    mode = cam_manager.motion_detector_mode if cam_manager.motion_detector is not None else "off"
+
+    if PIR_PIN_BCM is None and mode != "standalone":
         print("Error: PIR\_PIN\_BCM not defined in config.py. Motion detection disabled.")
+        STARTUP.set("motion", DISABLED, "PIR_PIN_BCM not set")
         return
 
     try:
-        # Initialize the PIR sensor using gpiozero with the BCM pin number
-        pir = MotionSensor(PIR_PIN_BCM)
-        print(f"Motion detection started on GPIO (BCM) pin {PIR_PIN_BCM}...")
-        print("Allowing sensor to settle for 30 seconds...")
-        time.sleep(30) # Allow PIR sensor to settle
-        print("Sensor settled. Monitoring for motion.")
-
-        while True:
-            if cam_manager.stream_active:
-                time.sleep(5)
-                continue 
-            if pir.motion_detected:
-                print(f"Motion detected by PIR sensor at {time.strftime('%Y-%m-%d %H:%M:%S')}!")
-                # Call the record_motion_video method of the passed CameraManager instance
-                cam_manager.record_motion_video()
-        
-                print("Motion event processed. Cooldown period starting (e.g., 60 seconds).")
-                # Wait for motion to stop before starting the next check cycle
-                pir.wait_for_no_motion()
-                print("Motion has stopped. Applying additional cooldown.")
-                time.sleep(30) # Additional 30s cooldown after motion stops
-                print("Cooldown finished. Resuming motion monitoring.")
-    
-            # Short sleep to prevent the loop from using 100% CPU if you remove the blocking waits
-            time.sleep(0.1)
+        if mode != "off" and not cam_manager.start_motion_detector():
+            mode = "off"
+            if PIR_PIN_BCM is None:
+                STARTUP.set("motion", FAILED, "camera motion detector could not start")
+                return
+        trigger = MotionTrigger(cam_manager, pir_pin=PIR_PIN_BCM, mode=mode)
+        cam_manager.motion_trigger = trigger
+        if PIR_PIN_BCM is not None:
+            print(f"Motion detection started on GPIO (BCM) pin {PIR_PIN_BCM}...")
+        trigger.run()
     except Exception as e:
         print(f"Error in motion detection loop: {e}")
-    
\ No newline at end of file
+        STARTUP.set("motion", FAILED, str(e))
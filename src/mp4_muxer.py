@@ -0,0 +1,95 @@
+import os
+from fractions import Fraction
+
+TIMESTAMP_BASE = Fraction(1, 1_000_000) # picamera2 encoder timestamps are in microseconds
+
+
+class Mp4Muxer:
+    """Muxes encoded H.264 frames into an MP4 file while they are recorded.
+
+    Packets are taken as they come out of the encoder, no .h264 intermediate
+    and no re-encoding. Timestamps are the encoder's frame timestamps, rebased
+    so the file starts at 0. The moov atom is moved to the front on close
+    (faststart) so browsers can start playing before downloading the file.
+
+    It also keeps one keyframe around (the last one up to thumbnail_delay
+    seconds after the trigger) so the thumbnail can be decoded in process
+    without reading the file back.
+    """
+
+    def __init__(self, filepath, size, framerate, thumbnail_delay=1.0):
+        import av # Deferred, PyAV is slow to import and only needed once something is recorded
+        self.filepath = filepath
+        self.container = av.open(filepath, "w", format="mp4", options={"movflags": "+faststart"})
+        self.stream = self.container.add_stream("h264", rate=framerate)
+        self.stream.width, self.stream.height = size
+        self.stream.time_base = TIMESTAMP_BASE
+        self.thumbnail_delay_us = int(thumbnail_delay * 1_000_000)
+        self.thumbnail_keyframe = None
+        self.frames_written = 0
+        self._first_timestamp = None
+        self._live_timestamp = None
+        self._last_pts = -1
+
+    def mark_live(self, timestamp):
+        # Called once the pre-roll is flushed, the thumbnail is chosen relative to this point
+        self._live_timestamp = timestamp
+
+    def write(self, frame, keyframe, timestamp):
+        if self._first_timestamp is None:
+            self._first_timestamp = timestamp
+        pts = timestamp - self._first_timestamp
+        if pts <= self._last_pts:
+            pts = self._last_pts + 1 # Timestamps must increase strictly for the mp4 muxer
+        self._last_pts = pts
+
+        import av
+        packet = av.Packet(bytes(frame))
+        packet.pts = packet.dts = pts
+        packet.time_base = TIMESTAMP_BASE
+        packet.is_keyframe = keyframe
+        packet.stream = self.stream
+        self.container.mux(packet)
+        self.frames_written += 1
+
+        if keyframe:
+            live = self._live_timestamp if self._live_timestamp is not None else self._first_timestamp
+            if self.thumbnail_keyframe is None or timestamp - live <= self.thumbnail_delay_us:
+                self.thumbnail_keyframe = bytes(frame)
+
+    def close(self):
+        self.container.close()
+
+    @property
+    def preroll_seconds(self):
+        # Footage in the file from before mark_live(), i.e. where the trigger is in the clip
+        if self._live_timestamp is None or self._first_timestamp is None:
+            return 0.0
+        return max(0, self._live_timestamp - self._first_timestamp) / 1_000_000
+
+    @property
+    def duration(self):
+        return max(self._last_pts, 0) / 1_000_000
+
+
+def save_keyframe_thumbnail(keyframe, thumbnail_fullpath, width=320):
+    """Decodes a single H.264 keyframe (with its SPS/PPS headers) and saves it as a JPEG."""
+    if not keyframe:
+        return None
+    try:
+        import av
+        codec = av.CodecContext.create("h264", "r")
+        frames = list(codec.decode(av.Packet(keyframe)))
+        frames += list(codec.decode(None)) # Flush, the decoder may hold the frame back
+        if not frames:
+            print(f"Thumbnail: keyframe could not be decoded for {thumbnail_fullpath}")
+            return None
+        frame = frames[0]
+        height = max(2, round(frame.height * width / frame.width / 2) * 2)
+        os.makedirs(os.path.dirname(thumbnail_fullpath), exist_ok=True)
+        frame.to_image(width=width, height=height).save(thumbnail_fullpath, quality=85)
+        print(f"Thumbnail generated successfully: {thumbnail_fullpath}")
+        return thumbnail_fullpath
+    except Exception as e:
+        print(f"An unexpected error occurred during thumbnail generation: {e}")
+        return None
@@ -1,102 +1,835 @@
 import sqlite3
 import os
+import shutil
+import threading
+import time
 from datetime import datetime
+import config
+from metrics import stage_timer
 
-DB_FILE = 'security_camera_events.db'
+# Kept with the recordings it indexes, not in the source tree, whatever directory the app is started from
+DB_FILE = getattr(config, "DB_FILE", os.path.join(os.path.abspath(config.EVENTS_STORAGE_DIR), 'security_camera_events.db'))
+# Where the default used to be, moved to DB_FILE on first use
+LEGACY_DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'security_camera_events.db')
+
+SCHEMA_VERSION = 8
+LEGACY_TIMESTAMP_FORMAT = "%m-%d-%Y_%H:%M" # event_timestamp format before schema version 2
+# With a hub configured, every change to video_events is queued in replication_outbox (see replication.py)
+REPLICATION_OUTBOX = bool(getattr(config, "HUB_URL", None))
+
+_local = threading.local()
+_db_dir_lock = threading.Lock()
+_db_dir_ready = False
+
+def get_events_version():
+    """Returns (version, last_modified) of the video_events and hub_events tables.
+
+    Kept in events_changes by triggers, so it counts changes made by any process:
+    the background worker, export_events --mark or another connection of this one.
+    """
+    row = get_connection().execute("SELECT version, modified_at FROM events_changes WHERE id = 1;").fetchone()
+    return row["version"], row["modified_at"]
+
+def _prepare_db_dir():
+    # Once per process, before the first connection: creates DB_FILE's directory and moves a database
+    # left in the package directory by an older version there, with its WAL files
+    global _db_dir_ready
+    with _db_dir_lock:
+        if _db_dir_ready:
+            return
+        os.makedirs(os.path.dirname(DB_FILE) or ".", exist_ok=True)
+        if not hasattr(config, "DB_FILE") and os.path.exists(LEGACY_DB_FILE) and not os.path.exists(DB_FILE):
+            for suffix in ("-wal", "-shm", ""): # The database file last, it is what the check above looks for
+                if os.path.exists(LEGACY_DB_FILE + suffix):
+                    shutil.move(LEGACY_DB_FILE + suffix, DB_FILE + suffix)
+            print(f"Moved the events database from {LEGACY_DB_FILE} to {DB_FILE}.")
+        _db_dir_ready = True
+
+def get_connection():
+    """Returns this thread's long-lived connection to the events database (WAL mode)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        _prepare_db_dir()
+        conn = sqlite3.connect(DB_FILE, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL;")   # Readers never block the writer
+        conn.execute("PRAGMA synchronous=NORMAL;") # Safe with WAL, avoids an fsync per insert
+        _local.conn = conn
+    return conn
 
 def init_db():
     create_video_events_table()
+    migrate_db()
 
 def create_video_events_table():
     query = """
     CREATE TABLE IF NOT EXISTS video_events (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        event_timestamp TEXT NOT NULL, -- Storing your custom formatted string
+        event_timestamp TEXT NOT NULL, -- ISO-8601 local time, e.g. 2025-06-08T14:03:20
         event_type TEXT DEFAULT 'motion_detected',
         h264_filepath TEXT UNIQUE,
-        mp4_filepath TEXT UNIQUE,    
+        mp4_filepath TEXT UNIQUE,
         thumbnail_path TEXT UNIQUE,
-        notes TEXT, 
+        notes TEXT,
         is_archived INTEGER DEFAULT 0,
         db_record_created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     );
     """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(query)
-            conn.commit()
-            print(f"Table 'video_events' (simplified) ensured to exist in '{DB_FILE}'.")
+        conn = get_connection()
+        with conn:
+            conn.execute(query)
+        print(f"Table 'video_events' (simplified) ensured to exist in '{DB_FILE}'.")
     except sqlite3.Error as e:
         print(f"Error creating 'video_events' table: {e}")
 
-def record_new_video_event(event_type, h264_path, mp4_path, thumbnail_path, notes_str):
-    """Inserts a new video event into the database with a custom formatted timestamp."""
+def _column_names(conn, table):
+    return {row["name"] for row in conn.execute(f"PRAGMA table_info({table});")}
+
+def migrate_db():
+    """Brings an existing database up to SCHEMA_VERSION, tracked in PRAGMA user_version."""
+    conn = get_connection()
+    version = conn.execute("PRAGMA user_version;").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    try:
+        with conn:
+            if version < 2:
+                # v2: sortable timestamps. Adds event_ts (unix seconds, indexed) and rewrites
+                # event_timestamp from "MM-DD-YYYY_HH:MM" to ISO-8601.
+                if "event_ts" not in _column_names(conn, "video_events"):
+                    conn.execute("ALTER TABLE video_events ADD COLUMN event_ts INTEGER;")
+                updates = []
+                for row in conn.execute("SELECT id, event_timestamp, db_record_created_at FROM video_events "
+                                        "WHERE event_ts IS NULL;"):
+                    try:
+                        event_time = datetime.strptime(row["event_timestamp"], LEGACY_TIMESTAMP_FORMAT)
+                    except (TypeError, ValueError):
+                        # Unparseable, fall back to when the row was written
+                        try:
+                            event_time = datetime.fromisoformat(row["db_record_created_at"])
+                        except (TypeError, ValueError):
+                            event_time = datetime.now()
+                    updates.append((int(event_time.timestamp()), event_time.isoformat(timespec="seconds"), row["id"]))
+                conn.executemany("UPDATE video_events SET event_ts = ?, event_timestamp = ? WHERE id = ?;", updates)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_video_events_ts ON video_events (event_ts, id);")
+                print(f"Database migrated to version 2, {len(updates)} event timestamp(s) converted.")
+            if version < 3:
+                # v3: index for filtering by type within a time range
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_video_events_type_ts ON video_events (event_type, event_ts, id);")
+            if version < 4:
+                # v4: exported_at (unix seconds) for events copied off the device by an export; retention
+                # evicts those first, through the partial index
+                if "exported_at" not in _column_names(conn, "video_events"):
+                    conn.execute("ALTER TABLE video_events ADD COLUMN exported_at INTEGER;")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_video_events_exported ON video_events (event_ts, id) "
+                             "WHERE exported_at IS NOT NULL;")
+            if version < 5:
+                # v5: continuous recording. Segment files with their keyframe index, and events that point
+                # into them by wall-clock range (clip_start, clip_end) instead of having their own file.
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS video_segments (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        filepath TEXT UNIQUE NOT NULL,
+                        start_ts REAL NOT NULL, -- unix seconds of the first frame
+                        end_ts REAL,            -- NULL while the segment is being written
+                        size_bytes INTEGER
+                    );""")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_video_segments_start ON video_segments (start_ts);")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS segment_keyframes (
+                        segment_id INTEGER NOT NULL,
+                        ts REAL NOT NULL,            -- unix seconds
+                        byte_offset INTEGER NOT NULL, -- of the fragment (moof) the keyframe starts
+                        PRIMARY KEY (segment_id, ts)
+                    ) WITHOUT ROWID;""")
+                columns = _column_names(conn, "video_events")
+                for column in ("clip_start", "clip_end"):
+                    if column not in columns:
+                        conn.execute(f"ALTER TABLE video_events ADD COLUMN {column} REAL;")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_video_events_clip ON video_events (clip_start) "
+                             "WHERE clip_start IS NOT NULL;")
+                # Archived pointer events keep their segments from being evicted
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_video_events_archived_clip ON video_events (clip_start) "
+                             "WHERE is_archived = 1 AND clip_start IS NOT NULL;")
+            if version < 6:
+                # v6: multi-node replication. On a node, the outbox of event changes still to be pushed
+                # to the hub; on the hub, the nodes and the events they pushed (see hub.py).
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS replication_outbox (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        op TEXT NOT NULL, -- 'upsert' or 'delete'
+                        event_id INTEGER NOT NULL,
+                        created_at REAL NOT NULL
+                    );""")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS hub_nodes (
+                        node_id TEXT PRIMARY KEY,
+                        node_url TEXT NOT NULL,
+                        last_seen REAL,
+                        ops_received INTEGER NOT NULL DEFAULT 0
+                    );""")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS hub_events (
+                        node_id TEXT NOT NULL,
+                        remote_id INTEGER NOT NULL, -- id in the node's video_events
+                        event_ts INTEGER NOT NULL,
+                        event_timestamp TEXT NOT NULL,
+                        event_type TEXT,
+                        notes TEXT,
+                        is_archived INTEGER DEFAULT 0,
+                        clip_start REAL,
+                        clip_end REAL,
+                        video_path TEXT,     -- URL path of the video on the node, fetched on demand
+                        thumbnail_path TEXT, -- local copy
+                        received_at REAL NOT NULL,
+                        PRIMARY KEY (node_id, remote_id)
+                    ) WITHOUT ROWID;""")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_hub_events_ts ON hub_events (event_ts, node_id, remote_id);")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_hub_events_type_ts ON hub_events "
+                             "(event_type, event_ts, node_id, remote_id);")
+            if version < 7:
+                # v7: activity summary from recording (see event_activity.py) and near-duplicate grouping
+                columns = _column_names(conn, "video_events")
+                for column, column_type in (("activity", "TEXT"), ("sprite_path", "TEXT"),
+                                            ("activity_hash", "INTEGER"), ("duplicate_of", "INTEGER")):
+                    if column not in columns:
+                        conn.execute(f"ALTER TABLE video_events ADD COLUMN {column} {column_type};")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_video_events_duplicate_of ON video_events (duplicate_of) "
+                             "WHERE duplicate_of IS NOT NULL;")
+            if version < 8:
+                # v8: a change counter kept by triggers, lets callers cache query results across processes
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS events_changes (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        version INTEGER NOT NULL,
+                        modified_at REAL NOT NULL -- unix seconds
+                    );""")
+                conn.execute("INSERT OR IGNORE INTO events_changes (id, version, modified_at) VALUES (1, 0, ?);",
+                             (time.time(),))
+                for table in ("video_events", "hub_events"):
+                    for op in ("INSERT", "UPDATE", "DELETE"):
+                        conn.execute(f"""
+                            CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_changed AFTER {op} ON {table}
+                            BEGIN
+                                UPDATE events_changes SET version = version + 1,
+                                    modified_at = (julianday('now') - 2440587.5) * 86400.0 WHERE id = 1;
+                            END;""")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+    except sqlite3.Error as e:
+        print(f"Error migrating the events database: {e}")
+
+def _queue_replication(conn, op, event_ids):
+    # In the caller's transaction, so a change and its outbox entry are committed together
+    if REPLICATION_OUTBOX and event_ids:
+        now = time.time()
+        conn.executemany("INSERT INTO replication_outbox (op, event_id, created_at) VALUES (?, ?, ?);",
+                         [(op, event_id, now) for event_id in event_ids])
+
+def _find_duplicate_head(conn, event_time, activity_hash):
+    # The first event of a recent group whose motion was in the same places, None if there is none
+    from event_activity import DUPLICATE_WINDOW_SECONDS, DUPLICATE_MAX_DISTANCE, hash_distance
+    if activity_hash is None:
+        return None
+    rows = conn.execute("SELECT id, activity_hash, duplicate_of FROM video_events "
+                        "WHERE event_ts >= ? AND event_ts <= ? AND activity_hash IS NOT NULL "
+                        "ORDER BY event_ts DESC, id DESC LIMIT 20;",
+                        (int(event_time - DUPLICATE_WINDOW_SECONDS), int(event_time))).fetchall()
+    for row in rows:
+        if hash_distance(row["activity_hash"], activity_hash) <= DUPLICATE_MAX_DISTANCE:
+            return row["duplicate_of"] or row["id"]
+    return None
+
+def record_new_video_event(event_type, h264_path, mp4_path, thumbnail_path, notes_str, event_time=None,
+                           clip_start=None, clip_end=None, activity=None, sprite_path=None, activity_hash=None):
+    """Inserts a new video event. event_time is a unix timestamp of when it happened (default: now).
+
+    With continuous recording the event has no file of its own: mp4_path is None and
+    clip_start / clip_end (unix seconds) say which part of the segments it covers.
+    activity, sprite_path and activity_hash come from the event's ActivityTracker; an
+    event whose activity hash is close to one recorded shortly before is grouped with it
+    (duplicate_of is the first event of the group).
+    """
     query = """
-    INSERT INTO video_events 
-        (event_type, h264_filepath, mp4_filepath, thumbnail_path, notes, event_timestamp)
-    VALUES (?, ?, ?, ?, ?, ?);
+    INSERT INTO video_events
+        (event_type, h264_filepath, mp4_filepath, thumbnail_path, notes, event_timestamp, event_ts, clip_start, clip_end,
+         activity, sprite_path, activity_hash, duplicate_of)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
     """
-    # Using your custom format for event_timestamp
-    current_event_time_str = datetime.now().strftime("%m-%d-%Y_%H:%M")
+    if event_time is None:
+        event_time = time.time()
+    event_datetime = datetime.fromtimestamp(event_time)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, (
+        conn = get_connection()
+        with stage_timer("db_insert"), conn:
+            duplicate_of = _find_duplicate_head(conn, event_time, activity_hash)
+            cursor = conn.execute(query, (
                 event_type,
                 h264_path,
                 mp4_path,
                 thumbnail_path,
                 notes_str,
-                current_event_time_str # Storing the custom formatted string
+                event_datetime.isoformat(timespec="seconds"),
+                int(event_time),
+                clip_start,
+                clip_end,
+                activity,
+                sprite_path,
+                activity_hash,
+                duplicate_of
             ))
-            conn.commit()
-            new_id = cursor.lastrowid
-            print(f"New video event recorded in DB. ID: {new_id}, MP4: {mp4_path}")
-            return new_id
+            _queue_replication(conn, "upsert", [cursor.lastrowid])
+        new_id = cursor.lastrowid
+        print(f"New video event recorded in DB. ID: {new_id}, MP4: {mp4_path or f'segments {clip_start:.0f}-{clip_end:.0f}'}")
+        return new_id
     except sqlite3.Error as e:
         print(f"Error inserting video event for '{mp4_path}': {e}")
         if "UNIQUE constraint failed" in str(e):
             print("This might be due to attempting to insert a duplicate filepath.")
         return None
 
-def get_video_events(limit=20, offset=0, sort_by="event_timestamp", sort_order="DESC"):
-    """Fetches video events from the database (simplified columns)."""
-    allowed_sort_columns = ["id", "event_timestamp", "event_type", "db_record_created_at"]
-    if sort_by not in allowed_sort_columns:
-        sort_by = "event_timestamp" 
-    
-    if sort_order.upper() not in ["ASC", "DESC"]:
-        sort_order = "DESC"
-
-    query = f"""
-    SELECT id, event_timestamp, event_type, h264_filepath, mp4_filepath, thumbnail_path, notes, is_archived
-    FROM video_events
-    ORDER BY {sort_by} {sort_order}
-    LIMIT ? OFFSET ?;
+def encode_cursor(event):
+    # Keyset pagination cursor: position of an event in (event_ts, id) order
+    return f"{event['event_ts']}_{event['id']}"
+
+def decode_cursor(cursor):
+    try:
+        event_ts, event_id = cursor.split("_")
+        return int(event_ts), int(event_id)
+    except (AttributeError, ValueError):
+        return None
+
+def _event_dict(row):
+    event_dict = dict(row)
+    event_dict['cursor'] = encode_cursor(event_dict)
+    # Pre-formatted display string, "HH:MM" from the ISO-8601 timestamp
+    if event_dict.get('event_timestamp'):
+        event_dict['display_time_only'] = event_dict['event_timestamp'][11:16] or event_dict['event_timestamp']
+    else:
+        event_dict['display_time_only'] = 'N/A'
+    return event_dict
+
+EVENT_COLUMNS = ("id, event_ts, event_timestamp, event_type, h264_filepath, mp4_filepath, thumbnail_path, notes, "
+                 "is_archived, exported_at, clip_start, clip_end, activity, sprite_path, duplicate_of")
+
+def _filters(since=None, until=None, event_type=None, grouped=False):
+    # WHERE clauses and parameters shared by the event queries. since/until are unix seconds,
+    # grouped leaves out the near-duplicates of other events.
+    clauses, params = [], []
+    if grouped:
+        clauses.append("duplicate_of IS NULL")
+    if since is not None:
+        clauses.append("event_ts >= ?")
+        params.append(int(since))
+    if until is not None:
+        clauses.append("event_ts < ?")
+        params.append(int(until))
+    if event_type:
+        clauses.append("event_type = ?")
+        params.append(event_type)
+    return clauses, params
+
+def get_video_events(limit=20, before=None, after=None, since=None, until=None, event_type=None, grouped=False):
+    """Fetches video events, newest first, using keyset pagination.
+
+    before / after are cursors (see encode_cursor): return the events older
+    than / newer than that position. The query walks the (event_ts, id)
+    index, so it costs the same however deep the page is. since / until
+    (unix seconds) and event_type narrow the results down; grouped=True
+    lists only the first event of each group of near-duplicates.
     """
     events = []
+    clauses, params = _filters(since, until, event_type, grouped)
+    order = "DESC"
+    if after:
+        clauses.append("(event_ts, id) > (?, ?)")
+        params.extend(decode_cursor(after) or (0, 0))
+        order = "ASC"
+    elif before:
+        clauses.append("(event_ts, id) < (?, ?)")
+        params.extend(decode_cursor(before) or (0, 0))
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    query = f"SELECT {EVENT_COLUMNS} FROM video_events {where} ORDER BY event_ts {order}, id {order} LIMIT ?;"
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(query, (limit, offset))
-            results = cursor.fetchall()
-            for row in results:
-                event_dict = dict(row)
-                # You can add pre-formatted display strings here if needed,
-                # or handle formatting directly in Jinja.
-                # For example, to get just the time part from "MM-DD-YYYY_HH:MM":
-                if event_dict.get('event_timestamp'):
-                    try:
-                        event_dict['display_time_only'] = event_dict['event_timestamp'].split('_')[1]
-                    except IndexError:
-                        event_dict['display_time_only'] = event_dict['event_timestamp'] # fallback
-                else:
-                    event_dict['display_time_only'] = 'N/A'
-                events.append(event_dict)
-        print(f"Fetched {len(events)} events. Limit: {limit}, Offset: {offset}, Sort: {sort_by} {sort_order}")
+        with stage_timer("db_query"):
+            rows = get_connection().execute(query, (*params, limit)).fetchall()
+        if after:
+            rows.reverse()
+        events = [_event_dict(row) for row in rows]
+        print(f"Fetched {len(events)} events. Limit: {limit}, Before: {before}, After: {after}")
     except sqlite3.Error as e:
         print(f"Error fetching video events: {e}")
     return events
 
+def count_video_events(since=None, until=None, event_type=None, grouped=False):
+    clauses, params = _filters(since, until, event_type, grouped)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    try:
+        return get_connection().execute(f"SELECT COUNT(*) FROM video_events {where};", params).fetchone()[0]
+    except sqlite3.Error as e:
+        print(f"Error counting video events: {e}")
+        return 0
+
+def iter_video_events(since=None, until=None, event_type=None, limit=None, batch_size=100):
+    """Yields the matching events oldest first, batch_size rows per query, for walks over large ranges."""
+    clauses, params = _filters(since, until, event_type)
+    position = None
+    remaining = limit
+    while remaining is None or remaining > 0:
+        batch_clauses, batch_params = list(clauses), list(params)
+        if position is not None:
+            batch_clauses.append("(event_ts, id) > (?, ?)")
+            batch_params.extend(position)
+        where = f"WHERE {' AND '.join(batch_clauses)}" if batch_clauses else ""
+        count = batch_size if remaining is None else min(batch_size, remaining)
+        try:
+            with stage_timer("db_query"):
+                rows = get_connection().execute(
+                    f"SELECT {EVENT_COLUMNS} FROM video_events {where} ORDER BY event_ts ASC, id ASC LIMIT ?;",
+                    (*batch_params, count)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error fetching video events: {e}")
+            return
+        for row in rows:
+            yield dict(row)
+        if len(rows) < count:
+            return
+        position = (rows[-1]["event_ts"], rows[-1]["id"])
+        if remaining is not None:
+            remaining -= len(rows)
+
+def get_video_events_page(per_page, before=None, after=None, **filters):
+    """Returns (events, older_cursor, newer_cursor); a cursor is None when there is no such page."""
+    events = get_video_events(limit=per_page + 1, before=before, after=after, **filters)
+    more = len(events) > per_page
+    if after:
+        events = events[-per_page:] if more else events # The extra row is on the newer side
+        newer_cursor = events[0]['cursor'] if more and events else None
+        older_cursor = events[-1]['cursor'] if events else None
+    else:
+        events = events[:per_page]
+        older_cursor = events[-1]['cursor'] if more else None
+        newer_cursor = events[0]['cursor'] if before and events else None
+    return events, older_cursor, newer_cursor
+
+def get_eviction_candidates(limit):
+    """Oldest events that are not archived, i.e. the first to go when storage runs out.
+
+    Events that were exported come before the others, a copy of them exists off the device.
+    Events pointing into segments are left out: they have no files to free and go with their
+    segments, which retention evicts on their own (see get_oldest_evictable_segment).
+    """
+    try:
+        conn = get_connection()
+        rows = conn.execute(
+            f"SELECT {EVENT_COLUMNS} FROM video_events WHERE is_archived = 0 AND exported_at IS NOT NULL AND clip_start IS NULL "
+            f"ORDER BY event_ts ASC, id ASC LIMIT ?;", (limit,)).fetchall()
+        if len(rows) < limit:
+            rows += conn.execute(
+                f"SELECT {EVENT_COLUMNS} FROM video_events WHERE is_archived = 0 AND exported_at IS NULL AND clip_start IS NULL "
+                f"ORDER BY event_ts ASC, id ASC LIMIT ?;", (limit - len(rows),)).fetchall()
+        return [dict(row) for row in rows]
+    except sqlite3.Error as e:
+        print(f"Error fetching eviction candidates: {e}")
+        return []
+
+def count_duplicates(event_ids):
+    """{event id: number of near-duplicates grouped under it} for the given group heads."""
+    if not event_ids:
+        return {}
+    placeholders = ", ".join("?" * len(event_ids))
+    try:
+        rows = get_connection().execute(
+            f"SELECT duplicate_of, COUNT(*) FROM video_events WHERE duplicate_of IN ({placeholders}) "
+            f"GROUP BY duplicate_of;", list(event_ids)).fetchall()
+        return {row[0]: row[1] for row in rows}
+    except sqlite3.Error as e:
+        print(f"Error counting duplicates: {e}")
+        return {}
+
+def get_video_event(event_id):
+    try:
+        row = get_connection().execute(f"SELECT {EVENT_COLUMNS} FROM video_events WHERE id = ?;", (event_id,)).fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        print(f"Error fetching video event {event_id}: {e}")
+        return None
+
+def get_events_after_id(last_id, limit):
+    # For incremental sweeps over the whole table
+    try:
+        rows = get_connection().execute(
+            f"SELECT {EVENT_COLUMNS} FROM video_events WHERE id > ? ORDER BY id LIMIT ?;", (last_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+    except sqlite3.Error as e:
+        print(f"Error fetching video events after id {last_id}: {e}")
+        return []
+
+UPDATABLE_COLUMNS = ("h264_filepath", "mp4_filepath", "thumbnail_path", "notes", "is_archived")
+
+def update_video_event(event_id, **columns):
+    columns = {name: value for name, value in columns.items() if name in UPDATABLE_COLUMNS}
+    if not columns:
+        return False
+    assignments = ", ".join(f"{name} = ?" for name in columns)
+    try:
+        conn = get_connection()
+        with conn:
+            conn.execute(f"UPDATE video_events SET {assignments} WHERE id = ?;", (*columns.values(), event_id))
+            _queue_replication(conn, "upsert", [event_id])
+        return True
+    except sqlite3.Error as e:
+        print(f"Error updating video event {event_id}: {e}")
+        return False
+
+def mark_events_exported(event_ids, exported_at=None):
+    """Sets exported_at on the given events, in one transaction."""
+    if exported_at is None:
+        exported_at = time.time()
+    try:
+        conn = get_connection()
+        with conn:
+            conn.executemany("UPDATE video_events SET exported_at = ? WHERE id = ?;",
+                             [(int(exported_at), event_id) for event_id in event_ids])
+        return True
+    except sqlite3.Error as e:
+        print(f"Error marking {len(event_ids)} event(s) as exported: {e}")
+        return False
+
+def delete_video_event(event_id):
+    try:
+        conn = get_connection()
+        with conn:
+            conn.execute("DELETE FROM video_events WHERE id = ?;", (event_id,))
+            # Its near-duplicates stand on their own again
+            conn.execute("UPDATE video_events SET duplicate_of = NULL WHERE duplicate_of = ?;", (event_id,))
+            _queue_replication(conn, "delete", [event_id])
+        return True
+    except sqlite3.Error as e:
+        print(f"Error deleting video event {event_id}: {e}")
+        return False
+
+# --- Continuous recording segments (see segment_recorder.py) ---
+
+SEGMENT_COLUMNS = "id, filepath, start_ts, end_ts, size_bytes"
+
+def open_segment(filepath, start_ts):
+    try:
+        conn = get_connection()
+        with conn:
+            cursor = conn.execute("INSERT INTO video_segments (filepath, start_ts) VALUES (?, ?);", (filepath, start_ts))
+        return cursor.lastrowid
+    except sqlite3.Error as e:
+        print(f"Error recording segment '{filepath}': {e}")
+        return None
+
+def add_segment_keyframes(segment_id, keyframes):
+    # keyframes: [(ts, byte_offset), ...]
+    if segment_id is None or not keyframes:
+        return
+    try:
+        conn = get_connection()
+        with stage_timer("db_insert"), conn:
+            conn.executemany("INSERT OR REPLACE INTO segment_keyframes (segment_id, ts, byte_offset) VALUES (?, ?, ?);",
+                             [(segment_id, ts, offset) for ts, offset in keyframes])
+    except sqlite3.Error as e:
+        print(f"Error indexing {len(keyframes)} keyframe(s) of segment {segment_id}: {e}")
+
+def close_segment(segment_id, end_ts, size_bytes):
+    if segment_id is None:
+        return
+    try:
+        conn = get_connection()
+        with conn:
+            conn.execute("UPDATE video_segments SET end_ts = ?, size_bytes = ? WHERE id = ?;", (end_ts, size_bytes, segment_id))
+    except sqlite3.Error as e:
+        print(f"Error closing segment {segment_id}: {e}")
+
+def get_open_segments():
+    """Segments without an end, i.e. being written, or left behind by a run that did not shut down cleanly."""
+    try:
+        rows = get_connection().execute(f"SELECT {SEGMENT_COLUMNS} FROM video_segments WHERE end_ts IS NULL;").fetchall()
+        return [dict(row) for row in rows]
+    except sqlite3.Error as e:
+        print(f"Error fetching open segments: {e}")
+        return []
+
+def find_segment(ts):
+    """The segment holding unix time ts, or the next one after it if ts falls in a gap. One index seek each."""
+    try:
+        conn = get_connection()
+        with stage_timer("db_query"):
+            row = conn.execute(f"SELECT {SEGMENT_COLUMNS} FROM video_segments WHERE start_ts <= ? "
+                               f"ORDER BY start_ts DESC LIMIT 1;", (ts,)).fetchone()
+            if row is None or (row["end_ts"] is not None and row["end_ts"] <= ts):
+                row = conn.execute(f"SELECT {SEGMENT_COLUMNS} FROM video_segments WHERE start_ts > ? "
+                                   f"ORDER BY start_ts ASC LIMIT 1;", (ts,)).fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        print(f"Error looking up the segment at {ts}: {e}")
+        return None
+
+def _keyframe_query(where, order, params):
+    try:
+        row = get_connection().execute(
+            f"SELECT ts, byte_offset FROM segment_keyframes WHERE segment_id = ? {where} ORDER BY ts {order} LIMIT 1;",
+            params).fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        print(f"Error looking up a keyframe of segment {params[0]}: {e}")
+        return None
+
+def find_keyframe(segment_id, ts):
+    """Last keyframe of the segment at or before ts, else its first one."""
+    return _keyframe_query("AND ts <= ?", "DESC", (segment_id, ts)) or first_keyframe(segment_id)
+
+def first_keyframe(segment_id):
+    return _keyframe_query("", "ASC", (segment_id,))
+
+def next_keyframe(segment_id, ts):
+    return _keyframe_query("AND ts > ?", "ASC", (segment_id, ts))
+
+def last_keyframe(segment_id):
+    return _keyframe_query("", "DESC", (segment_id,))
+
+def get_segments_between(start_ts, end_ts):
+    """Segments overlapping [start_ts, end_ts), oldest first."""
+    first = find_segment(start_ts)
+    if first is None:
+        return []
+    try:
+        rows = get_connection().execute(
+            f"SELECT {SEGMENT_COLUMNS} FROM video_segments WHERE start_ts >= ? AND start_ts < ? ORDER BY start_ts;",
+            (first["start_ts"], end_ts)).fetchall()
+        return [dict(row) for row in rows]
+    except sqlite3.Error as e:
+        print(f"Error fetching segments between {start_ts} and {end_ts}: {e}")
+        return []
+
+def get_oldest_evictable_segment():
+    """Oldest finished segment that no archived event points into."""
+    try:
+        row = get_connection().execute(f"""
+            SELECT {SEGMENT_COLUMNS} FROM video_segments s
+            WHERE end_ts IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM video_events e
+                WHERE e.is_archived = 1 AND e.clip_start IS NOT NULL
+                  AND e.clip_start < s.end_ts AND e.clip_end > s.start_ts)
+            ORDER BY start_ts ASC LIMIT 1;""").fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        print(f"Error fetching the oldest segment: {e}")
+        return None
+
+def delete_segment(segment):
+    """Deletes a segment's rows and the events that start in it (their footage goes with it). Returns those events."""
+    try:
+        conn = get_connection()
+        with conn:
+            events = [dict(row) for row in conn.execute(
+                f"SELECT {EVENT_COLUMNS} FROM video_events WHERE clip_start >= ? AND clip_start < ? AND is_archived = 0;",
+                (segment["start_ts"], segment["end_ts"]))]
+            conn.execute("DELETE FROM segment_keyframes WHERE segment_id = ?;", (segment["id"],))
+            conn.execute("DELETE FROM video_segments WHERE id = ?;", (segment["id"],))
+            conn.executemany("DELETE FROM video_events WHERE id = ?;", [(event["id"],) for event in events])
+            conn.executemany("UPDATE video_events SET duplicate_of = NULL WHERE duplicate_of = ?;",
+                             [(event["id"],) for event in events])
+            _queue_replication(conn, "delete", [event["id"] for event in events])
+        return events
+    except sqlite3.Error as e:
+        print(f"Error deleting segment {segment['id']}: {e}")
+        return []
+
+# --- Replication outbox (see replication.py) ---
+
+def get_outbox(limit):
+    """Oldest queued changes: [{"id", "op", "event_id", "created_at"}, ...]."""
+    try:
+        rows = get_connection().execute(
+            "SELECT id, op, event_id, created_at FROM replication_outbox ORDER BY id LIMIT ?;", (limit,)).fetchall()
+        return [dict(row) for row in rows]
+    except sqlite3.Error as e:
+        print(f"Error reading the replication outbox: {e}")
+        return []
+
+def delete_outbox(up_to_id):
+    # Once the hub has acknowledged everything up to and including up_to_id
+    try:
+        conn = get_connection()
+        with conn:
+            conn.execute("DELETE FROM replication_outbox WHERE id <= ?;", (up_to_id,))
+        return True
+    except sqlite3.Error as e:
+        print(f"Error trimming the replication outbox: {e}")
+        return False
+
+def outbox_depth():
+    try:
+        return get_connection().execute("SELECT COUNT(*) FROM replication_outbox;").fetchone()[0]
+    except sqlite3.Error as e:
+        print(f"Error counting the replication outbox: {e}")
+        return 0
+
+def queue_all_events():
+    # Full resync, for a hub that has not heard of this node yet (first start, or the hub lost its database)
+    try:
+        conn = get_connection()
+        with conn:
+            cursor = conn.execute("INSERT INTO replication_outbox (op, event_id, created_at) "
+                                  "SELECT 'upsert', id, ? FROM video_events ORDER BY event_ts, id;", (time.time(),))
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        print(f"Error queueing the events for a resync: {e}")
+        return 0
+
+# --- Hub: events pushed by the camera nodes (see hub.py) ---
+
+HUB_EVENT_COLUMNS = ("node_id, remote_id, event_ts, event_timestamp, event_type, notes, is_archived, "
+                     "clip_start, clip_end, video_path, thumbnail_path")
+
+def encode_hub_cursor(event):
+    # Position in the merged (event_ts, node_id, id) order; node ids may contain underscores, ids do not
+    return f"{event['event_ts']}_{event['node_id']}_{event['id']}"
+
+def decode_hub_cursor(cursor):
+    try:
+        event_ts, rest = cursor.split("_", 1)
+        node_id, event_id = rest.rsplit("_", 1)
+        return int(event_ts), node_id, int(event_id)
+    except (AttributeError, ValueError):
+        return None
+
+def apply_hub_ops(node_id, node_url, ops):
+    """Applies one ingest batch of a node in a single transaction, in order.
+
+    Upserts replace the whole row and deletes of unknown events do
+    nothing, so a batch applied twice leaves the same state as once.
+    Returns (thumbnail paths no longer referenced, ids of the events whose video is gone or changed).
+    """
+    now = time.time()
+    orphaned, stale_videos = [], []
+    conn = get_connection()
+    with conn:
+        for op in ops:
+            old = conn.execute("SELECT thumbnail_path, video_path FROM hub_events WHERE node_id = ? AND remote_id = ?;",
+                               (node_id, op["id"])).fetchone()
+            if op["op"] == "delete":
+                conn.execute("DELETE FROM hub_events WHERE node_id = ? AND remote_id = ?;", (node_id, op["id"]))
+                if old and old["thumbnail_path"]:
+                    orphaned.append(old["thumbnail_path"])
+                stale_videos.append(op["id"])
+                continue
+            event = op["event"]
+            conn.execute("""
+                INSERT INTO hub_events (node_id, remote_id, event_ts, event_timestamp, event_type, notes, is_archived,
+                                        clip_start, clip_end, video_path, thumbnail_path, received_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (node_id, remote_id) DO UPDATE SET
+                    event_ts = excluded.event_ts, event_timestamp = excluded.event_timestamp,
+                    event_type = excluded.event_type, notes = excluded.notes, is_archived = excluded.is_archived,
+                    clip_start = excluded.clip_start, clip_end = excluded.clip_end, video_path = excluded.video_path,
+                    thumbnail_path = excluded.thumbnail_path, received_at = excluded.received_at;""",
+                (node_id, op["id"], event["event_ts"], event["event_timestamp"], event["event_type"], event["notes"],
+                 int(bool(event["is_archived"])), event["clip_start"], event["clip_end"], event["video_path"],
+                 event["thumbnail_path"], now))
+            if old and old["thumbnail_path"] and old["thumbnail_path"] != event["thumbnail_path"]:
+                orphaned.append(old["thumbnail_path"])
+            if old and old["video_path"] != event["video_path"]:
+                stale_videos.append(op["id"]) # A recording whose range grew, say
+        conn.execute("""
+            INSERT INTO hub_nodes (node_id, node_url, last_seen, ops_received) VALUES (?, ?, ?, ?)
+            ON CONFLICT (node_id) DO UPDATE SET node_url = excluded.node_url, last_seen = excluded.last_seen,
+                ops_received = ops_received + excluded.ops_received;""", (node_id, node_url, now, len(ops)))
+    return orphaned, stale_videos
+
+def get_hub_nodes():
+    try:
+        rows = get_connection().execute("""
+            SELECT n.node_id, n.node_url, n.last_seen, n.ops_received,
+                   (SELECT COUNT(*) FROM hub_events e WHERE e.node_id = n.node_id) AS event_count
+            FROM hub_nodes n ORDER BY n.node_id;""").fetchall()
+        return [dict(row) for row in rows]
+    except sqlite3.Error as e:
+        print(f"Error fetching hub nodes: {e}")
+        return []
+
+def get_hub_node(node_id):
+    try:
+        row = get_connection().execute("SELECT node_id, node_url, last_seen, ops_received FROM hub_nodes "
+                                       "WHERE node_id = ?;", (node_id,)).fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        print(f"Error fetching hub node {node_id}: {e}")
+        return None
+
+def get_hub_event(node_id, remote_id):
+    try:
+        row = get_connection().execute(f"SELECT {HUB_EVENT_COLUMNS} FROM hub_events WHERE node_id = ? AND remote_id = ?;",
+                                       (node_id, remote_id)).fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        print(f"Error fetching hub event {node_id}/{remote_id}: {e}")
+        return None
+
+def get_merged_video_events(limit=20, before=None, since=None, until=None, event_type=None, local_node_id="local",
+                            node_id=None):
+    """Events of the hub's own camera and of every node, newest first, in one keyset-paginated list.
+
+    Both arms walk their (event_ts, ...) index and stop after limit rows,
+    so the merge costs the same however deep the page is. Rows carry
+    node_id and id (the id on that node); local rows also keep their
+    file paths, node rows their video_path on the node. before is a
+    cursor from encode_hub_cursor.
+    """
+    position = decode_hub_cursor(before) if before else None
+    arms, params = [], []
+    for table in ("video_events", "hub_events"):
+        local = table == "video_events"
+        if node_id is not None and (node_id == local_node_id) != local:
+            continue
+        clauses, arm_params = _filters(since, until, event_type)
+        if local:
+            columns = ("? AS node_id, id, event_ts, event_timestamp, event_type, notes, is_archived, clip_start, "
+                       "clip_end, NULL AS video_path, thumbnail_path, mp4_filepath")
+            arm_params.insert(0, local_node_id)
+            order = "event_ts DESC, id DESC"
+            if position is not None:
+                # All local rows share the node id, so the (event_ts, node_id, id) comparison is worked out here
+                ts, cursor_node, cursor_id = position
+                if local_node_id < cursor_node:
+                    clauses.append("event_ts <= ?")
+                    arm_params.append(ts)
+                elif local_node_id > cursor_node:
+                    clauses.append("event_ts < ?")
+                    arm_params.append(ts)
+                else:
+                    clauses.append("(event_ts, id) < (?, ?)")
+                    arm_params.extend((ts, cursor_id))
+        else:
+            columns = ("node_id, remote_id AS id, event_ts, event_timestamp, event_type, notes, is_archived, "
+                       "clip_start, clip_end, video_path, thumbnail_path, NULL AS mp4_filepath")
+            order = "event_ts DESC, node_id DESC, remote_id DESC"
+            if node_id is not None:
+                clauses.append("node_id = ?")
+                arm_params.append(node_id)
+            if position is not None:
+                clauses.append("(event_ts, node_id, remote_id) < (?, ?, ?)")
+                arm_params.extend(position)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        arms.append(f"SELECT * FROM (SELECT {columns} FROM {table} {where} ORDER BY {order} LIMIT ?)")
+        params.extend((*arm_params, limit))
+    if not arms:
+        return []
+    query = f"{' UNION ALL '.join(arms)} ORDER BY event_ts DESC, node_id DESC, id DESC LIMIT ?;"
+    try:
+        with stage_timer("db_query"):
+            rows = get_connection().execute(query, (*params, limit)).fetchall()
+    except sqlite3.Error as e:
+        print(f"Error fetching merged events: {e}")
+        return []
+    events = []
+    for row in rows:
+        event = dict(row)
+        event["cursor"] = encode_hub_cursor(event)
+        events.append(event)
+    return events
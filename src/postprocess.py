@@ -0,0 +1,253 @@
+import json
+import threading
+import time
+from myEventDataBase import get_connection
+from metrics import stage_timer, POSTPROCESS_JOBS
+
+# Job states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Stage:
+    def __init__(self, name, handler, concurrency=1, next_stages=(), max_attempts=3, retry_delay=5, optional=False):
+        # handler(payload) -> dict of values to merge into the payload for the next stages.
+        # Raising an exception marks the attempt as failed and schedules a retry.
+        # optional: not queued when the queue is full; the other stages always are.
+        self.name = name
+        self.optional = optional
+        self.handler = handler
+        self.concurrency = concurrency
+        self.next_stages = tuple(next_stages)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+
+class PostProcessor:
+    """Durable post-processing queue for recorded events.
+
+    Jobs live in the postprocess_jobs table of the events database, so work
+    that was queued or running when the process died is picked up again on
+    the next start. Every stage has its own worker threads (its concurrency
+    limit); a stage's jobs are claimed oldest first, and the follow-up
+    stages of an event are only queued once the previous stage finished,
+    so the steps of one event always run in order.
+
+    The workers may run in another process than the one submitting
+    (see worker_process.py); on_submit() is then called after every
+    submit so the other process can be woken instead of polling.
+    """
+
+    def __init__(self, max_pending=200, poll_interval=1.0, on_submit=None):
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self.on_submit = on_submit
+        self.stages = {}
+        self._claim_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._stop = threading.Event()
+        self._create_table()
+
+    def add_stage(self, stage):
+        self.stages[stage.name] = stage
+
+    # --- Storage ---
+
+    def _conn(self):
+        # The events database's per-thread connection
+        return get_connection()
+
+    def _create_table(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS postprocess_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_key TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_run_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                last_error TEXT
+            );
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_postprocess_jobs_claim "
+                         "ON postprocess_jobs (stage, state, next_run_at, id);")
+
+    def _insert_job(self, conn, event_key, stage, payload):
+        now = time.time()
+        conn.execute(
+            "INSERT INTO postprocess_jobs (event_key, stage, payload, next_run_at, created_at) VALUES (?, ?, ?, ?, ?);",
+            (event_key, stage, json.dumps(payload), now, now))
+
+    # --- Producer side ---
+
+    def pending_count(self):
+        row = self._conn().execute(
+            "SELECT COUNT(*) FROM postprocess_jobs WHERE state IN (?, ?);", (PENDING, RUNNING)).fetchone()
+        return row[0]
+
+    def submit(self, event_key, first_stages, payload):
+        """Queues the first stages of an event. Returns False if the queue was full and its optional stages were shed.
+
+        The required stages are queued regardless: the event's files are already on disk,
+        and without its row it would neither be listed nor ever evicted.
+        """
+        shed = ()
+        if self.pending_count() >= self.max_pending:
+            shed = tuple(name for name in first_stages if name in self.stages and self.stages[name].optional)
+            first_stages = [name for name in first_stages if name not in shed]
+            for stage_name in shed:
+                POSTPROCESS_JOBS.labels(stage_name, "shed").inc()
+            print(f"Post-processing queue full ({self.max_pending} jobs), skipping {', '.join(shed) or 'nothing'} "
+                  f"for event {event_key}.")
+        conn = self._conn()
+        with conn:
+            for stage_name in first_stages:
+                self._insert_job(conn, event_key, stage_name, payload)
+        self._notify()
+        if self.on_submit is not None:
+            self.on_submit()
+        return not shed
+
+    def _notify(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def wake(self):
+        """Has the workers look for jobs now, for jobs submitted by another process."""
+        self._notify()
+
+    # --- Workers ---
+
+    def start(self):
+        if self._threads:
+            return
+        # Jobs that were running when the process stopped are run again, unless they already used
+        # up their attempts (a job that takes the process down with it must not do so forever)
+        conn = self._conn()
+        recovered = 0
+        with conn:
+            for job in conn.execute("SELECT id, stage, attempts FROM postprocess_jobs WHERE state = ?;",
+                                    (RUNNING,)).fetchall():
+                stage = self.stages.get(job["stage"])
+                if stage is not None and job["attempts"] >= stage.max_attempts:
+                    print(f"Post-processing {job['stage']} job {job['id']} was interrupted {job['attempts']} times, giving up.")
+                    conn.execute("UPDATE postprocess_jobs SET state = ?, finished_at = ?, last_error = ? WHERE id = ?;",
+                                 (FAILED, time.time(), "interrupted", job["id"]))
+                else:
+                    conn.execute("UPDATE postprocess_jobs SET state = ? WHERE id = ?;", (PENDING, job["id"]))
+                    recovered += 1
+        if recovered:
+            print(f"Post-processing: re-queued {recovered} interrupted job(s).")
+        self.prune()
+        self._stop.clear()
+        for stage in self.stages.values():
+            for i in range(stage.concurrency):
+                t = threading.Thread(target=self._worker, args=(stage,), name=f"pp-{stage.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        print(f"Post-processing workers started for stages: {', '.join(self.stages)}")
+
+    def stop(self):
+        self._stop.set()
+        self._notify()
+
+    def _claim(self, stage):
+        conn = self._conn()
+        with self._claim_lock, conn:
+            row = conn.execute(
+                "SELECT * FROM postprocess_jobs WHERE stage = ? AND state = ? AND next_run_at <= ? "
+                "ORDER BY id LIMIT 1;", (stage.name, PENDING, time.time())).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE postprocess_jobs SET state = ?, started_at = ?, attempts = attempts + 1 WHERE id = ?;",
+                         (RUNNING, time.time(), row["id"]))
+            return row
+
+    def _worker(self, stage):
+        while not self._stop.is_set():
+            job = self._claim(stage)
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+            self._run_job(stage, job)
+
+    def _run_job(self, stage, job):
+        payload = json.loads(job["payload"])
+        conn = self._conn()
+        try:
+            with stage_timer(f"postprocess_{stage.name}"):
+                result = stage.handler(payload) or {}
+        except Exception as e:
+            POSTPROCESS_JOBS.labels(stage.name, "error").inc()
+            attempts = job["attempts"] + 1
+            if attempts >= stage.max_attempts:
+                print(f"Post-processing {stage.name} failed for {job['event_key']} after {attempts} attempts: {e}")
+                with conn:
+                    conn.execute("UPDATE postprocess_jobs SET state = ?, finished_at = ?, last_error = ? WHERE id = ?;",
+                                 (FAILED, time.time(), str(e), job["id"]))
+            else:
+                delay = stage.retry_delay * (2 ** (attempts - 1))
+                print(f"Post-processing {stage.name} failed for {job['event_key']} ({e}), retrying in {delay}s.")
+                with conn:
+                    conn.execute("UPDATE postprocess_jobs SET state = ?, next_run_at = ?, last_error = ? WHERE id = ?;",
+                                 (PENDING, time.time() + delay, str(e), job["id"]))
+            return
+
+        POSTPROCESS_JOBS.labels(stage.name, "done").inc()
+        payload.update(result)
+        with conn:
+            conn.execute("UPDATE postprocess_jobs SET state = ?, finished_at = ?, payload = ? WHERE id = ?;",
+                         (DONE, time.time(), json.dumps(payload), job["id"]))
+            for next_stage in stage.next_stages:
+                self._insert_job(conn, job["event_key"], next_stage, payload)
+        if stage.next_stages:
+            self._notify()
+
+    # --- Introspection ---
+
+    def queue_depth(self):
+        """{(stage, state): jobs} for the jobs that are not done yet."""
+        rows = self._conn().execute("SELECT stage, state, COUNT(*) AS n FROM postprocess_jobs "
+                                    "WHERE state != ? GROUP BY stage, state;", (DONE,))
+        return {(row["stage"], row["state"]): row["n"] for row in rows}
+
+    def get_stats(self, latency_window=50):
+        """Queue depth per stage and state, plus recent per-stage latency in ms."""
+        conn = self._conn()
+        depth = {name: {PENDING: 0, RUNNING: 0, FAILED: 0} for name in self.stages}
+        for (stage, state), count in self.queue_depth().items():
+            depth.setdefault(stage, {})[state] = count
+
+        latency = {}
+        for name in self.stages:
+            rows = conn.execute(
+                "SELECT created_at, started_at, finished_at FROM postprocess_jobs "
+                "WHERE stage = ? AND state = ? ORDER BY id DESC LIMIT ?;", (name, DONE, latency_window)).fetchall()
+            if not rows:
+                continue
+            run_ms = [(r["finished_at"] - r["started_at"]) * 1000 for r in rows]
+            total_ms = [(r["finished_at"] - r["created_at"]) * 1000 for r in rows]
+            latency[name] = {
+                "count": len(rows),
+                "avg_run_ms": round(sum(run_ms) / len(run_ms), 1),
+                "max_run_ms": round(max(run_ms), 1),
+                "avg_total_ms": round(sum(total_ms) / len(total_ms), 1), # Includes time spent queued
+            }
+        return {"depth": depth, "latency": latency}
+
+    def prune(self, older_than_seconds=7 * 24 * 3600):
+        # Finished jobs are only kept around for the latency stats
+        conn = self._conn()
+        with conn:
+            return conn.execute("DELETE FROM postprocess_jobs WHERE state = ? AND finished_at < ?;",
+                                (DONE, time.time() - older_than_seconds)).rowcount
@@ -0,0 +1,91 @@
+import collections
+import threading
+import time
+from camera_backend import Output
+
+
+class PrerollOutput(Output):
+    """Encoder output that keeps the last few seconds of H.264 in memory.
+
+    The encoder runs all the time and writes here. While idle, encoded frames
+    go into a ring buffer bounded both by age (preroll_seconds) and by size
+    (max_bytes). start_recording() hands the buffered frames to a sink
+    (an Mp4Muxer), starting at the oldest keyframe, and from then on frames
+    go straight to that sink until stop_recording(). Frames are never
+    re-encoded.
+    """
+
+    def __init__(self, preroll_seconds, max_bytes):
+        super().__init__()
+        self.preroll_us = int(preroll_seconds * 1_000_000)
+        self.max_bytes = max_bytes
+        self._frames = collections.deque() # (frame, keyframe, timestamp_us)
+        self._buffered_bytes = 0
+        self._lock = threading.Lock()
+        self._sink = None
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        if timestamp is None:
+            timestamp = time.monotonic_ns() // 1000
+        with self._lock:
+            if self._sink is not None:
+                self._sink.write(frame, keyframe, timestamp)
+                return
+            self._frames.append((bytes(frame), keyframe, timestamp))
+            self._buffered_bytes += len(frame)
+            self._trim(timestamp)
+
+    def _trim(self, newest_timestamp):
+        # Drop the oldest frames once they fall outside the pre-roll window or the byte cap
+        while self._frames and (newest_timestamp - self._frames[0][2] > self.preroll_us
+                                or self._buffered_bytes > self.max_bytes):
+            frame, _, _ = self._frames.popleft()
+            self._buffered_bytes -= len(frame)
+
+    def start_recording(self, sink):
+        # Flush the pre-roll into sink and keep passing live frames to it.
+        # sink needs write(frame, keyframe, timestamp), mark_live(timestamp) and close().
+        with self._lock:
+            if self._sink is not None:
+                print("Pre-roll output already recording, ignoring start.")
+                return False
+            started = False
+            last_timestamp = None
+            for frame, keyframe, timestamp in self._frames:
+                started = started or keyframe # The clip has to start on a keyframe to be decodable
+                if started:
+                    sink.write(frame, keyframe, timestamp)
+                last_timestamp = timestamp
+            if last_timestamp is not None:
+                sink.mark_live(last_timestamp)
+            self._frames.clear()
+            self._buffered_bytes = 0
+            self._sink = sink
+        return True
+
+    def stop_recording(self):
+        with self._lock:
+            sink = self._sink
+            self._sink = None
+        if sink is None:
+            return False
+        sink.close() # Outside the lock, finishing the file must not stall the encoder
+        return True
+
+    @property
+    def clip_active(self):
+        # Not "recording": picamera2's Output sets that attribute itself in __init__/start()/stop()
+        return self._sink is not None
+
+    def stats(self):
+        with self._lock:
+            buffered_seconds = 0.0
+            if len(self._frames) > 1:
+                buffered_seconds = (self._frames[-1][2] - self._frames[0][2]) / 1_000_000
+            return {
+                "frames": len(self._frames),
+                "bytes": self._buffered_bytes,
+                "seconds": round(buffered_seconds, 2),
+                "max_bytes": self.max_bytes,
+                "clip_active": self._sink is not None,
+            }
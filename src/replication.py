@@ -0,0 +1,170 @@
+import base64
+import os
+import socket
+import threading
+import time
+import config
+import myEventDataBase as db
+import metrics
+from metrics import stage_timer
+
+# Multi-node mode, on a camera node: the hub to push events to (None: standalone), and how the hub reaches this node
+HUB_URL = getattr(config, "HUB_URL", None)
+NODE_ID = getattr(config, "NODE_ID", socket.gethostname()) # Unique per camera; letters, digits, '.', '_', '-'
+NODE_URL = getattr(config, "NODE_URL", f"http://{socket.gethostname()}:{getattr(config, 'SERVER_BIND', '0.0.0.0:5000').rsplit(':', 1)[1]}")
+REPLICATION_INTERVAL = getattr(config, "REPLICATION_INTERVAL", 5) # Seconds between outbox checks when it is empty
+
+REPLICATION_BATCH_SIZE = 50 # Outbox entries per request to the hub
+THUMBNAIL_MAX_BYTES = 256 * 1024 # Bigger thumbnails are not sent, the hub shows none
+
+
+def event_video_path(event):
+    # URL path of the event's video on this node, for the hub to fetch it from
+    if event.get("mp4_filepath"):
+        return f"/media/videos/{os.path.basename(event['mp4_filepath'])}"
+    if event.get("clip_start") is not None:
+        return f"/recording?at={event['clip_start']}&until={event['clip_end']}"
+    return None
+
+
+def _read_thumbnail(path):
+    try:
+        if path and os.path.getsize(path) <= THUMBNAIL_MAX_BYTES:
+            with open(path, "rb") as f:
+                return base64.b64encode(f.read()).decode()
+    except OSError:
+        pass
+    return None
+
+
+def build_batch(entries):
+    """Turns outbox entries into the ops of an ingest request.
+
+    Only the last entry per event counts, and an upsert sends the row as it
+    is now, so a batch carries every event once. An upsert of an event that
+    is gone by now is sent as a delete.
+    """
+    latest = {}
+    for entry in entries:
+        latest.pop(entry["event_id"], None) # Re-inserted to keep the order of the last change
+        latest[entry["event_id"]] = entry["op"]
+    ops = []
+    for event_id, op in latest.items():
+        event = db.get_video_event(event_id) if op == "upsert" else None
+        if event is None:
+            ops.append({"op": "delete", "id": event_id})
+            continue
+        thumbnail_path = event.get("thumbnail_path")
+        ops.append({"op": "upsert", "event": {
+            "id": event["id"],
+            "event_ts": event["event_ts"],
+            "event_timestamp": event["event_timestamp"],
+            "event_type": event["event_type"],
+            "notes": event["notes"],
+            "is_archived": bool(event["is_archived"]),
+            "clip_start": event["clip_start"],
+            "clip_end": event["clip_end"],
+            "video_path": event_video_path(event),
+            "thumbnail_name": os.path.basename(thumbnail_path) if thumbnail_path else None,
+            "thumbnail": _read_thumbnail(thumbnail_path),
+        }})
+    return ops
+
+
+class NodeReplicator:
+    """Pushes this node's event changes to the hub.
+
+    Changes to video_events are queued in the replication_outbox table in
+    the same transaction as the change itself (see myEventDataBase). This
+    thread sends them in batches to the hub's /hub/ingest and removes them
+    only once the hub has acknowledged the batch. Applying a batch twice
+    has the same effect as applying it once (upserts and deletes keyed by
+    node and event id), so a batch whose answer got lost is simply sent
+    again. While the hub is unreachable the outbox grows and is worked off
+    when it comes back, with exponential backoff in between.
+    """
+
+    def __init__(self, hub_url, node_id, node_url, token=None, interval=5.0, max_backoff=300.0,
+                 batch_size=REPLICATION_BATCH_SIZE):
+        self.hub_url = hub_url.rstrip("/")
+        self.node_id = node_id
+        self.node_url = node_url.rstrip("/")
+        self.token = token
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.ops_sent = 0
+        self.batches_sent = 0
+        self.failures = 0
+        self.last_success = None
+        self.last_error = None
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._session = None
+        metrics.gauge_callback("pizero_replication_outbox_depth", "Event changes not yet acknowledged by the hub.",
+                               db.outbox_depth)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="replication", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self):
+        backoff = self.interval
+        while True:
+            try:
+                while self.push_once(): # Drain the outbox while the hub keeps up
+                    pass
+                backoff = self.interval
+                self.last_error = None
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                backoff = min(backoff * 2, self.max_backoff)
+                print(f"Replication: hub unreachable ({e}), retrying in {backoff:.0f}s.")
+            self._wakeup.wait(backoff)
+            self._wakeup.clear()
+
+    def push_once(self):
+        """Sends the next batch. Returns the number of outbox entries acknowledged, 0 when there was none."""
+        entries = db.get_outbox(self.batch_size)
+        if not entries:
+            return 0
+        ops = build_batch(entries)
+        if self._session is None:
+            import requests # Deferred like the Telegram client, only needed with a hub
+            self._session = requests.Session()
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+        with stage_timer("replication_push"):
+            response = self._session.post(f"{self.hub_url}/hub/ingest", headers=headers, timeout=30, json={
+                "node_id": self.node_id,
+                "node_url": self.node_url,
+                "ops": ops,
+            })
+        if response.status_code != 200:
+            raise RuntimeError(f"hub answered {response.status_code}: {response.text[:200]}")
+        db.delete_outbox(entries[-1]["id"])
+        if response.json().get("new_node"):
+            # The hub has never seen this node (or lost its database): send every event once
+            queued = db.queue_all_events()
+            print(f"Replication: hub {self.hub_url} did not know this node, {queued} event(s) queued for a resync.")
+        self.ops_sent += len(ops)
+        self.batches_sent += 1
+        self.last_success = time.time()
+        return len(entries)
+
+    def stats(self):
+        return {
+            "hub_url": self.hub_url,
+            "node_id": self.node_id,
+            "outbox_depth": db.outbox_depth(),
+            "ops_sent": self.ops_sent,
+            "batches_sent": self.batches_sent,
+            "failures": self.failures,
+            "last_success": self.last_success,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,202 @@
+import os
+import shutil
+import threading
+import time
+import config
+from myEventDataBase import (get_eviction_candidates, get_events_after_id, update_video_event,
+                             delete_video_event, get_oldest_evictable_segment, delete_segment)
+
+STORAGE_MAX_BYTES = getattr(config, "STORAGE_MAX_BYTES", None)                      # Quota for EVENTS_STORAGE_DIR, None = no size cap
+STORAGE_MIN_FREE_BYTES = getattr(config, "STORAGE_MIN_FREE_BYTES", 500 * 1024 * 1024) # Keep this much free on the SD card
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def mp4_is_complete(mp4_path):
+    # The MP4 counts as confirmed when PyAV can open it and it has frames
+    try:
+        import av
+        with av.open(mp4_path) as container:
+            stream = container.streams.video[0]
+            return bool(stream.frames or container.duration)
+    except Exception:
+        return False
+
+
+class RetentionManager:
+    """Keeps the event storage under its quota.
+
+    The bytes used under storage_dir are counted once at start-up and then
+    kept up to date from file_added()/the deletions done here, so checking
+    the quota never rescans the directory (a full rescan only happens every
+    rescan_interval to correct drift). When the total goes over max_bytes,
+    or the disk has less than min_free_bytes left, the oldest non-archived
+    events are deleted, files and row, a small batch at a time; events that
+    were exported (see event_export) go first. With continuous recording the
+    oldest segment goes when it is older than the oldest such event, along
+    with the events pointing into it; segments an archived event points
+    into are kept.
+
+    The same background thread also sweeps the video_events table a few
+    rows per pass: raw .h264 files are removed once their MP4 is confirmed,
+    and rows whose video is gone from disk are deleted.
+    """
+
+    def __init__(self, storage_dir, max_bytes=None, min_free_bytes=None, batch_size=5,
+                 interval=60, sweep_rows=100, rescan_interval=24 * 3600):
+        self.storage_dir = storage_dir
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.batch_size = batch_size
+        self.interval = interval
+        self.sweep_rows = sweep_rows
+        self.rescan_interval = rescan_interval
+        self.used_bytes = None
+        self.evicted_events = 0
+        self.evicted_bytes = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._sweep_after_id = 0
+        self._last_scan = 0.0
+        self._thread = None
+
+    # --- Byte accounting ---
+
+    def scan(self):
+        total = 0
+        for root, _, files in os.walk(self.storage_dir):
+            for name in files:
+                total += _file_size(os.path.join(root, name))
+        with self._lock:
+            self.used_bytes = total
+        self._last_scan = time.monotonic()
+        print(f"Retention: {total / 1e6:.1f} MB used under {self.storage_dir}")
+
+    def file_added(self, *paths):
+        # Called by the recorder for every file it finishes; may trigger an eviction pass
+        added = sum(_file_size(path) for path in paths if path)
+        with self._lock:
+            if self.used_bytes is not None:
+                self.used_bytes += added
+        if self.over_quota():
+            self._wakeup.set()
+
+    def _remove_file(self, path):
+        if not path or not os.path.exists(path):
+            return 0
+        size = _file_size(path)
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Retention: could not delete {path}: {e}")
+            return 0
+        with self._lock:
+            if self.used_bytes is not None:
+                self.used_bytes -= size
+        return size
+
+    def free_bytes(self):
+        try:
+            return shutil.disk_usage(self.storage_dir).free
+        except OSError:
+            return None
+
+    def over_quota(self):
+        if self.max_bytes is not None and self.used_bytes is not None and self.used_bytes > self.max_bytes:
+            return True
+        if self.min_free_bytes is not None:
+            free = self.free_bytes()
+            if free is not None and free < self.min_free_bytes:
+                return True
+        return False
+
+    # --- Background work ---
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        os.makedirs(self.storage_dir, exist_ok=True)
+        self.scan()
+        while True:
+            try:
+                self.sweep() # Dropping intermediates first may already be enough
+                self.evict()
+                if time.monotonic() - self._last_scan > self.rescan_interval:
+                    self.scan()
+            except Exception as e:
+                print(f"Retention error: {e}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def evict(self):
+        """Deletes the oldest non-archived events and segments, exported events first, until storage is back under quota."""
+        while self.over_quota():
+            candidates = get_eviction_candidates(self.batch_size)
+            segment = get_oldest_evictable_segment()
+            if not candidates and segment is None:
+                print("Retention: over quota but every remaining event is archived.")
+                return
+            if segment is not None and (not candidates or segment["start_ts"] <= candidates[0]["event_ts"]):
+                self._evict_segment(segment)
+                time.sleep(0.1)
+                continue
+            for event in candidates:
+                freed = sum(self._remove_file(event[column])
+                            for column in ("mp4_filepath", "h264_filepath", "thumbnail_path", "sprite_path"))
+                delete_video_event(event["id"])
+                self.evicted_events += 1
+                self.evicted_bytes += freed
+                print(f"Retention: evicted event {event['id']} ({event['event_timestamp']}), freed {freed} bytes.")
+            time.sleep(0.1) # Small batches with a pause, so the disk stays available to the recorder
+
+    def _evict_segment(self, segment):
+        freed = self._remove_file(segment["filepath"])
+        events = delete_segment(segment)
+        freed += sum(self._remove_file(event["thumbnail_path"]) + self._remove_file(event["sprite_path"]) for event in events)
+        self.evicted_bytes += freed
+        self.evicted_events += len(events)
+        print(f"Retention: evicted segment {segment['filepath']} with {len(events)} event(s), freed {freed} bytes.")
+
+    def sweep(self):
+        """Checks the next few rows: drops confirmed .h264 intermediates and rows without a video."""
+        events = get_events_after_id(self._sweep_after_id, self.sweep_rows)
+        if not events:
+            self._sweep_after_id = 0 # Start over next time
+            return
+        for event in events:
+            self._sweep_after_id = event["id"]
+            if event["clip_start"] is not None:
+                continue # Points into the segments, removed with them
+            mp4_path, h264_path = event["mp4_filepath"], event["h264_filepath"]
+            mp4_exists = bool(mp4_path) and os.path.exists(mp4_path)
+            h264_exists = bool(h264_path) and os.path.exists(h264_path)
+            if not mp4_exists and not h264_exists:
+                self._remove_file(event["thumbnail_path"])
+                self._remove_file(event["sprite_path"])
+                delete_video_event(event["id"])
+                print(f"Retention: removed event {event['id']}, its video is no longer on disk.")
+                continue
+            if h264_path and mp4_exists and (not h264_exists or mp4_is_complete(mp4_path)):
+                self._remove_file(h264_path)
+                update_video_event(event["id"], h264_filepath=None)
+            if event["thumbnail_path"] and not os.path.exists(event["thumbnail_path"]):
+                update_video_event(event["id"], thumbnail_path=None)
+
+    def stats(self):
+        return {
+            "used_bytes": self.used_bytes,
+            "max_bytes": self.max_bytes,
+            "free_bytes": self.free_bytes(),
+            "min_free_bytes": self.min_free_bytes,
+            "evicted_events": self.evicted_events,
+            "evicted_bytes": self.evicted_bytes,
+        }
@@ -0,0 +1,435 @@
+import collections
+import os
+import queue
+import struct
+import threading
+import time
+from datetime import datetime
+from fractions import Fraction
+from camera_backend import Output
+import myEventDataBase as db
+from metrics import stage_timer
+
+TIMESTAMP_BASE = Fraction(1, 1_000_000) # picamera2 encoder timestamps are in microseconds
+# A fragment per keyframe: every moof starts a GOP, so its byte offset is a seek point.
+# Nothing is rewritten on close, and a segment cut short by a power loss plays up to its last fragment.
+FRAGMENT_FLAGS = "frag_keyframe+empty_moov+default_base_moof"
+KEYFRAME_FLUSH = 5 # Keyframes collected before they are written to the index
+SEGMENT_GAP_TOLERANCE = 1.0 # Seconds between one segment's end and the next one's start that still count as seamless
+
+# Part of a recording served from one segment file: the fragments in [start, end), time_shift seconds
+# after the first segment of the range; timescale is the unit of their tfdt, None when they are not shifted
+RecordingPiece = collections.namedtuple("RecordingPiece", "path start end time_shift timescale")
+
+
+class _IndexedFile:
+    # File-like target for the PyAV muxer: writes through to the segment file and reports
+    # the offset of every top-level box as the bytes go by.
+    def __init__(self, path, on_box):
+        self.f = open(path, "wb")
+        self.position = 0
+        self._on_box = on_box
+        self._box_at = 0          # Offset of the next top-level box
+        self._header = bytearray() # Its first bytes, when they straddle two writes
+
+    def write(self, data):
+        data = bytes(data)
+        self.f.write(data)
+        start = self.position
+        self.position += len(data)
+        while True:
+            index = self._box_at + len(self._header) - start
+            if index >= len(data):
+                break
+            self._header += data[index:index + 8 - len(self._header)]
+            if len(self._header) < 8:
+                break
+            size, kind = struct.unpack(">I4s", self._header)
+            self._header.clear()
+            if size < 8: # 0 (runs to the end) or a 64-bit size, neither happens for moof
+                self._box_at = float("inf")
+                break
+            self._on_box(kind, self._box_at)
+            self._box_at += size
+        return len(data)
+
+    def close(self):
+        self.f.close()
+
+
+class _SegmentWriter:
+    """One segment file: H.264 muxed as fragmented MP4, and its keyframes as (wall time, byte offset)."""
+
+    def __init__(self, path, size, framerate, first_timestamp, start_ts):
+        import av
+        self.path = path
+        self.segment_id = None # Row in video_segments, set by the index thread
+        self.first_timestamp = first_timestamp
+        self.start_ts = start_ts # Wall clock of the first frame; later frames are placed by their timestamps
+        self.end_ts = self.start_ts
+        self.keyframes = [] # (wall time, byte offset) not in the index yet
+        self._keyframe_times = collections.deque() # Keyframes muxed whose fragment has not come out yet
+        self._file = _IndexedFile(path, self._on_box)
+        self.container = av.open(self._file, "w", format="mp4", options={"movflags": FRAGMENT_FLAGS})
+        self.stream = self.container.add_stream("h264", rate=framerate)
+        self.stream.width, self.stream.height = size
+        self.stream.time_base = TIMESTAMP_BASE
+        self.frame_us = 1_000_000 // framerate
+        self._last_pts = -1
+
+    def wall_time(self, timestamp):
+        return self.start_ts + (timestamp - self.first_timestamp) / 1_000_000
+
+    def _on_box(self, kind, offset):
+        if kind == b"moof" and self._keyframe_times:
+            self.keyframes.append((self._keyframe_times.popleft(), offset))
+
+    def write(self, frame, keyframe, timestamp):
+        import av
+        pts = max(timestamp - self.first_timestamp, self._last_pts + 1)
+        self._last_pts = pts
+        if keyframe:
+            self._keyframe_times.append(self.wall_time(timestamp))
+        packet = av.Packet(bytes(frame))
+        packet.pts = packet.dts = pts
+        packet.time_base = TIMESTAMP_BASE
+        packet.is_keyframe = keyframe
+        packet.stream = self.stream
+        self.container.mux(packet)
+        self.end_ts = self.wall_time(timestamp) + self.frame_us / 1_000_000
+
+    def take_keyframes(self):
+        keyframes, self.keyframes = self.keyframes, []
+        return keyframes
+
+    def close(self):
+        # Flushes the last fragment, whose keyframe then lands in self.keyframes
+        self.container.close()
+        self._file.close()
+
+    @property
+    def size(self):
+        return self._file.position
+
+
+class SegmentOutput(Output):
+    """Encoder output for continuous recording.
+
+    The always-on encoder writes here instead of the pre-roll buffer. Frames
+    go into fragmented MP4 segments of segment_seconds; a segment is cut at
+    the first keyframe past that length and the keyframe opens the next
+    one, so there is no gap and nothing is re-encoded. Every segment and
+    its keyframes (wall-clock time and byte offset of the fragment) go into
+    the video_segments / segment_keyframes tables, which is what lets
+    find_recording() jump to any moment with two index lookups.
+
+    Database writes and closing finished segments happen on a background
+    thread, the encoder thread only muxes.
+    """
+
+    def __init__(self, directory, size, framerate, segment_seconds, on_segment_closed=None):
+        super().__init__()
+        self.directory = directory
+        self.size = size
+        self.framerate = framerate
+        self.segment_us = int(segment_seconds * 1_000_000)
+        self.on_segment_closed = on_segment_closed # Called with the path of every finished segment
+        self.latest_keyframe = None # Newest keyframe (with its SPS/PPS), for event thumbnails
+        self.segments_written = 0
+        self._writer = None
+        self._lock = threading.Lock()
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run_index, name="segment-index", daemon=True)
+        self._thread.start()
+        os.makedirs(directory, exist_ok=True)
+        import av # Here rather than on the encoder thread with the first frame, it is slow to import
+        recover_segments()
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        if timestamp is None:
+            timestamp = time.monotonic_ns() // 1000
+        with self._lock:
+            writer = self._writer
+            if writer is None and not keyframe:
+                return # A segment has to start on a keyframe to be decodable
+            if writer is None or (keyframe and timestamp - writer.first_timestamp >= self.segment_us):
+                writer = self._open_segment(timestamp)
+            try:
+                writer.write(frame, keyframe, timestamp)
+            except Exception as e:
+                print(f"Segments: write to {writer.path} failed, starting a new segment: {e}")
+                self._writer = None
+                self._jobs.put(("close", writer))
+                return
+            if keyframe:
+                self.latest_keyframe = bytes(frame)
+            if len(writer.keyframes) >= KEYFRAME_FLUSH:
+                self._jobs.put(("keyframes", writer, writer.take_keyframes()))
+
+    def _open_segment(self, timestamp):
+        start_ts = time.time()
+        if self._writer is not None:
+            continued = self._writer.wall_time(timestamp)
+            if abs(continued - start_ts) < 1.0:
+                start_ts = continued # Seamless with the previous segment, unless the clock was set meanwhile
+            self._jobs.put(("close", self._writer))
+        name = f"segment_{datetime.fromtimestamp(start_ts).strftime('%Y%m%d_%H%M%S')}"
+        path = os.path.join(self.directory, name + ".mp4")
+        suffix = 1
+        while os.path.exists(path):
+            path = os.path.join(self.directory, f"{name}_{suffix}.mp4")
+            suffix += 1
+        writer = _SegmentWriter(path, self.size, self.framerate, timestamp, start_ts)
+        self._writer = writer
+        self._jobs.put(("open", writer))
+        return writer
+
+    def stop(self):
+        # Closes the segment being written; the encoder must be stopped first
+        with self._lock:
+            writer = self._writer
+            self._writer = None
+        if writer is not None:
+            self._jobs.put(("close", writer))
+        super().stop()
+
+    def flush(self, timeout=10):
+        """Waits until everything handed to the index thread so far is in the database."""
+        done = threading.Event()
+        self._jobs.put(("flush", done))
+        return done.wait(timeout)
+
+    def _run_index(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                kind, subject = job[0], job[1]
+                if kind == "open":
+                    subject.segment_id = db.open_segment(subject.path, subject.start_ts)
+                elif kind == "keyframes":
+                    db.add_segment_keyframes(subject.segment_id, job[2])
+                elif kind == "close":
+                    with stage_timer("segment_close"):
+                        subject.close()
+                    db.add_segment_keyframes(subject.segment_id, subject.take_keyframes())
+                    db.close_segment(subject.segment_id, subject.end_ts, subject.size)
+                    self.segments_written += 1
+                    print(f"Segment closed: {subject.path} ({subject.end_ts - subject.start_ts:.0f}s, "
+                          f"{subject.size / 1e6:.1f} MB)")
+                    if self.on_segment_closed is not None:
+                        self.on_segment_closed(subject.path)
+                elif kind == "flush":
+                    subject.set()
+            except Exception as e:
+                print(f"Segments: index update failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            writer = self._writer
+        return {
+            "segment": os.path.basename(writer.path) if writer else None,
+            "segment_seconds": round(writer.end_ts - writer.start_ts, 1) if writer else 0,
+            "segment_bytes": writer.size if writer else 0,
+            "segments_written": self.segments_written,
+            "index_backlog": self._jobs.qsize(),
+        }
+
+
+def _boxes(f, start, end):
+    # (type, offset, size) of the boxes in [start, end); stops at one that runs past end (cut short)
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+        if size < 8 or offset + size > end:
+            return
+        yield kind, offset, size
+        offset += size
+
+
+def _child(f, parent_offset, parent_size, kind):
+    for child_kind, offset, size in _boxes(f, parent_offset + 8, parent_offset + parent_size):
+        if child_kind == kind:
+            return offset, size
+    return None
+
+
+def _track_timescale(f, moov_offset, moov_size):
+    # Timescale of the video track (mdhd), the unit of its tfdt decode times
+    box = (moov_offset, moov_size)
+    for name in (b"trak", b"mdia", b"mdhd"):
+        box = _child(f, *box, name) if box else None
+    if box is None:
+        return None
+    f.seek(box[0] + 8)
+    version = f.read(1)[0]
+    f.seek(box[0] + 12 + (16 if version == 1 else 8)) # Past the creation and modification times
+    return struct.unpack(">I", f.read(4))[0]
+
+
+def _segment_timescale(path, init_size):
+    # _track_timescale() of a segment file, whose moov is in its first init_size bytes; None if it has none
+    try:
+        with open(path, "rb") as f:
+            moov = next(((offset, size) for kind, offset, size in _boxes(f, 0, init_size) if kind == b"moov"), None)
+            return _track_timescale(f, *moov) if moov else None
+    except (OSError, IndexError, struct.error):
+        return None
+
+
+def _shift_tfdt(moof, shift):
+    # Adds shift to the baseMediaDecodeTime of every traf of one whole moof box (a bytearray), in place.
+    # Its size does not change, and with default_base_moof the sample offsets are relative to the moof.
+    def children(start, end, kind):
+        while start + 8 <= end:
+            size, child_kind = struct.unpack_from(">I4s", moof, start)
+            if size < 8:
+                return
+            if child_kind == kind:
+                yield start, size
+            start += size
+    for traf, traf_size in children(8, len(moof), b"traf"):
+        for tfdt, _ in children(traf + 8, traf + traf_size, b"tfdt"):
+            time_format = ">Q" if moof[tfdt + 8] == 1 else ">I"
+            value = struct.unpack_from(time_format, moof, tfdt + 12)[0]
+            struct.pack_into(time_format, moof, tfdt + 12, max(0, value + shift))
+
+
+def scan_segment(path):
+    """Reads the keyframe index back from a segment file: ([(seconds from start, moof offset)], bytes).
+
+    Only complete fragments count, bytes is where the last one ends. Used for
+    segments whose index was not written out because the process stopped.
+    """
+    keyframes, timescale, complete = [], None, 0
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        moof = None
+        for kind, offset, size in _boxes(f, 0, file_size):
+            if kind == b"moov":
+                timescale = _track_timescale(f, offset, size)
+            elif kind == b"moof":
+                moof = (offset, size)
+            elif kind == b"mdat" and moof is not None and timescale:
+                traf = _child(f, *moof, b"traf")
+                tfdt = _child(f, *traf, b"tfdt") if traf else None
+                if tfdt is not None:
+                    f.seek(tfdt[0] + 8)
+                    version = f.read(4)[0]
+                    base_time = struct.unpack(">Q" if version == 1 else ">I", f.read(8 if version == 1 else 4))[0]
+                    keyframes.append((base_time / timescale, moof[0]))
+                moof = None
+            if kind != b"moof":
+                complete = offset + size # A moof only counts with its mdat
+    return keyframes, complete
+
+
+def recover_segments():
+    """Closes the segments a previous run left open, re-indexing them from their files."""
+    for segment in db.get_open_segments():
+        try:
+            keyframes, size = scan_segment(segment["filepath"])
+        except OSError as e:
+            print(f"Segments: {segment['filepath']} is unreadable ({e}), dropping it from the index.")
+            db.delete_segment(dict(segment, end_ts=segment["start_ts"]))
+            continue
+        keyframes = [(segment["start_ts"] + seconds, offset) for seconds, offset in keyframes]
+        db.add_segment_keyframes(segment["id"], keyframes)
+        # The last fragment's length is not in the index, assume it is as long as the one before
+        end_ts = segment["start_ts"]
+        if keyframes:
+            gop = keyframes[-1][0] - keyframes[-2][0] if len(keyframes) > 1 else 1.0
+            end_ts = keyframes[-1][0] + gop
+        db.close_segment(segment["id"], end_ts, size)
+        print(f"Segments: recovered {segment['filepath']} ({len(keyframes)} keyframes, {end_ts - segment['start_ts']:.0f}s).")
+
+
+def find_recording(at, until=None):
+    """Where to play from for wall-clock time at: (path, init_size, pieces, start_ts).
+
+    path and init_size are the segment file to take the ftyp+moov from and
+    its length. pieces are RecordingPiece(path, start, end, time_shift):
+    the fragments to play, from the last keyframe at or before at to the
+    first keyframe after until. A range that runs past the end of its
+    segment goes on with the fragments of the segments that follow it
+    without a gap, time_shift seconds after the first on its timeline (see
+    iter_recording); one whose track timescale cannot be read ends the
+    range before it. Without until it ends with the first segment, where
+    an open segment stops at its last indexed keyframe. start_ts is the
+    time of the keyframe playback starts at. A time in a gap plays from the
+    next segment. The lookups are index seeks. None when there is no footage.
+    """
+    segment = db.find_segment(at)
+    if segment is None:
+        return None
+    keyframe = db.find_keyframe(segment["id"], max(at, segment["start_ts"]))
+    first = db.first_keyframe(segment["id"])
+    if keyframe is None or first is None:
+        return None
+    path, origin, pieces, start = segment["filepath"], segment["start_ts"], [], keyframe["byte_offset"]
+    timescale = None # Only needed from the second segment on, to shift its fragments
+    while True:
+        end_offset = None
+        if until is not None:
+            after = db.next_keyframe(segment["id"], until)
+            end_offset = after["byte_offset"] if after else None
+        ends_here = until is None or end_offset is not None or segment["end_ts"] is None or until < segment["end_ts"]
+        if end_offset is None:
+            # Closed segments run to the end of the file; an open one stops at its last indexed keyframe,
+            # the fragment after it may still be half written
+            end_offset = segment["size_bytes"] if segment["end_ts"] is not None else db.last_keyframe(segment["id"])["byte_offset"]
+        if end_offset > start:
+            pieces.append(RecordingPiece(segment["filepath"], start, end_offset, segment["start_ts"] - origin, timescale))
+        if ends_here:
+            break
+        following = db.find_segment(segment["end_ts"])
+        if (following is None or following["id"] == segment["id"] or following["start_ts"] > until
+                or abs(following["start_ts"] - segment["end_ts"]) > SEGMENT_GAP_TOLERANCE):
+            break # No more footage in the range, or only after a gap (the camera was restarted)
+        following_first = db.first_keyframe(following["id"])
+        if following_first is None:
+            break
+        # Checked before the response's length is worked out from the pieces, not while streaming them
+        timescale = _segment_timescale(following["filepath"], following_first["byte_offset"])
+        if not timescale:
+            break # Not a segment this recorder wrote, the range ends before it
+        segment, start = following, following_first["byte_offset"]
+    if not pieces:
+        return None
+    return path, first["byte_offset"], pieces, keyframe["ts"]
+
+
+def iter_recording(path, init_size, pieces, block_size=256 * 1024):
+    """The bytes of what find_recording() found: the ftyp+moov, then the fragments of every piece.
+
+    The fragments of a following segment are passed on with their tfdt
+    moved by the piece's time_shift, so the range plays as one timeline.
+    Sizes do not change, the total is init_size plus every end - start.
+    """
+    def read(f, offset, length):
+        f.seek(offset)
+        while length > 0:
+            chunk = f.read(min(block_size, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+    with open(path, "rb") as f:
+        yield from read(f, 0, init_size)
+    for piece in pieces:
+        with open(piece.path, "rb") as f:
+            if not piece.time_shift:
+                yield from read(f, piece.start, piece.end - piece.start)
+                continue
+            shift = round(piece.time_shift * piece.timescale)
+            for kind, offset, size in _boxes(f, piece.start, piece.end):
+                if kind == b"moof":
+                    f.seek(offset)
+                    moof = bytearray(f.read(size))
+                    _shift_tfdt(moof, shift)
+                    yield bytes(moof)
+                else:
+                    yield from read(f, offset, size)
@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+import metrics
+
+# Subsystem states
+STARTING = "starting"
+READY = "ready"
+FAILED = "failed"
+DISABLED = "disabled"
+
+
+def process_start_monotonic():
+    """time.monotonic() value of when the kernel started this process, so interpreter and import time count too."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19]) # Field 22, starttime
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        age = uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+        return time.monotonic() - max(0.0, age)
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+
+class Startup:
+    """Startup progress of the app, for /healthz, /readyz and /metrics.
+
+    Every subsystem (database, camera, autofocus, motion, ...) reports its
+    state as it comes up; milestones (http_ready, camera_ready,
+    first_frame, ...) are recorded once, in seconds since the process was
+    started.
+    """
+
+    def __init__(self):
+        self.started_at = process_start_monotonic()
+        self._lock = threading.Lock()
+        self._subsystems = {} # name -> (state, detail, monotonic time of the change)
+        self._milestones = {} # name -> seconds since process start
+
+    def set(self, name, state, detail=None):
+        with self._lock:
+            self._subsystems[name] = (state, detail, time.monotonic())
+
+    def state(self, name):
+        with self._lock:
+            entry = self._subsystems.get(name)
+        return entry[0] if entry else None
+
+    def milestone(self, name):
+        # Only the first time counts; called for every frame, so the common case takes no lock
+        if name in self._milestones:
+            return
+        with self._lock:
+            if name in self._milestones:
+                return
+            elapsed = time.monotonic() - self.started_at
+            self._milestones[name] = elapsed
+        print(f"Startup: {name} after {elapsed:.2f}s.")
+
+    def ready(self, required):
+        with self._lock:
+            return all(self._subsystems.get(name, (None,))[0] == READY for name in required)
+
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "uptime_seconds": round(now - self.started_at, 3),
+                "subsystems": {
+                    name: {"state": state, "detail": detail, "since_seconds": round(changed - self.started_at, 3)}
+                    for name, (state, detail, changed) in self._subsystems.items()
+                },
+                "milestones": {name: round(seconds, 3) for name, seconds in self._milestones.items()},
+            }
+
+    def _ready_gauge(self):
+        with self._lock:
+            return {(name,): int(state == READY) for name, (state, _, _) in self._subsystems.items()}
+
+    def _milestone_gauge(self):
+        with self._lock:
+            return {(name,): seconds for name, seconds in self._milestones.items()}
+
+
+STARTUP = Startup()
+metrics.gauge_callback("pizero_subsystem_ready", "1 when the subsystem is up.", STARTUP._ready_gauge,
+                       labels=("subsystem",))
+metrics.gauge_callback("pizero_startup_milestone_seconds", "Seconds from process start to each startup milestone.",
+                       STARTUP._milestone_gauge, labels=("milestone",))
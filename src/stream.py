@@ -1,11 +1,29 @@
 import os
+import fcntl
+import socket
+import termios
+import struct
 import threading
+import collections
+import hashlib
+import hmac
+import json
 from camera_manager import CameraManager
 from flask import Flask, render_template, Response, jsonify, request, session,redirect,url_for, send_from_directory
 from telegram_handler import notiManager
 from motion_logic import check_for_motion
+import config
 from config import PASSWORD, USER_NAME, THUMBNAILS_SUBDIR_NAME, VIDEOS_SUBDIR_NAME, EVENTS_STORAGE_DIR
-from myEventDataBase import init_db, get_video_events
+from werkzeug.security import safe_join
+from video_delivery import ensure_faststart, send_video_file, send_fragmented_range
+from segment_recorder import find_recording, iter_recording
+from myEventDataBase import init_db, get_video_events_page, count_video_events, get_events_version, count_duplicates
+import metrics
+from event_export import EventArchive, FORMATS as EXPORT_FORMATS, EXPORT_MAX_EVENTS, acquire_export_slot, release_export_slot
+from startup import STARTUP, READY, FAILED, DISABLED
+import hub
+from myEventDataBase import get_merged_video_events, get_hub_nodes
+from replication import NodeReplicator, HUB_URL, NODE_ID, NODE_URL, REPLICATION_INTERVAL
 
 # Make the Flask app
 app = Flask(__name__)
@@ -17,6 +35,32 @@ cam_manager = CameraManager()
 VIDEO_FILES_DIR = os.path.join(EVENTS_STORAGE_DIR, VIDEOS_SUBDIR_NAME)
 THUMBNAIL_FILES_DIR = os.path.join(EVENTS_STORAGE_DIR, THUMBNAILS_SUBDIR_NAME)
 
+# Socket tuning for /video_feed connections, only applied under gunicorn (see gunicorn.conf.py)
+STREAM_SEND_TIMEOUT = getattr(config, "STREAM_SEND_TIMEOUT", 10)                  # A write blocked this long drops the client
+STREAM_SEND_BUFFER_BYTES = getattr(config, "STREAM_SEND_BUFFER_BYTES", 128 * 1024) # Small, so a slow client blocks early instead of queueing stale frames
+
+# Optional bearer token for /metrics; None leaves it open like /stream_status, for a Prometheus on the LAN
+METRICS_TOKEN = getattr(config, "METRICS_TOKEN", None)
+
+# Set when this node pushes its events to a hub (HUB_URL in config.py)
+replicator = None
+
+# Subsystems that must be up for /readyz to answer 200
+READY_SUBSYSTEMS = ("database", "camera")
+
+# Serialized /api/events responses, keyed by (events version, query). Entries from older
+# versions are dropped as soon as a new event is recorded.
+EVENTS_CACHE_SIZE = 64
+events_cache = collections.OrderedDict()
+events_cache_lock = threading.Lock()
+
+def logged_in():
+    # A browser session, or the hub fetching media of this node with the shared HUB_TOKEN
+    if 'user' in session:
+        return True
+    return bool(hub.HUB_TOKEN) and hmac.compare_digest(request.headers.get("Authorization", ""),
+                                                       f"Bearer {hub.HUB_TOKEN}")
+
 def load_jpeg_image(filename="placeholder.jpg"):
     """Loads a JPEG image from the static folder and returns its binary content."""
     image_path = os.path.join(app.static_folder, filename)
@@ -33,7 +77,7 @@ def load_jpeg_image(filename="placeholder.jpg"):
 
 @app.route('/media/thumbnails/<path:filename>')
 def serve_thumbnail(filename):
-    if 'user' not in session: # Protect thumbnails
+    if not logged_in(): # Protect thumbnails
         return "Access Denied", 403
     try:
         print(f"Attempting to serve thumbnail: {filename} from {THUMBNAIL_FILES_DIR}")
@@ -45,18 +89,42 @@ def serve_thumbnail(filename):
 
 @app.route('/media/videos/<path:filename>')
 def serve_video(filename):
-    if 'user' not in session: # Protect videos
+    if not logged_in(): # Protect videos
         return "Access Denied: Please login.", 403
     try:
         # VIDEO_FILES_DIR is the absolute path to MP4 video files
         print(f"Attempting to serve video: {filename} from {VIDEO_FILES_DIR}")
-        # send_from_directory handles range requests for video streaming
-        return send_from_directory(VIDEO_FILES_DIR, filename, as_attachment=False, mimetype='video/mp4')
+        video_path = safe_join(VIDEO_FILES_DIR, filename)
+        if video_path is None or not os.path.isfile(video_path):
+            return "Video not found", 404
+        ensure_faststart(video_path) # Remuxes older clips once, so playback starts right away
+        return send_video_file(video_path, request)
     except FileNotFoundError:
         return "Video not found", 404
     except Exception as e:
         return "Error serving video", 500
 
+# Continuous recording from a point in time: ?at=<unix seconds>, optionally ?until=<unix seconds>.
+# Looks up the segment and its keyframe in the index and serves from that fragment on, no file scanning;
+# a range that runs past the end of its segment goes on into the next ones.
+@app.route('/recording')
+def serve_recording():
+    if not logged_in():
+        return "Access Denied: Please login.", 403
+    at = request.args.get('at', type=float)
+    if at is None:
+        return "at= (unix seconds) is required", 400
+    found = find_recording(at, until=request.args.get('until', type=float))
+    if found is None:
+        return "No recording at that time", 404
+    path, init_size, pieces, keyframe_ts = found
+    if not all(os.path.isfile(piece.path) for piece in pieces):
+        return "No recording at that time", 404
+    length = init_size + sum(piece.end - piece.start for piece in pieces)
+    response = send_fragmented_range(iter_recording(path, init_size, pieces), length)
+    response.headers['X-Recording-Start'] = f"{keyframe_ts:.3f}" # The keyframe playback starts at
+    return response
+
 #Login Page
 @app.route('/', methods=['GET','POST'])
 def login():
@@ -78,18 +146,147 @@ def dashboard():
     if 'user' not in session:
         return redirect(url_for('login'))
 
-    page = request.args.get('page', 1, type=int) # Get page number for events, default to 1
+    # Keyset pagination: ?before=<cursor> for older events, ?after=<cursor> for newer ones.
+    # ?group=1 folds near-duplicate events into the first one of their group.
     per_page = 5 # Show fewer events per page on the dashboard
-    offset = (page - 1) * per_page
-    events_on_dashboard = get_video_events(limit=per_page, offset=offset)
+    grouped = request.args.get('group') == '1'
+    events_on_dashboard, older_cursor, newer_cursor = get_video_events_page(
+        per_page, before=request.args.get('before'), after=request.args.get('after'), grouped=grouped)
+    duplicates = count_duplicates([event['id'] for event in events_on_dashboard]) if grouped else {}
+    for event in events_on_dashboard:
+        event['duplicates'] = duplicates.get(event['id'], 0)
     
     return render_template(
         'index.html',
         user=session['user'],
         events=events_on_dashboard, # Pass the events to index.html
-        current_page=page # Pass current page for pagination
+        older_cursor=older_cursor, # Cursors for the pagination links
+        newer_cursor=newer_cursor,
+        grouped=grouped
         )
 
+def event_video_url(event):
+    # A clip of its own, or with continuous recording the event's range of the segments
+    if event.get('mp4_filepath'):
+        return url_for('serve_video', filename=os.path.basename(event['mp4_filepath']))
+    if event.get('clip_start') is not None:
+        return url_for('serve_recording', at=event['clip_start'], until=event['clip_end'])
+    return None
+
+app.jinja_env.globals['event_video_url'] = event_video_url
+
+def event_to_json(event):
+    mp4_name = os.path.basename(event['mp4_filepath']) if event.get('mp4_filepath') else None
+    thumb_name = os.path.basename(event['thumbnail_path']) if event.get('thumbnail_path') else None
+    sprite_name = os.path.basename(event['sprite_path']) if event.get('sprite_path') else None
+    video_url = event_video_url(event)
+    return {
+        "id": event['id'],
+        "cursor": event['cursor'],
+        "event_ts": event['event_ts'],
+        "event_timestamp": event['event_timestamp'],
+        "display_time": event['display_time_only'],
+        "event_type": event['event_type'],
+        "notes": event['notes'],
+        "is_archived": bool(event['is_archived']),
+        "exported_at": event['exported_at'],
+        "clip_start": event['clip_start'],
+        "clip_end": event['clip_end'],
+        "video_name": mp4_name or (f"{event['event_timestamp'][11:]} (segments)" if video_url else None),
+        "video_url": video_url,
+        "thumbnail_url": url_for('serve_thumbnail', filename=thumb_name) if thumb_name else None,
+        # Motion energy per second, peak and sprite tile times, in seconds into the video (see event_activity.py)
+        "activity": json.loads(event['activity']) if event.get('activity') else None,
+        "sprite_url": url_for('serve_thumbnail', filename=sprite_name) if sprite_name else None,
+        "duplicate_of": event['duplicate_of'],
+        "duplicates": event.get('duplicates', 0),
+    }
+
+# JSON events API: cursor pagination (before/after), filters (since/until as unix seconds, type,
+# group=1 for only the first event of each group of near-duplicates), cached in process and answered with 304 when the client already has the current version.
+@app.route('/api/events')
+def api_events():
+    if 'user' not in session:
+        return jsonify({"status": "error", "message": "Please login."}), 403
+
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    before = request.args.get('before')
+    after = request.args.get('after')
+    filters = {
+        "since": request.args.get('since', type=int),
+        "until": request.args.get('until', type=int),
+        "event_type": request.args.get('type'),
+        "grouped": request.args.get('group') == '1',
+    }
+    version, last_modified = get_events_version()
+    key = (version, limit, before, after, tuple(sorted(filters.items())))
+
+    with events_cache_lock:
+        cached = events_cache.get(key)
+        if cached is not None:
+            events_cache.move_to_end(key)
+    if cached is None:
+        events, older_cursor, newer_cursor = get_video_events_page(limit, before=before, after=after, **filters)
+        if filters["grouped"]:
+            duplicates = count_duplicates([event['id'] for event in events])
+            for event in events:
+                event['duplicates'] = duplicates.get(event['id'], 0)
+        body = json.dumps({
+            "events": [event_to_json(event) for event in events],
+            "older_cursor": older_cursor,
+            "newer_cursor": newer_cursor,
+            "total": count_video_events(**filters),
+        })
+        cached = (body, hashlib.sha1(body.encode()).hexdigest())
+        with events_cache_lock:
+            for stale_key in [k for k in events_cache if k[0] != version]:
+                del events_cache[stale_key]
+            events_cache[key] = cached
+            while len(events_cache) > EVENTS_CACHE_SIZE:
+                events_cache.popitem(last=False)
+
+    body, etag = cached
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True # Always revalidate, a 304 is cheap
+    return response.make_conditional(request)
+
+# Bulk download of events as one archive, streamed as it is written: ?since=&until= (unix seconds),
+# ?type=, ?format=tar|zip, and ?mark=1 to record the events as exported (retention then evicts them first)
+@app.route('/export')
+def export_events():
+    if 'user' not in session:
+        return jsonify({"status": "error", "message": "Please login."}), 403
+
+    fmt = request.args.get('format', 'tar')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"status": "error", "message": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    archive = EventArchive(fmt,
+                           since=request.args.get('since', type=int),
+                           until=request.args.get('until', type=int),
+                           event_type=request.args.get('type'),
+                           mark=request.args.get('mark') == '1')
+    total = archive.count()
+    if total == 0:
+        return jsonify({"status": "error", "message": "No events in that range."}), 404
+    if total > EXPORT_MAX_EVENTS:
+        return jsonify({"status": "error",
+                        "message": f"{total} events, at most {EXPORT_MAX_EVENTS} per export. Narrow the range."}), 400
+    if not acquire_export_slot():
+        return Response("An export is already running, try again later.", status=503,
+                        headers={"Retry-After": "30"}, mimetype='text/plain')
+
+    response = Response(archive.chunks(), mimetype=archive.mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{archive.filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    def close():
+        archive.close()
+        release_export_slot()
+    response.call_on_close(close)
+    return response
+
 # Logout route
 @app.route('/logout')
 def logout():
@@ -101,20 +298,69 @@ def events_page():
     if 'user' not in session:
         return redirect(url_for('login'))
 
-    page = request.args.get('page', 1, type=int) # Get page number from query param, default to 1
     per_page = 10 # Number of events per page
-    offset = (page - 1) * per_page
-    all_events = get_video_events(limit=per_page, offset=offset)
-    return render_template('events.html', events=all_events, current_page=page)
+    all_events, older_cursor, newer_cursor = get_video_events_page(
+        per_page, before=request.args.get('before'), after=request.args.get('after'))
+    return render_template('events.html', events=all_events, older_cursor=older_cursor, newer_cursor=newer_cursor)
 
-# Video feed route
+def tune_stream_socket(environ):
+    # Write backpressure for a stream: a small send buffer and a send timeout on the client socket.
+    # gunicorn exposes the socket, the development server does not.
+    sock = environ.get("gunicorn.socket")
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, STREAM_SEND_BUFFER_BYTES)
+        sock.settimeout(STREAM_SEND_TIMEOUT) # gunicorn resets it when the connection is reused
+    except OSError as e:
+        print(f"Could not tune stream socket: {e}")
+
+def stream_queue_probe(environ):
+    # Returns a callable giving the bytes still queued in the client socket (TIOCOUTQ), for the
+    # adaptive pacing's latency estimate. None when the socket is not available.
+    sock = environ.get("gunicorn.socket")
+    if sock is None or not hasattr(termios, "TIOCOUTQ"):
+        return None
+    def queued_bytes():
+        try:
+            return struct.unpack("i", fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0"))[0]
+        except OSError:
+            return 0
+    return queued_bytes
+
+def reset_stream_socket(environ):
+    # A dropped viewer still has stale frames queued. Discard them with a reset on close instead of
+    # letting the server linger on the socket, which would hold up its other connections.
+    sock = environ.get("gunicorn.socket")
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        sock.shutdown(socket.SHUT_RD)
+    except OSError:
+        pass # Already gone
+
+# Video feed route. Optional hints: ?fps= (max frame rate), ?q= (max JPEG quality), ?w= (max width)
 @app.route('/video_feed')
 def video_feed():
     if cam_manager.stream_active:
-        return Response(
-            cam_manager.generate_mjpeg_stream(),
+        if not cam_manager.acquire_viewer_slot():
+            return Response("Too many viewers, try again later.", status=503,
+                            headers={"Retry-After": "10"}, mimetype='text/plain')
+        environ = request.environ
+        tune_stream_socket(environ)
+        response = Response(
+            cam_manager.generate_mjpeg_stream(
+                max_fps=request.args.get('fps', type=float),
+                max_quality=request.args.get('q', type=int),
+                max_width=request.args.get('w', type=int),
+                queued_bytes=stream_queue_probe(environ),
+                on_dropped=lambda: reset_stream_socket(environ)),
             mimetype='multipart/x-mixed-replace; boundary=frame'
         )
+        # Runs even if the client disconnects before the first frame
+        response.call_on_close(cam_manager.release_viewer_slot)
+        return response
     else:
         placeholder_bytes = load_jpeg_image("placeholder.jpg")
         if placeholder_bytes:
@@ -123,6 +369,37 @@ def video_feed():
             # Fallback if placeholder couldn't be loaded
             return "Stream inactive and placeholder image is unavailable.", 404
 
+# H.264 live view as fragmented MP4, for a MediaSource player. Much lighter on the link than MJPEG.
+@app.route('/live_h264')
+def live_h264():
+    if not cam_manager.stream_active:
+        return "Stream inactive.", 404
+    if not cam_manager.acquire_viewer_slot():
+        return Response("Too many viewers, try again later.", status=503,
+                        headers={"Retry-After": "10"}, mimetype='text/plain')
+    if not cam_manager.start_live_h264():
+        cam_manager.release_viewer_slot()
+        return "H.264 live view unavailable.", 503
+    init_segment = cam_manager.live_h264.wait_for_init()
+    if init_segment is None:
+        cam_manager.stop_live_h264()
+        cam_manager.release_viewer_slot()
+        return "H.264 live view did not start in time.", 503
+
+    environ = request.environ
+    tune_stream_socket(environ)
+    response = Response(
+        cam_manager.generate_h264_stream(init_segment, on_dropped=lambda: reset_stream_socket(environ)),
+        mimetype='video/mp4'
+    )
+    response.headers['X-Codecs'] = cam_manager.live_h264.codec # For MediaSource.addSourceBuffer()
+    response.headers['Cache-Control'] = 'no-store'
+    def close():
+        cam_manager.stop_live_h264()
+        cam_manager.release_viewer_slot()
+    response.call_on_close(close)
+    return response
+
 # Route to start stream
 @app.route('/start_stream', methods=['POST'])
 def start_stream_route():
@@ -139,10 +416,179 @@ def stop_stream_route():
     else:
         return jsonify({"status": "error", "message": "Stream was not running"}), 400
 
+# Post-processing queue depth and per-stage latency, and the state of the worker process running it
+@app.route('/pipeline_status')
+def pipeline_status():
+    if 'user' not in session:
+        return jsonify({"status": "error", "message": "Please login."}), 403
+    stats = cam_manager.postprocessor.get_stats()
+    if cam_manager.worker is not None:
+        stats["worker"] = cam_manager.worker.stats()
+    return jsonify(stats)
+
+# Disk usage and eviction counters of the retention manager
+@app.route('/storage_status')
+def storage_status():
+    if 'user' not in session:
+        return jsonify({"status": "error", "message": "Please login."}), 403
+    stats = cam_manager.retention.stats()
+    if cam_manager.segments is not None:
+        stats["continuous_recording"] = cam_manager.segments.stats()
+    if replicator is not None:
+        stats["replication"] = replicator.stats()
+    return jsonify(stats)
+
+# Motion trigger state, counters and trigger-to-record latency
+@app.route('/motion_status')
+def motion_status():
+    if 'user' not in session:
+        return jsonify({"status": "error", "message": "Please login."}), 403
+    if cam_manager.motion_trigger is None:
+        return jsonify({"state": "off"})
+    return jsonify(cam_manager.motion_trigger.stats())
+
+# Liveness: the server answers, with the state of every subsystem for a look at startup progress
+@app.route('/healthz')
+def healthz():
+    return jsonify({"status": "ok", **STARTUP.snapshot()})
+
+# Readiness: 200 once the database and the camera are up, 503 until then (or if one of them failed)
+@app.route('/readyz')
+def readyz():
+    ready = STARTUP.ready(READY_SUBSYSTEMS)
+    return jsonify({"ready": ready, "required": list(READY_SUBSYSTEMS), **STARTUP.snapshot()}), (200 if ready else 503)
+
+# Prometheus scrape target: stage timings, lock waits, frame counters, queue depths, CPU and memory
+@app.route('/metrics')
+def metrics_route():
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return Response("Unauthorized\n", status=401, mimetype="text/plain")
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 # Route to check stream status
 @app.route('/stream_status')
 def stream_status():
-    return jsonify({"active": cam_manager.stream_active})
+    return jsonify(cam_manager.get_stream_stats())
+
+# --- Hub mode (HUB_MODE in config.py): events of every camera node in one place, see hub.py ---
+
+def hub_event_to_json(event):
+    if event['node_id'] == NODE_ID: # The hub's own camera
+        thumb_name = os.path.basename(event['thumbnail_path']) if event.get('thumbnail_path') else None
+        video_url = event_video_url(event)
+        thumbnail_url = url_for('serve_thumbnail', filename=thumb_name) if thumb_name else None
+    else:
+        video_url = url_for('hub_video', node_id=event['node_id'], remote_id=event['id']) if event['video_path'] else None
+        thumbnail_url = (url_for('hub_thumbnail', node_id=event['node_id'],
+                                 filename=os.path.basename(event['thumbnail_path']))
+                         if event['thumbnail_path'] else None)
+    return {
+        "node_id": event['node_id'],
+        "id": event['id'],
+        "cursor": event['cursor'],
+        "event_ts": event['event_ts'],
+        "event_timestamp": event['event_timestamp'],
+        "display_time": event['event_timestamp'][11:16] if event['event_timestamp'] else 'N/A',
+        "event_type": event['event_type'],
+        "notes": event['notes'],
+        "is_archived": bool(event['is_archived']),
+        "clip_start": event['clip_start'],
+        "clip_end": event['clip_end'],
+        "video_url": video_url,
+        "thumbnail_url": thumbnail_url,
+    }
+
+# Nodes push their event changes here (see replication.py), with HUB_TOKEN as a bearer token. Without a
+# HUB_TOKEN nothing is accepted: anyone could register a node URL the hub then fetches videos from.
+@app.route('/hub/ingest', methods=['POST'])
+def hub_ingest():
+    if not hub.HUB_MODE:
+        return "Not a hub.", 404
+    if not hub.HUB_TOKEN:
+        return jsonify({"status": "error", "message": "Hub mode needs HUB_TOKEN in config.py."}), 403
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {hub.HUB_TOKEN}"):
+        return jsonify({"status": "error", "message": "Bad hub token."}), 401
+    if request.content_length is None or request.content_length > hub.HUB_MAX_INGEST_BYTES:
+        return jsonify({"status": "error", "message": f"Ingest requests need a Content-Length of at most "
+                                                      f"{hub.HUB_MAX_INGEST_BYTES} bytes."}), 413
+    request.max_content_length = hub.HUB_MAX_INGEST_BYTES
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict) and payload.get("node_id") == NODE_ID:
+        return jsonify({"status": "error", "message": f"node_id {NODE_ID} is the hub's own."}), 400
+    try:
+        applied, new_node = hub.ingest(payload)
+    except hub.IngestError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "ok", "applied": applied, "new_node": new_node})
+
+# Merged event list of the hub's own camera and all nodes, newest first: ?before= (cursor), ?limit=, ?since=, ?until=, ?type=, ?node=
+@app.route('/hub/events')
+def hub_events():
+    if not hub.HUB_MODE:
+        return "Not a hub.", 404
+    if 'user' not in session:
+        return jsonify({"status": "error", "message": "Please login."}), 403
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    events = get_merged_video_events(limit=limit + 1, before=request.args.get('before'),
+                                     since=request.args.get('since', type=int), until=request.args.get('until', type=int),
+                                     event_type=request.args.get('type'), local_node_id=NODE_ID,
+                                     node_id=request.args.get('node'))
+    older_cursor = events[limit - 1]['cursor'] if len(events) > limit else None
+    return jsonify({"events": [hub_event_to_json(event) for event in events[:limit]], "older_cursor": older_cursor})
+
+@app.route('/hub/nodes')
+def hub_nodes():
+    if not hub.HUB_MODE:
+        return "Not a hub.", 404
+    if 'user' not in session:
+        return jsonify({"status": "error", "message": "Please login."}), 403
+    return jsonify({"local_node_id": NODE_ID, "nodes": get_hub_nodes()})
+
+@app.route('/hub')
+def hub_page():
+    if not hub.HUB_MODE:
+        return "Not a hub.", 404
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    return render_template('hub.html', user=session['user'], nodes=get_hub_nodes())
+
+@app.route('/hub/thumbnails/<node_id>/<filename>')
+def hub_thumbnail(node_id, filename):
+    if not hub.HUB_MODE:
+        return "Not a hub.", 404
+    if 'user' not in session:
+        return "Access Denied", 403
+    if not hub.valid_name(node_id) or not hub.valid_name(filename):
+        return "Thumbnail not found", 404
+    return send_from_directory(hub.node_dir(node_id, "thumbnails"), filename, as_attachment=False)
+
+# A node's event video, fetched from the node on first request and served from the hub cache after that
+@app.route('/hub/videos/<node_id>/<int:remote_id>')
+def hub_video(node_id, remote_id):
+    if not hub.HUB_MODE:
+        return "Not a hub.", 404
+    if 'user' not in session:
+        return "Access Denied: Please login.", 403
+    path = hub.fetch_video(node_id, remote_id) if hub.valid_name(node_id) else None
+    if path is None:
+        return "Video not available", 404
+    return send_video_file(path, request)
+
+# A node's live view (video_feed or live_h264, same query hints), relayed as the node sends it
+@app.route('/hub/live/<node_id>/<kind>')
+def hub_live(node_id, kind):
+    if not hub.HUB_MODE:
+        return "Not a hub.", 404
+    if 'user' not in session:
+        return "Access Denied: Please login.", 403
+    opened = hub.open_live(node_id, kind, request.args.to_dict())
+    if opened is None:
+        return "Live view unavailable.", 502
+    upstream, headers = opened
+    tune_stream_socket(request.environ)
+    response = Response(hub.live_chunks(upstream), status=upstream.status, headers=headers, direct_passthrough=True)
+    response.call_on_close(upstream.close)
+    return response
 
 # Create templates directory
 def create_templates_dir():
@@ -150,21 +596,80 @@ def create_templates_dir():
     os.makedirs("/home/seedx/pizero/events", exist_ok=True)
     #os.makedirs(THUMBNAILS_STORAGE_DIR, exist_ok=True)
 
-# Main program starts here
-if __name__ == '__main__':
-    print("Starting security camera app...")
+_services_started = False
+_services_lock = threading.Lock()
 
-    init_db()
+def start_background_services():
+    """Starts everything besides the web server. Called once, from __main__ or the gunicorn worker.
 
-    # Create directories
-    create_templates_dir()
+    Only the database schema is set up here; the rest comes up in a
+    background thread so the server starts answering right away.
+    /healthz and /readyz report the progress.
+    """
+    global _services_started
+    with _services_lock:
+        if _services_started:
+            return
+        _services_started = True
+
+    try:
+        init_db()
+        STARTUP.set("database", READY)
+    except Exception as e:
+        print(f"Database setup failed: {e}")
+        STARTUP.set("database", FAILED, str(e))
+
+    threading.Thread(target=_start_subsystems, name="startup", daemon=True).start()
+    STARTUP.milestone("http_ready")
 
-    cam_manager.noti.send_telegram_message("Security camera system is starting...")
+def _start_subsystems():
+    # Camera first: its setup runs while the rest starts, and autofocus continues in its own thread
+    threading.Thread(target=cam_manager.setup_camera, name="camera-setup", daemon=True).start()
 
-    # Start the motion detection in a background thread
+    # Start the motion detection in a background thread (the PIR settles without blocking it)
     motion_thread = threading.Thread(target=check_for_motion,args=(cam_manager,),daemon=True)
     motion_thread.start()
 
-    # Run the Flask app
-    app.run(host="0.0.0.0", port=5000)
+    # Create directories
+    create_templates_dir()
+
+    if cam_manager.worker is not None:
+        # Post-processing and storage quota enforcement in the background worker process
+        cam_manager.worker.start()
+        STARTUP.set("postprocessing", READY, "worker process")
+        STARTUP.set("retention", READY, "worker process")
+    else:
+        # Start the post-processing workers (resumes jobs left over from the last run)
+        cam_manager.postprocessor.start()
+        STARTUP.set("postprocessing", READY)
+
+        # Background storage quota enforcement
+        cam_manager.retention.start()
+        STARTUP.set("retention", READY)
+
+    if hub.HUB_MODE and not hub.HUB_TOKEN:
+        print("Hub mode is on but HUB_TOKEN is not set: /hub/ingest refuses every node until it is.")
+    if HUB_URL:
+        global replicator
+        replicator = NodeReplicator(HUB_URL, NODE_ID, NODE_URL, token=hub.HUB_TOKEN, interval=REPLICATION_INTERVAL)
+        replicator.start()
+        STARTUP.set("replication", READY)
+    else:
+        STARTUP.set("replication", DISABLED, "HUB_URL not set")
+
+    if cam_manager.noti.bot_token and cam_manager.noti.chat_id:
+        cam_manager.noti.send_telegram_message("Security camera system is starting...")
+        STARTUP.set("telegram", READY)
+    else:
+        STARTUP.set("telegram", DISABLED, "BOT_TOKEN / CHAT_ID not set")
+
+# Main program starts here. Development server; for production use
+# gunicorn -c gunicorn.conf.py (see that file).
+if __name__ == '__main__':
+    print("Starting security camera app...")
+    start_background_services()
+
+    # Run the Flask app, on the address gunicorn would use
+    host, port = getattr(config, "SERVER_BIND", "0.0.0.0:5000").rsplit(":", 1)
+    app.run(host=host, port=int(port))
 
@@ -1,56 +1,268 @@
-import requests
+import collections
+import threading
+import time
 import subprocess
 import os
+import config
 from config import CHAT_ID, BOT_TOKEN
+import metrics
+from metrics import stage_timer, TELEGRAM_REQUESTS
+
+# Optional settings, older config.py files may not define them
+TELEGRAM_API_BASE = getattr(config, "TELEGRAM_API_BASE", "https://api.telegram.org") # Point at a local stand-in for testing
+TELEGRAM_VIDEO_LIMIT_BYTES = getattr(config, "TELEGRAM_VIDEO_LIMIT_BYTES", 50 * 1024 * 1024) # Bot API upload limit
+TELEGRAM_TRANSCODE_CODEC = getattr(config, "TELEGRAM_TRANSCODE_CODEC", "h264_v4l2m2m") # Pi hardware encoder
+TELEGRAM_QUEUE_SIZE = getattr(config, "TELEGRAM_QUEUE_SIZE", 100)
+TELEGRAM_MAX_ATTEMPTS = getattr(config, "TELEGRAM_MAX_ATTEMPTS", 5)
+TELEGRAM_COALESCE_SECONDS = getattr(config, "TELEGRAM_COALESCE_SECONDS", 1.0) # Messages within this window go out as one
+
+# Outcome of a send
+SENT = "sent"
+FAILED = "failed"     # Network error, 5xx or rate limited: may work later
+REJECTED = "rejected" # Other 4xx, or a video that cannot be shrunk under the limit: retrying will not help
+
+
+class _Delivery:
+    def __init__(self, kind, content, attempts=TELEGRAM_MAX_ATTEMPTS):
+        self.kind = kind       # "message" or "video"
+        self.content = content # Text or video path
+        self.attempts = attempts # 1 when the caller does its own retrying
+        self.done = threading.Event()
+        self.status = None
+
+    @property
+    def ok(self):
+        return self.status == SENT
+
+    def finish(self, status):
+        self.status = status
+        self.done.set()
+
+
+class TelegramDispatcher:
+    """Background sender for Telegram notifications.
+
+    Keeps one keep-alive requests.Session (no TLS handshake per message) and
+    a bounded in-order send queue worked off by a single thread. Text
+    messages queued close together are coalesced into one message. Failed
+    sends are retried with exponential backoff (unless the caller asked for
+    a single attempt because it retries itself), and a 429 answer pauses
+    all sending for the retry_after Telegram asks for.
+    """
+
+    def __init__(self, base_url, chat_id, max_queue=TELEGRAM_QUEUE_SIZE):
+        import requests # Deferred until the first notification, it is slow to import
+        self.base_url = base_url
+        self.chat_id = chat_id
+        self.max_queue = max_queue
+        self.session = requests.Session()
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._blocked_until = 0.0 # Set from 429 retry_after
+        self._thread = threading.Thread(target=self._run, name="telegram-dispatcher", daemon=True)
+        self._thread.start()
+        metrics.gauge_callback("pizero_telegram_queue_depth", "Telegram messages and videos waiting to be sent.",
+                               self.queue_depth)
+
+    def submit(self, kind, content, attempts=TELEGRAM_MAX_ATTEMPTS):
+        delivery = _Delivery(kind, content, attempts)
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                print(f"Telegram queue full, dropping {kind}.")
+                delivery.finish(FAILED)
+                return delivery
+            self._queue.append(delivery)
+            self._cond.notify()
+        return delivery
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def _next_batch(self):
+        # Returns the next video, or all text messages queued in a row at the head of the queue
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            if self._queue[0].kind != "message":
+                return [self._queue.popleft()]
+        time.sleep(TELEGRAM_COALESCE_SECONDS) # Give a burst the chance to pile up
+        batch = []
+        with self._cond:
+            while self._queue and self._queue[0].kind == "message":
+                batch.append(self._queue.popleft())
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            attempts = max(delivery.attempts for delivery in batch)
+            try:
+                if batch[0].kind == "message":
+                    text = "\n".join(d.content for d in batch)
+                    status = self._post("sendMessage", {"chat_id": self.chat_id, "text": text}, attempts=attempts)
+                else:
+                    status = self._send_video(batch[0].content, attempts)
+            except Exception as e:
+                print(f"Error sending Telegram {batch[0].kind}: {e}")
+                status = FAILED
+            for delivery in batch:
+                delivery.finish(status)
+
+    def _post(self, method, data, video_path=None, timeout=15, attempts=TELEGRAM_MAX_ATTEMPTS):
+        # Returns SENT, FAILED (after attempts tries) or REJECTED
+        import requests
+        url = f"{self.base_url}/{method}"
+        for attempt in range(1, attempts + 1):
+            last = attempt == attempts
+            wait = self._blocked_until - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                with stage_timer(f"telegram_{method}"):
+                    if video_path:
+                        with open(video_path, "rb") as video_file:
+                            response = self.session.post(url, data=data, files={"video": video_file}, timeout=timeout)
+                    else:
+                        response = self.session.post(url, data=data, timeout=timeout)
+            except requests.exceptions.RequestException as e:
+                TELEGRAM_REQUESTS.labels(method, "network_error").inc()
+                print(f"Telegram {method} attempt {attempt} failed: {e}")
+                if not last:
+                    time.sleep(min(2 ** attempt, 60))
+                continue
+
+            TELEGRAM_REQUESTS.labels(method, response.status_code).inc()
+            if response.ok:
+                return SENT
+            if response.status_code == 429:
+                try:
+                    retry_after = response.json().get("parameters", {}).get("retry_after", 5)
+                except ValueError:
+                    retry_after = 5
+                print(f"Telegram rate limit hit, waiting {retry_after}s.")
+                self._blocked_until = time.time() + retry_after
+                continue
+            if response.status_code >= 500:
+                print(f"Telegram {method} attempt {attempt} failed: HTTP {response.status_code}")
+                if not last:
+                    time.sleep(min(2 ** attempt, 60))
+                continue
+            # Other 4xx errors will not get better by retrying
+            print(f"Telegram {method} rejected: HTTP {response.status_code} {response.text[:200]}")
+            return REJECTED
+        print(f"Telegram {method} failed after {attempts} attempt(s).")
+        return FAILED
+
+    def _send_video(self, video_path, attempts=TELEGRAM_MAX_ATTEMPTS):
+        upload_path = video_path
+        if os.path.getsize(video_path) > TELEGRAM_VIDEO_LIMIT_BYTES:
+            upload_path = shrink_video(video_path, TELEGRAM_VIDEO_LIMIT_BYTES)
+            if upload_path is None:
+                return REJECTED
+        try:
+            # Uploads get a longer timeout, a few MB over a Pi Zero's Wi-Fi takes a while
+            return self._post("sendVideo", {"chat_id": self.chat_id}, video_path=upload_path, timeout=120,
+                              attempts=attempts)
+        finally:
+            if upload_path != video_path:
+                os.remove(upload_path)
+
+
+def shrink_video(video_path, limit_bytes):
+    """Transcodes a video to fit under limit_bytes. Returns the path of the smaller copy or None."""
+    import av
+    with av.open(video_path) as container:
+        duration = (container.duration or 0) / av.time_base
+    if duration <= 0:
+        print(f"Cannot shrink {video_path}: unknown duration.")
+        return None
+    bitrate = int(limit_bytes * 8 * 0.9 / duration) # 10% headroom for the container
+    small_path = os.path.splitext(video_path)[0] + "_small.mp4"
+    for codec in (TELEGRAM_TRANSCODE_CODEC, "libx264"):
+        command = ["ffmpeg", "-y", "-i", video_path, "-an", "-vf", "scale=-2:min(ih\\,720)",
+                   "-c:v", codec, "-b:v", str(bitrate), "-maxrate", str(bitrate),
+                   "-bufsize", str(bitrate), "-movflags", "+faststart", small_path]
+        with stage_timer("ffmpeg"):
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        if result.returncode == 0 and os.path.getsize(small_path) <= limit_bytes:
+            print(f"Shrunk {video_path} to {os.path.getsize(small_path)} bytes with {codec}.")
+            return small_path
+    print(f"Could not shrink {video_path} under {limit_bytes} bytes.")
+    if os.path.exists(small_path):
+        os.remove(small_path)
+    return None
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def get_dispatcher():
+    # One dispatcher (one session, one queue) shared by every notiManager
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = TelegramDispatcher(f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}", CHAT_ID)
+        return _dispatcher
+
 
 class notiManager:
-    
+
     def __init__(self):
         self.bot_token = BOT_TOKEN
         self.chat_id = CHAT_ID
-        self.base_url = f"https://api.telegram.org/bot{self.bot_token}"
-        
-    
-    # Function to send message on Telegram
-    def send_telegram_message(self, message):
-        
+        self.base_url = f"{TELEGRAM_API_BASE}/bot{self.bot_token}"
+
+
+    # Function to send message on Telegram. Queued, returns right away unless wait=True.
+    def send_telegram_message(self, message, wait=False):
+
         if not self.bot_token or not self.chat_id:
             print("Telegram not configured. Cannot send message.")
-            return
+            return False
         print(f"Sending Telegram message: {message}")
-        url = f"{self.base_url}/sendMessage"    
-        data = {"chat_id": self.chat_id, "text": message}
-        try:
-            response = requests.post(url, data=data, timeout=10)            
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending Telegram message: {e}")
+        delivery = get_dispatcher().submit("message", message)
+        if wait:
+            delivery.done.wait()
+            return delivery.ok
+        return True
+
+    # Function to send video on Telegram. Queued, returns right away unless wait=True.
+    def send_telegram_video(self, video_path, wait=False):
 
-    # Function to send video on Telegram
-    def send_telegram_video(self, video_path):
-        
         if not self.bot_token or not self.chat_id:
             print("Telegram not configured. Cannot send message.")
-            return
-       
+            return False
+
         print(f"Sending video to Telegram: {video_path}")
-        url = f"{self.base_url}/sendVideo" 
-        try:
-            with open(video_path, "rb") as video_file:
-                data = {"chat_id": self.chat_id}
-                files = {"video": video_file}
-                requests.post(url, data=data, files=files)
-        except Exception:
-            print(f"Error sending Telegram video:")
+        delivery = get_dispatcher().submit("video", video_path)
+        if wait:
+            delivery.done.wait()
+            return delivery.ok
+        return True
+
+    # Sends a video with a single attempt and waits for it, for callers that retry themselves
+    # (the upload stage). Returns SENT, FAILED or REJECTED.
+    def send_telegram_video_once(self, video_path):
+
+        if not self.bot_token or not self.chat_id:
+            print("Telegram not configured. Cannot send message.")
+            return REJECTED
+
+        print(f"Sending video to Telegram: {video_path}")
+        delivery = get_dispatcher().submit("video", video_path, attempts=1)
+        delivery.done.wait()
+        return delivery.status
 
     # Convert h264 to mp4 for telegram
     def convert_video_to_mp4(self, video_path):
         print(f"Converting video to MP4: {video_path}")
-        
+
         mp4_file = video_path.replace(".h264", ".mp4")
-        command = ["ffmpeg", "-i", video_path, "-c:v", "copy", mp4_file]
+        command = ["ffmpeg", "-y", "-i", video_path, "-c:v", "copy", "-movflags", "+faststart", mp4_file]
         try:
-            subprocess.run(command, check=True)
+            with stage_timer("ffmpeg"):
+                subprocess.run(command, check=True)
             return mp4_file
         except FileNotFoundError:
             print("Error: 'ffmpeg' command not found. Please ensure it is installed.")
-            return None    
\ No newline at end of file
+            return None
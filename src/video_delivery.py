@@ -0,0 +1,180 @@
+import collections
+import os
+import struct
+import threading
+from flask import Response
+
+VIDEO_CACHE_CONTROL = "private, max-age=31536000, immutable" # A clip never changes once it is served
+READ_BLOCK_SIZE = 64 * 1024
+
+FASTSTART_CHECKED_SIZE = 1024 # Files remembered as checked; one forgotten is only looked at again
+
+_faststart_checked = collections.OrderedDict() # path -> (mtime_ns, size) of files known to have their index up front, LRU
+_faststart_locks = {}   # path -> [lock held while that file is checked or remuxed, requests using it]
+_faststart_locks_guard = threading.Lock() # Also guards _faststart_checked
+
+
+def index_at_front(path):
+    """True when the MP4's moov atom (or a fragmented MP4's empty moov) comes before the media data."""
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            size, kind = struct.unpack(">I4s", f.read(8))
+            if size == 1: # 64-bit size follows the type
+                size = struct.unpack(">Q", f.read(8))[0]
+            elif size == 0: # Atom runs to the end of the file
+                size = file_size - offset
+            if kind == b"moov":
+                return True
+            if kind in (b"mdat", b"moof"):
+                return False
+            if size < 8:
+                return False # Corrupt, leave the file alone
+            offset += size
+    return False
+
+
+def remux_faststart(path):
+    # Rewrites the file with the index at the front. Packets are copied, nothing is re-encoded.
+    import av
+    tmp_path = path + ".faststart.tmp"
+    try:
+        with av.open(path) as source, av.open(tmp_path, "w", format="mp4", options={"movflags": "+faststart"}) as target:
+            source_stream = source.streams.video[0]
+            target_stream = target.add_stream_from_template(source_stream)
+            for packet in source.demux(source_stream):
+                if packet.dts is None: # Demuxer flush packet
+                    continue
+                packet.stream = target_stream
+                target.mux(packet)
+        os.replace(tmp_path, path)
+        print(f"Remuxed {path} with its index at the front.")
+        return True
+    except Exception as e:
+        print(f"Could not remux {path} for fast start: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def ensure_faststart(path):
+    """Makes sure the MP4 at path can start playing before it is fully downloaded.
+
+    Checked once per file version (mtime and size), older clips converted
+    without +faststart are remuxed the first time they are requested.
+    """
+    stat = os.stat(path)
+    if _checked(path, stat):
+        return
+    # One lock per file: remuxing an old clip only holds up the requests for that clip.
+    # It is dropped with the last request using it, so deleted files leave nothing behind.
+    with _faststart_locks_guard:
+        entry = _faststart_locks.setdefault(path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            stat = os.stat(path) # Another request may have remuxed it meanwhile
+            if _checked(path, stat):
+                return
+            if not index_at_front(path):
+                remux_faststart(path)
+                stat = os.stat(path)
+            with _faststart_locks_guard:
+                _faststart_checked[path] = (stat.st_mtime_ns, stat.st_size)
+                while len(_faststart_checked) > FASTSTART_CHECKED_SIZE:
+                    _faststart_checked.popitem(last=False)
+    finally:
+        with _faststart_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _faststart_locks[path]
+
+
+def _checked(path, stat):
+    # True when this version of the file was already checked
+    with _faststart_locks_guard:
+        if _faststart_checked.get(path) != (stat.st_mtime_ns, stat.st_size):
+            return False
+        _faststart_checked.move_to_end(path)
+        return True
+
+
+def _read_range(f, length):
+    # Fallback body for servers without a sendfile capable file_wrapper
+    try:
+        while length > 0:
+            chunk = f.read(min(READ_BLOCK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def send_video_file(path, request, mimetype="video/mp4"):
+    """Serves a video file with strong ETags, immutable caching and byte ranges.
+
+    Under gunicorn the body is the server's wsgi.file_wrapper around a file
+    positioned at the range start, with Content-Length set to the range
+    length; gunicorn then transmits exactly that slice with sendfile(), so
+    the bytes never pass through Python.
+    """
+    stat = os.stat(path)
+    etag = f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+    file_size = stat.st_size
+
+    response = Response(mimetype=mimetype, direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = stat.st_mtime
+    response.headers["Cache-Control"] = VIDEO_CACHE_CONTROL
+    response.headers["Accept-Ranges"] = "bytes"
+
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+
+    start, stop = 0, file_size
+    byte_range = request.range
+    if_range = request.if_range
+    # An If-Range that does not match means the client's partial copy is outdated, send the whole file
+    range_valid = (if_range.etag is None and if_range.date is None) or if_range.etag == etag
+    # Several ranges would need a multipart/byteranges body; RFC 9110 lets a server ignore such a Range
+    # and answer 200 with the whole file, which players handle fine
+    if byte_range is not None and range_valid and len(byte_range.ranges) == 1:
+        bounds = byte_range.range_for_length(file_size)
+        if bounds is None:
+            response.status_code = 416
+            response.headers["Content-Range"] = f"bytes */{file_size}"
+            return response
+        start, stop = bounds
+        response.status_code = 206
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{file_size}"
+
+    length = stop - start
+    response.headers["Content-Length"] = str(length)
+    if request.method == "HEAD":
+        return response
+
+    f = open(path, "rb")
+    f.seek(start)
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None and "gunicorn.socket" in request.environ:
+        response.response = file_wrapper(f, READ_BLOCK_SIZE) # gunicorn limits it to Content-Length
+        response.call_on_close(f.close)
+    else:
+        response.response = _read_range(f, length)
+    return response
+
+
+def send_fragmented_range(chunks, length, mimetype="video/mp4"):
+    """Serves part of a fragmented MP4 as a playable file: chunks yields its ftyp+moov and then the
+    fragments to play, length bytes in all (see segment_recorder.iter_recording). Never held whole.
+    """
+    response = Response(chunks, mimetype=mimetype, direct_passthrough=True)
+    response.headers["Content-Length"] = str(length)
+    response.headers["Cache-Control"] = "private, no-cache" # Same URL, more footage while the segment is open
+    response.headers["Accept-Ranges"] = "none"
+    return response
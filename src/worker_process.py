@@ -0,0 +1,399 @@
+"""Background worker process: post-processing and retention, away from the web process.
+
+On the single core of a Pi Zero, converting, thumbnailing and uploading a
+clip in the web process leaves the live view and the web UI waiting (one
+GIL, one core). WorkerSupervisor, which lives in the web process, starts
+this file as a separate process that
+
+  * lowers its own CPU and I/O priority first (nice, ionice, optionally
+    SCHED_IDLE); its threads and the ffmpeg processes it starts inherit them,
+  * runs the post-processing stages (event_jobs.py) and the retention manager,
+  * exchanges only small JSON lines with the web process over a socketpair:
+    job wake-ups and the paths of finished files one way, a stats heartbeat
+    the other. The jobs themselves go through the postprocess_jobs table both
+    processes share (its events_changes counter tells the web process about
+    new events); frames never leave the web process.
+
+The supervisor restarts the worker when it exits or stops answering, with
+a growing delay. While the live view falls behind (frame delivery latency
+over WORKER_LATENCY_TARGET) it pauses the worker's process group with
+SIGSTOP/SIGCONT in short slices, at most WORKER_THROTTLE_MAX_DUTY of the
+time, so background work slows down but never stops.
+
+    python worker_process.py --fd N --parent PID   (started by WorkerSupervisor)
+"""
+import argparse
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import config
+import metrics
+from config import EVENTS_STORAGE_DIR
+from startup import STARTUP, STARTING, READY, FAILED
+
+WORKER_PROCESS = getattr(config, "WORKER_PROCESS", True)           # False runs post-processing and retention in the web process
+WORKER_NICE = getattr(config, "WORKER_NICE", 10)                     # Added to the worker's nice value
+WORKER_IONICE = getattr(config, "WORKER_IONICE", (2, 7))             # (class, level) for ionice: best effort, lowest; (3, 0) is idle; None leaves it
+WORKER_SCHED_IDLE = getattr(config, "WORKER_SCHED_IDLE", False)      # Only run when nothing else wants the CPU (can starve the worker)
+WORKER_LATENCY_TARGET = getattr(config, "WORKER_LATENCY_TARGET", getattr(config, "STREAM_LATENCY_TARGET", 0.5)) # Seconds
+WORKER_THROTTLE_MAX_DUTY = getattr(config, "WORKER_THROTTLE_MAX_DUTY", 0.75) # Share of the time the worker may be paused, 0 = never
+WORKER_HEARTBEAT_INTERVAL = getattr(config, "WORKER_HEARTBEAT_INTERVAL", 5)  # Seconds between stats from the worker
+WORKER_HANG_TIMEOUT = getattr(config, "WORKER_HANG_TIMEOUT", 60)             # Kill and restart a worker silent this long
+WORKER_RESTART_MAX_DELAY = getattr(config, "WORKER_RESTART_MAX_DELAY", 60)   # Seconds, the delay doubles from 1 with every crash
+
+THROTTLE_SLICE = 0.25          # Seconds the worker is paused at a time
+THROTTLE_CHECK_INTERVAL = 0.25 # How often the latency is looked at while the worker runs freely
+STABLE_SECONDS = 60            # A worker that ran this long is restarted after 1s again
+
+_METRIC_NAME = re.compile(r"^(# (?:HELP|TYPE) )?(?:pizero_)?([a-zA-Z_:][a-zA-Z0-9_:]*)")
+
+
+class Channel:
+    """JSON lines over one end of the socketpair between the web process and the worker."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._reader = sock.makefile("r", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def send(self, **message):
+        data = (json.dumps(message, separators=(",", ":")) + "\n").encode()
+        with self._lock:
+            self.sock.sendall(data)
+
+    def __iter__(self):
+        # Until the other end closes
+        try:
+            for line in self._reader:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    print(f"Worker channel: ignoring malformed message {line[:100]!r}")
+        except (OSError, ValueError): # Closed from this side
+            return
+
+    def close(self):
+        try:
+            self._reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+# --- Worker side ---
+
+def lower_priority(nice=WORKER_NICE, ionice=WORKER_IONICE, sched_idle=WORKER_SCHED_IDLE):
+    """Lowers the CPU and I/O priority of this process. Returns what was applied.
+
+    Linux keeps these per thread, so this runs before any thread is
+    started; later threads and child processes inherit them.
+    """
+    applied = {}
+    if nice:
+        applied["nice"] = os.nice(nice)
+    if sched_idle:
+        try:
+            os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+            applied["sched"] = "idle"
+        except (AttributeError, OSError) as e:
+            print(f"Worker: SCHED_IDLE not available: {e}")
+    if ionice:
+        io_class, level = ionice
+        command = ["ionice", "-c", str(io_class), *(["-n", str(level)] if io_class == 2 else []), "-p", str(os.getpid())]
+        try:
+            subprocess.run(command, check=True, capture_output=True)
+            applied["ionice"] = f"{io_class}/{level}"
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Worker: could not lower the I/O priority ({' '.join(command)}): {e}")
+    return applied
+
+
+def _tie_to_parent(parent_pid):
+    # Named in top/ps and killed along with the web process. python-prctl is Linux only; without
+    # it the worker still exits once the socket to the web process closes.
+    try:
+        import prctl
+        prctl.set_name("pizero-worker")
+        prctl.set_pdeathsig(signal.SIGTERM)
+    except ImportError:
+        pass
+    return os.getppid() == parent_pid # False if the web process went away before the death signal was set
+
+
+def _worker_metrics():
+    # This process's metrics renamed pizero_worker_*, so the web process can show them next to its own
+    return [_METRIC_NAME.sub(lambda m: f"{m.group(1) or ''}pizero_worker_{m.group(2)}", line, count=1)
+            for line in metrics.render().splitlines() if line]
+
+
+def _report(channel, retention):
+    # The only thread that writes to the web process: stats every heartbeat
+    try:
+        while True:
+            channel.send(op="stats", retention=retention.stats(), metrics=_worker_metrics())
+            time.sleep(WORKER_HEARTBEAT_INTERVAL)
+    except OSError:
+        pass # The web process is gone, the main thread sees it too
+
+
+def run_worker(fd, parent_pid):
+    applied = lower_priority()
+    if not _tie_to_parent(parent_pid):
+        return
+    channel = Channel(socket.socket(fileno=fd))
+
+    # Imported here, the web process only needs the supervisor side of this module
+    from telegram_handler import notiManager
+    from postprocess import PostProcessor
+    from event_jobs import EventJobs, POSTPROCESS_MAX_PENDING
+    from retention import RetentionManager, STORAGE_MAX_BYTES, STORAGE_MIN_FREE_BYTES
+
+    retention = RetentionManager(EVENTS_STORAGE_DIR, max_bytes=STORAGE_MAX_BYTES, min_free_bytes=STORAGE_MIN_FREE_BYTES)
+    postprocessor = EventJobs(notiManager(), retention.file_added).register(PostProcessor(max_pending=POSTPROCESS_MAX_PENDING))
+    postprocessor.start() # Re-queues the jobs a crashed worker left running
+    retention.start()
+    print(f"Worker: running (pid {os.getpid()}, {applied or 'priority unchanged'}).")
+    channel.send(op="hello", pid=os.getpid(), priority=applied)
+    threading.Thread(target=_report, args=(channel, retention), name="worker-report", daemon=True).start()
+
+    for message in channel:
+        op = message.get("op")
+        if op == "wake":
+            postprocessor.wake()
+        elif op == "file_added":
+            retention.file_added(*message.get("paths", ()))
+    print("Worker: the web process closed the connection, exiting.")
+
+
+# --- Web process side ---
+
+class RetentionProxy:
+    """Stands in for the worker's RetentionManager in the web process."""
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+
+    def file_added(self, *paths):
+        paths = [path for path in paths if path]
+        if paths:
+            self.supervisor.send(op="file_added", paths=paths)
+
+    def stats(self):
+        # As of the last heartbeat, {} until the worker sent one
+        return dict(self.supervisor.retention_stats or {})
+
+
+class _ForwardedMetrics:
+    # The worker's metrics from its last heartbeat, rendered as part of the web process's /metrics
+    name = "pizero_worker_forwarded"
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+
+    def render(self):
+        return list(self.supervisor.forwarded_metrics)
+
+
+class WorkerSupervisor:
+    """Starts the worker process, restarts it when it dies, and pauses it while the live view is behind.
+
+    latency() returns the frame delivery latency to protect in seconds,
+    None when nobody is watching.
+    """
+
+    def __init__(self, latency=None, latency_target=WORKER_LATENCY_TARGET, max_duty=WORKER_THROTTLE_MAX_DUTY):
+        self.latency = latency
+        self.latency_target = latency_target
+        self.max_duty = min(max_duty, 0.95) # The worker always gets some time
+        self.retention = RetentionProxy(self)
+        self.retention_stats = None
+        self.forwarded_metrics = []
+        self.priority = None
+        self.pid = None
+        self.starts = 0
+        self.restarts = 0
+        self.last_exit_code = None
+        self.paused = False
+        self.throttled_seconds = 0.0
+        self._process = None
+        self._channel = None
+        self._signal_lock = threading.Lock()
+        self._last_message = 0.0
+        self._stopping = False
+        self._thread = None
+        self._register_metrics()
+
+    def _register_metrics(self):
+        metrics.gauge_callback("pizero_worker_up", "1 while the background worker process runs.",
+                               lambda: int(self.running()))
+        metrics.counter_callback("pizero_worker_restarts_total", "Background worker restarts after it exited or hung.",
+                                 lambda: self.restarts)
+        metrics.counter_callback("pizero_worker_throttled_seconds_total",
+                                 "Time the background worker was paused because the live view was behind.",
+                                 lambda: self.throttled_seconds)
+        if self.latency is not None:
+            metrics.gauge_callback("pizero_frame_delivery_latency_seconds",
+                                   "Capture-to-client latency of the worst-off live viewer.", self.latency)
+        metrics.REGISTRY.register(_ForwardedMetrics(self))
+
+    def running(self):
+        process = self._process
+        return process is not None and process.poll() is None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="worker-supervisor", daemon=True)
+        self._thread.start()
+        if self.latency is not None and self.max_duty > 0:
+            threading.Thread(target=self._throttle, name="worker-throttle", daemon=True).start()
+
+    def stop(self):
+        self._stopping = True
+        self._signal(signal.SIGTERM)
+        self._signal(signal.SIGCONT) # A paused worker only acts on the SIGTERM once it runs again
+
+    # --- Messages ---
+
+    def send(self, **message):
+        # Lost while the worker is down, which is fine: it polls the job table and rescans the storage when it starts
+        channel = self._channel
+        if channel is None:
+            return False
+        try:
+            channel.send(**message)
+            return True
+        except OSError:
+            return False
+
+    def wake(self):
+        self.send(op="wake")
+
+    def _read(self, channel):
+        for message in channel:
+            self._last_message = time.monotonic()
+            op = message.get("op")
+            if op == "hello":
+                self.priority = message.get("priority")
+                STARTUP.set("worker", READY, f"pid {message.get('pid')}")
+            elif op == "stats":
+                self.retention_stats = message.get("retention")
+                self.forwarded_metrics = message.get("metrics") or []
+
+    # --- Process lifecycle ---
+
+    def _spawn(self):
+        parent_sock, child_sock = socket.socketpair()
+        command = [sys.executable, "-u", os.path.abspath(__file__),
+                   "--fd", str(child_sock.fileno()), "--parent", str(os.getpid())]
+        try:
+            # Own process group, so pausing and killing it covers the ffmpeg processes it starts
+            process = subprocess.Popen(command, pass_fds=(child_sock.fileno(),), start_new_session=True)
+        except OSError:
+            parent_sock.close()
+            raise
+        finally:
+            child_sock.close()
+        self._channel = Channel(parent_sock)
+        self._last_message = time.monotonic()
+        with self._signal_lock:
+            self._process = process
+        self.pid = process.pid
+        self.starts += 1
+        STARTUP.set("worker", STARTING, f"pid {process.pid}")
+        threading.Thread(target=self._read, args=(self._channel,), name="worker-reader", daemon=True).start()
+
+    def _watch(self):
+        # Waits for the worker to exit, and kills it when it stops answering. Returns its exit code.
+        while True:
+            try:
+                return self._process.wait(timeout=WORKER_HEARTBEAT_INTERVAL)
+            except subprocess.TimeoutExpired:
+                pass
+            if time.monotonic() - self._last_message > WORKER_HANG_TIMEOUT:
+                print(f"Background worker (pid {self.pid}) sent nothing for {WORKER_HANG_TIMEOUT}s, killing it.")
+                self._signal(signal.SIGKILL)
+
+    def _close(self):
+        channel, self._channel = self._channel, None
+        if channel is not None:
+            channel.close()
+        with self._signal_lock:
+            self._process = None
+        self.paused = False
+
+    def _run(self):
+        delay = 1
+        while not self._stopping:
+            started = time.monotonic()
+            try:
+                self._spawn()
+            except OSError as e:
+                print(f"Could not start the background worker: {e}")
+                STARTUP.set("worker", FAILED, str(e))
+            else:
+                self.last_exit_code = self._watch()
+                self._close()
+                if self._stopping:
+                    return
+                if time.monotonic() - started >= STABLE_SECONDS:
+                    delay = 1
+                print(f"Background worker exited with code {self.last_exit_code}, restarting in {delay}s.")
+                STARTUP.set("worker", FAILED, f"exited with code {self.last_exit_code}, restarting")
+            time.sleep(delay)
+            delay = min(delay * 2, WORKER_RESTART_MAX_DELAY)
+            self.restarts += 1
+
+    def _signal(self, sig):
+        with self._signal_lock:
+            if self._process is None or self._process.returncode is not None:
+                return False
+            try:
+                os.killpg(self._process.pid, sig)
+                return True
+            except OSError: # Already gone
+                return False
+
+    # --- Throttling ---
+
+    def _throttle(self):
+        # Frames first: while the live view is behind, the worker only runs between short pauses
+        resume = THROTTLE_SLICE * (1 - self.max_duty) / self.max_duty
+        while not self._stopping:
+            latency = self.latency()
+            if latency is None or latency <= self.latency_target or not self._signal(signal.SIGSTOP):
+                time.sleep(THROTTLE_CHECK_INTERVAL)
+                continue
+            self.paused = True
+            time.sleep(THROTTLE_SLICE)
+            self._signal(signal.SIGCONT)
+            self.paused = False
+            self.throttled_seconds += THROTTLE_SLICE
+            time.sleep(resume)
+
+    def stats(self):
+        return {
+            "running": self.running(),
+            "pid": self.pid,
+            "priority": self.priority,
+            "starts": self.starts,
+            "restarts": self.restarts,
+            "last_exit_code": self.last_exit_code,
+            "paused": self.paused,
+            "throttled_seconds": round(self.throttled_seconds, 1),
+            "latency_target": self.latency_target,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Background worker process, started by WorkerSupervisor")
+    parser.add_argument("--fd", type=int, required=True, help="This end of the socketpair to the web process")
+    parser.add_argument("--parent", type=int, required=True, help="pid of the web process")
+    args = parser.parse_args()
+    run_worker(args.fd, args.parent)